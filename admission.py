@@ -0,0 +1,121 @@
+"""
+Контроль допуска запросов к ассистентам при перегрузке.
+
+Давление — худший из сигналов, каждый относительно своего порога:
+    in_flight   — запросы в работе в этом процессе / ADMISSION_MAX_IN_FLIGHT;
+    queue_wait  — сколько задача ждёт воркера в task_queue / ADMISSION_QUEUE_WAIT;
+    p95         — p95 ответов OpenAI за ADMISSION_WINDOW секунд / ADMISSION_P95.
+
+По давлению выбирается уровень деградации (уровни накопительные):
+    0 normal        — всё как обычно;
+    1 no_tools      — без необязательных инструментов: code_interpreter только
+                      при живом контейнере, file_search только по классификатору;
+    2 cheap_model   — сначала резервная (более дешёвая и быстрая) модель ассистента;
+    3 short_output  — ограничение длины ответа и просьба отвечать кратко;
+    4 reject        — новые запросы не принимаются, пользователь получает ETA.
+
+Вверх уровень переключается сразу, вниз — по одному шагу не чаще раза
+в ADMISSION_COOLDOWN секунд, чтобы не раскачиваться.
+"""
+from __future__ import annotations
+import logging
+import math
+import time
+
+from config import (
+    ADMISSION_CONTROL, ADMISSION_MAX_IN_FLIGHT, ADMISSION_QUEUE_WAIT, ADMISSION_P95,
+    ADMISSION_WINDOW, ADMISSION_COOLDOWN
+)
+from metrics import ADMISSION_TIER, ADMISSION_PRESSURE
+from model_router import router
+from pending_jobs import in_flight
+
+TIER_NORMAL, TIER_NO_TOOLS, TIER_CHEAP_MODEL, TIER_SHORT_OUTPUT, TIER_REJECT = range(5)
+TIER_NAMES = ("normal", "no_tools", "cheap_model", "short_output", "reject")
+# Давление, с которого включается уровень 1..4
+TIER_PRESSURE = (0.6, 0.8, 1.0, 1.3)
+
+# Как часто пересчитывать уровень (секунды) и сколько доверять последнему замеру очереди
+CHECK_INTERVAL = 1.0
+QUEUE_WAIT_TTL = 60.0
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        enabled: bool = ADMISSION_CONTROL,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        queue_wait_target: float = ADMISSION_QUEUE_WAIT,
+        p95_target: float = ADMISSION_P95,
+        window: float = ADMISSION_WINDOW,
+        cooldown: float = ADMISSION_COOLDOWN
+    ):
+        self.enabled = enabled
+        self.max_in_flight = max_in_flight
+        self.queue_wait_target = queue_wait_target
+        self.p95_target = p95_target
+        self.window = window
+        self.cooldown = cooldown
+        self._tier = TIER_NORMAL
+        self._changed = 0.0
+        self._checked = float("-inf")
+        self._queue_wait = (0.0, float("-inf"))  # (секунды, когда замерено)
+
+    def observe_queue_wait(self, seconds: float) -> None:
+        """Замер ожидания в task_queue (dispatcher — старейшая задача, воркер — только что взятая)"""
+        self._queue_wait = (max(seconds, 0.0), time.monotonic())
+
+    def queue_wait(self) -> float:
+        seconds, at = self._queue_wait
+        return seconds if time.monotonic() - at <= QUEUE_WAIT_TTL else 0.0
+
+    def signals(self) -> dict[str, float]:
+        """Давление по каждому сигналу (1.0 — на пороге)"""
+        p95 = router.recent_p95(self.window)
+        return {
+            "in_flight": len(in_flight) / self.max_in_flight if self.max_in_flight > 0 else 0.0,
+            "queue_wait": self.queue_wait() / self.queue_wait_target if self.queue_wait_target > 0 else 0.0,
+            "p95": (p95 or 0.0) / self.p95_target if self.p95_target > 0 else 0.0,
+        }
+
+    def tier(self) -> int:
+        """Текущий уровень деградации"""
+        if not self.enabled:
+            return TIER_NORMAL
+
+        now = time.monotonic()
+        if now - self._checked < CHECK_INTERVAL:
+            return self._tier
+        self._checked = now
+
+        signals = self.signals()
+        for signal, value in signals.items():
+            ADMISSION_PRESSURE.labels(signal).set(value)
+        target = sum(max(signals.values()) >= threshold for threshold in TIER_PRESSURE)
+
+        if target > self._tier:
+            self._switch(target, now)
+        elif target < self._tier and now - self._changed >= self.cooldown:
+            self._switch(self._tier - 1, now)
+        return self._tier
+
+    def _switch(self, tier: int, now: float) -> None:
+        logging.warning(f"Admission tier {TIER_NAMES[self._tier]} -> {TIER_NAMES[tier]}")
+        self._tier = tier
+        self._changed = now
+        ADMISSION_TIER.set(tier)
+
+    def eta(self) -> int:
+        """Через сколько секунд имеет смысл повторить: очередь + ответ + шаг вниз по уровням"""
+        p95 = router.recent_p95(self.window) or 0.0
+        return int(self.queue_wait() + p95 + self.cooldown)
+
+    def reject_text(self) -> str:
+        minutes = max(1, math.ceil(self.eta() / 60))
+        return (
+            "⏳ Сейчас к ассистентам слишком много запросов, и ответ не успел бы прийти вовремя.\n"
+            f"Попробуйте через {minutes} мин. — этот запрос не учтён в лимите."
+        )
+
+
+admission = AdmissionController()
@@ -0,0 +1,388 @@
+"""
+Аналитика для администраторов (/stats, /stats_csv).
+
+Каждый запрос к ассистенту и каждый отказ по дневному лимиту пишется одной
+строкой в request_log. Фоновый агрегатор раз в ANALYTICS_INTERVAL секунд берёт
+строки после водяного знака (rollup_state.last_id) и прибавляет их к сводкам:
+
+    daily_stats        — (день, ассистент): запросы, ошибки, таймауты, отказы
+                         по лимиту, токены, гистограмма задержек;
+    daily_active_users — уникальные пользователи за день (пересчёт из usage_log
+                         только для дней, затронутых очередной порцией).
+
+Отчёты читают только сводки — O(дней), а не O(строк журнала). Гистограммы
+складываются, поэтому перцентили за любой период считаются по сумме бакетов.
+Сырой журнал старше ANALYTICS_RETENTION_DAYS удаляется после агрегации.
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import csv
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import ANALYTICS_RETENTION_DAYS
+from database import session_maker, RequestLog, DailyStats, DailyActiveUsers, RollupState, UsageLog
+
+# Верхние границы бакетов задержки (мс); последний бакет — всё, что дольше
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2000, 3000, 5000, 7500, 10_000, 15_000, 20_000,
+                      30_000, 45_000, 60_000, 120_000, 300_000)
+
+ROLLUP_NAME = "daily_stats"
+ROLLUP_BATCH = 5000
+# Свежие строки не агрегируем: транзакция с меньшим id могла ещё не закоммититься
+ROLLUP_LAG = 10
+# Строк на одну порцию при выгрузке CSV
+EXPORT_CHUNK = 1000
+
+_current: contextvars.ContextVar[dict | None] = contextvars.ContextVar("analytics_request", default=None)
+
+
+# ======================================================
+#                   ЗАПИСЬ СОБЫТИЙ
+# ======================================================
+def add_tokens(usage, model: str) -> None:
+    """Учесть токены ответа OpenAI в текущем запросе (если он отслеживается)"""
+    stats = _current.get()
+    if stats is None or usage is None:
+        return
+    stats["model"] = model
+    stats["input_tokens"] += usage.input_tokens or 0
+    stats["output_tokens"] += usage.output_tokens or 0
+
+
+def add_estimate(input_tokens: int) -> None:
+    """Учесть локальную оценку входа запроса — для сравнения с фактическими токенами"""
+    stats = _current.get()
+    if stats is not None:
+        stats["estimated_tokens"] = (stats["estimated_tokens"] or 0) + input_tokens
+
+
+async def record_request(
+    tg_id: int,
+    assistant_id: str | None,
+    kind: str,
+    status: str,
+    latency_ms: int | None = None,
+    model: str | None = None,
+    input_tokens: int = 0,
+    output_tokens: int = 0,
+    estimated_tokens: int | None = None,
+    input_type: str | None = None
+) -> None:
+    """Записать запрос в журнал (ошибки записи не мешают ответу пользователю)"""
+    try:
+        async with session_maker() as session:
+            session.add(RequestLog(
+                tg_id=tg_id,
+                assistant_id=assistant_id,
+                kind=kind,
+                input_type=input_type,
+                status=status,
+                model=model,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                estimated_tokens=estimated_tokens,
+                latency_ms=latency_ms,
+                created_at=datetime.now()
+            ))
+            await session.commit()
+    except Exception as e:
+        logging.warning(f"Failed to record request of user {tg_id}: {e}")
+
+
+@asynccontextmanager
+async def track_request(tg_id: int, assistant_id: str, kind: str, input_type: str | None = None):
+    """Замерить запрос к ассистенту и записать его в журнал вместе с токенами"""
+    stats = {"model": None, "input_tokens": 0, "output_tokens": 0, "estimated_tokens": None}
+    token = _current.set(stats)
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException as e:
+        status = "timeout" if isinstance(e, TimeoutError) else "error"
+        raise
+    finally:
+        _current.reset(token)
+        await record_request(
+            tg_id, assistant_id, kind, status,
+            latency_ms=int((time.perf_counter() - started) * 1000),
+            input_type=input_type,
+            **stats
+        )
+
+
+# ======================================================
+#                   АГРЕГАЦИЯ
+# ======================================================
+def _bucket_index(latency_ms: int) -> int:
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if latency_ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+def _empty_delta() -> dict:
+    return {
+        "requests": 0, "errors": 0, "timeouts": 0, "limit_hits": 0,
+        "input_tokens": 0, "output_tokens": 0, "latency_sum_ms": 0,
+        "latency_buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+    }
+
+
+def _aggregate(rows: list[RequestLog]) -> dict[tuple[date, str], dict]:
+    deltas: dict[tuple[date, str], dict] = {}
+    for row in rows:
+        delta = deltas.setdefault((row.created_at.date(), row.assistant_id or "-"), _empty_delta())
+        if row.status == "limit":
+            delta["limit_hits"] += 1
+            continue
+
+        delta["requests"] += 1
+        delta["errors"] += row.status == "error"
+        delta["timeouts"] += row.status == "timeout"
+        delta["input_tokens"] += row.input_tokens or 0
+        delta["output_tokens"] += row.output_tokens or 0
+        if row.latency_ms is not None:
+            delta["latency_sum_ms"] += row.latency_ms
+            delta["latency_buckets"][_bucket_index(row.latency_ms)] += 1
+    return deltas
+
+
+async def _advance_watermark(session: AsyncSession, watermark: int | None, last_id: int) -> bool:
+    """Сдвинуть водяной знак; False — другой инстанс успел агрегировать эту порцию"""
+    if watermark is None:
+        session.add(RollupState(name=ROLLUP_NAME, last_id=last_id))
+        try:
+            await session.flush()
+        except IntegrityError:
+            return False
+        return True
+
+    result = await session.execute(
+        update(RollupState)
+        .where(RollupState.name == ROLLUP_NAME, RollupState.last_id == watermark)
+        .values(last_id=last_id)
+    )
+    return result.rowcount == 1
+
+
+async def rollup_once() -> int:
+    """Прибавить к сводкам следующую порцию журнала; возвращает число учтённых строк"""
+    async with session_maker() as session:
+        state = await session.get(RollupState, ROLLUP_NAME)
+        watermark = state.last_id if state else None
+
+        border = datetime.now() - timedelta(seconds=ROLLUP_LAG)
+        result = await session.execute(
+            select(RequestLog)
+            .where(RequestLog.id > (watermark or 0), RequestLog.created_at < border)
+            .order_by(RequestLog.id)
+            .limit(ROLLUP_BATCH)
+        )
+        rows = result.scalars().all()
+        if not rows:
+            return 0
+
+        # Водяной знак двигаем первым: параллельный агрегатор на нём остановится
+        if not await _advance_watermark(session, watermark, rows[-1].id):
+            await session.rollback()
+            return 0
+
+        for (day, assistant_id), delta in _aggregate(rows).items():
+            result = await session.execute(
+                select(DailyStats).where(DailyStats.day == day, DailyStats.assistant_id == assistant_id)
+            )
+            stats = result.scalar_one_or_none()
+            buckets = delta.pop("latency_buckets")
+            if stats is None:
+                session.add(DailyStats(day=day, assistant_id=assistant_id,
+                                       latency_buckets=json.dumps(buckets), **delta))
+                continue
+            for field, value in delta.items():
+                setattr(stats, field, getattr(stats, field) + value)
+            stats.latency_buckets = json.dumps([a + b for a, b in zip(json.loads(stats.latency_buckets), buckets)])
+
+        for day in {row.created_at.date() for row in rows}:
+            await _refresh_active_users(session, day)
+
+        await session.commit()
+        return len(rows)
+
+
+async def _refresh_active_users(session: AsyncSession, day: date) -> None:
+    # usage_log — одна строка на пользователя в день, индекс по usage_date
+    users = (await session.execute(
+        select(func.count()).select_from(UsageLog).where(UsageLog.usage_date == day)
+    )).scalar_one()
+
+    result = await session.execute(update(DailyActiveUsers).where(DailyActiveUsers.day == day).values(users=users))
+    if result.rowcount == 0:
+        session.add(DailyActiveUsers(day=day, users=users))
+
+
+async def purge_request_log() -> int:
+    """Удалить уже агрегированные строки журнала старше ANALYTICS_RETENTION_DAYS"""
+    if ANALYTICS_RETENTION_DAYS <= 0:
+        return 0
+    async with session_maker() as session:
+        state = await session.get(RollupState, ROLLUP_NAME)
+        if state is None:
+            return 0
+        result = await session.execute(
+            delete(RequestLog).where(
+                RequestLog.id <= state.last_id,
+                RequestLog.created_at < datetime.now() - timedelta(days=ANALYTICS_RETENTION_DAYS)
+            )
+        )
+        await session.commit()
+    return result.rowcount
+
+
+async def run_rollups(interval: float) -> None:
+    """Фоновый агрегатор: догоняет журнал порциями, потом ждёт interval секунд"""
+    while True:
+        try:
+            while await rollup_once() == ROLLUP_BATCH:
+                pass
+            purged = await purge_request_log()
+            if purged:
+                logging.info(f"Purged {purged} old request_log rows")
+        except Exception as e:
+            logging.warning(f"Analytics rollup failed: {e}")
+        await asyncio.sleep(interval)
+
+
+# ======================================================
+#                   ОТЧЁТЫ
+# ======================================================
+def latency_percentile(buckets: list[int], q: float) -> int | None:
+    """Перцентиль задержки по гистограмме (верхняя граница бакета, мс)"""
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(buckets):
+        seen += count
+        if seen >= rank:
+            return LATENCY_BUCKETS_MS[min(i, len(LATENCY_BUCKETS_MS) - 1)]
+    return LATENCY_BUCKETS_MS[-1]
+
+
+async def get_stats(session: AsyncSession, days: int) -> tuple[list[dict], dict[str, dict]]:
+    """Сводка за последние days дней: (по дням, по ассистентам)"""
+    since = date.today() - timedelta(days=days - 1)
+
+    per_day: dict[date, dict] = {}
+    per_assistant: dict[str, dict] = {}
+
+    result = await session.execute(select(DailyStats).where(DailyStats.day >= since))
+    for stats in result.scalars().all():
+        day = per_day.setdefault(stats.day, {"day": stats.day, "users": 0, "requests": 0, "limit_hits": 0,
+                                             "errors": 0, "tokens": 0})
+        day["requests"] += stats.requests
+        day["limit_hits"] += stats.limit_hits
+        day["errors"] += stats.errors + stats.timeouts
+        day["tokens"] += stats.input_tokens + stats.output_tokens
+
+        total = per_assistant.setdefault(stats.assistant_id, _empty_delta())
+        for field in ("requests", "errors", "timeouts", "limit_hits", "input_tokens", "output_tokens",
+                      "latency_sum_ms"):
+            total[field] += getattr(stats, field)
+        total["latency_buckets"] = [a + b for a, b in zip(total["latency_buckets"], json.loads(stats.latency_buckets))]
+
+    result = await session.execute(select(DailyActiveUsers).where(DailyActiveUsers.day >= since))
+    for active in result.scalars().all():
+        per_day.setdefault(active.day, {"day": active.day, "users": 0, "requests": 0, "limit_hits": 0,
+                                        "errors": 0, "tokens": 0})["users"] = active.users
+
+    return [per_day[d] for d in sorted(per_day)], per_assistant
+
+
+def _num(value: int) -> str:
+    return f"{value:,}".replace(",", " ")
+
+
+def format_stats(days: int, per_day: list[dict], per_assistant: dict[str, dict], titles: dict[str, str]) -> str:
+    lines = [f"📈 <b>Статистика за {days} дн.</b>\n"]
+
+    lines.append("<b>По дням</b> (пользователи / запросы / лимит / ошибки / токены):")
+    for d in per_day:
+        lines.append(f"{d['day']:%d.%m}: {d['users']} / {d['requests']} / {d['limit_hits']} / "
+                     f"{d['errors']} / {_num(d['tokens'])}")
+
+    lines.append("\n<b>По ассистентам:</b>")
+    for assistant_id, a in sorted(per_assistant.items(), key=lambda item: -item[1]["requests"]):
+        p50 = latency_percentile(a["latency_buckets"], 0.5)
+        p95 = latency_percentile(a["latency_buckets"], 0.95)
+        latency = f"p50 ≤ {p50 / 1000:g}s, p95 ≤ {p95 / 1000:g}s" if p50 is not None else "нет данных"
+        lines.append(
+            f"{titles.get(assistant_id, assistant_id)}: {a['requests']} запр., "
+            f"ошибок {a['errors']}, таймаутов {a['timeouts']}, лимит {a['limit_hits']}\n"
+            f"   токены {_num(a['input_tokens'])} → {_num(a['output_tokens'])}, {latency}"
+        )
+
+    if not per_day:
+        lines.append("Данных пока нет")
+    return "\n".join(lines)
+
+
+# ======================================================
+#                   ВЫГРУЗКА CSV
+# ======================================================
+EXPORTS = {
+    "daily": (
+        ("day", "assistant_id", "requests", "errors", "timeouts", "limit_hits",
+         "input_tokens", "output_tokens", "latency_p50_ms", "latency_p95_ms"),
+        lambda since: select(DailyStats).where(DailyStats.day >= since).order_by(DailyStats.day, DailyStats.assistant_id),
+    ),
+    "requests": (
+        ("id", "created_at", "tg_id", "assistant_id", "kind", "input_type", "status", "model",
+         "input_tokens", "output_tokens", "estimated_tokens", "latency_ms"),
+        lambda since: select(RequestLog).where(RequestLog.created_at >= datetime.combine(since, datetime.min.time()))
+        .order_by(RequestLog.id),
+    ),
+}
+
+
+def _csv_row(kind: str, obj) -> list:
+    if kind == "daily":
+        buckets = json.loads(obj.latency_buckets)
+        return [obj.day, obj.assistant_id, obj.requests, obj.errors, obj.timeouts, obj.limit_hits,
+                obj.input_tokens, obj.output_tokens, latency_percentile(buckets, 0.5), latency_percentile(buckets, 0.95)]
+    return [obj.id, obj.created_at.isoformat(timespec="seconds"), obj.tg_id, obj.assistant_id, obj.kind,
+            obj.input_type, obj.status, obj.model, obj.input_tokens, obj.output_tokens, obj.estimated_tokens, obj.latency_ms]
+
+
+async def export_csv(kind: str, days: int, path: str) -> int:
+    """
+    Выгрузить сводки (daily) или сырой журнал (requests) в CSV.
+    Строки читаются потоком (server-side cursor) и пишутся порциями — без загрузки всего в память.
+    """
+    header, build_query = EXPORTS[kind]
+    since = date.today() - timedelta(days=days - 1)
+    written = 0
+
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+
+        async with session_maker() as session:
+            result = await session.stream_scalars(
+                build_query(since).execution_options(yield_per=EXPORT_CHUNK)
+            )
+            async for partition in result.partitions(EXPORT_CHUNK):
+                rows = [_csv_row(kind, obj) for obj in partition]
+                await asyncio.to_thread(writer.writerows, rows)
+                written += len(rows)
+
+    return written
@@ -0,0 +1,376 @@
+"""
+Выполнение запросов к ассистентам и доставка ответов в Telegram.
+
+Используется и хэндлерами main.py (inline-режим), и воркерами очереди (worker.py),
+поэтому работает только с bot/chat_id, без объекта Message.
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import json
+import logging
+import mimetypes
+import os
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+from aiogram.utils.chat_action import ChatActionSender
+
+from config import (
+    TELEGRAM_TOKEN, TELEGRAM_API_URL, DAILY_REQUEST_LIMIT, BACKGROUND_FILE_JOBS, SEND_QUEUE, LOADING_MODE,
+    PENDING_JOB_MAX_AGE
+)
+from database import session_maker, BackgroundJobs
+from keyboards import build_assistant_keyboard, ASSISTANTS
+from openai_client_v2 import ask_assistant_v2, ask_assistant_file_v2
+from rate_limit import increment_usage, get_usage_count, refund_usage
+from background_jobs import job_poller
+from coordination import user_lock
+from metrics import timed
+from analytics import track_request, record_request
+from send_queue import SendQueueMiddleware, send_priority, PRIORITY_LOADING, PRIORITY_REPLY
+from pending_jobs import in_flight, claim_pending, InFlightJob
+from eta import input_type, TEXT
+
+
+def create_bot() -> Bot:
+    """Создать экземпляр бота с настройками по умолчанию"""
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else AiohttpSession()
+    if SEND_QUEUE:
+        # Отправка через очередь с учётом лимитов Telegram (send_queue.py)
+        session.middleware(SendQueueMiddleware())
+    return Bot(TELEGRAM_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+
+def get_safe_filepath(original_filename: str) -> str:
+    """Генерирует безопасный путь для временного файла"""
+    safe_name = os.path.basename(original_filename)
+    unique_name = f"{uuid.uuid4().hex}_{safe_name}"
+    return os.path.join(tempfile.gettempdir(), unique_name)
+
+
+def format_usage_info(current: int, limit: int) -> str:
+    """Форматирует информацию о лимите"""
+    remaining = limit - current
+    if remaining <= 20:
+        return f"⚠️ Осталось запросов: {remaining}/{limit}"
+    return f"📊 Запросов: {current}/{limit}"
+
+
+def format_title(assistant_id: str) -> str:
+    a = ASSISTANTS.get(assistant_id)
+    if not a:
+        return "🤖 <b>Ассистент</b>"
+    return f"{a['emoji']} <b>{a['title']}</b>"
+
+
+async def send_loading(bot: Bot, chat_id: int, text: str, force: bool = False) -> int | None:
+    """
+    Показать индикатор загрузки и вернуть id сообщения.
+    В режиме action сообщение не отправляется (кроме force) — вместо него chat action.
+    """
+    if LOADING_MODE == "action" and not force:
+        return None
+    with send_priority(PRIORITY_LOADING):
+        message = await bot.send_message(chat_id, text)
+    return message.message_id
+
+
+def loading_action(bot: Bot, chat_id: int, action: str = "typing"):
+    """Heartbeat chat action на время запроса к ассистенту (режим action)"""
+    if LOADING_MODE != "action":
+        return contextlib.nullcontext()
+    return ChatActionSender(bot=bot, chat_id=chat_id, action=action)
+
+
+async def deliver_message(bot: Bot, chat_id: int, loading_message_id: int | None, text: str, assistant_id: str) -> None:
+    """Итоговое сообщение: правкой индикатора загрузки (режим edit) или новым сообщением"""
+    markup = build_assistant_keyboard(assistant_id)
+
+    if loading_message_id and LOADING_MODE == "edit":
+        try:
+            with send_priority(PRIORITY_REPLY):
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=loading_message_id,
+                                            reply_markup=markup)
+            return
+        except Exception as e:
+            logging.warning(f"Failed to edit loading message {loading_message_id}: {e}")
+
+    await delete_loading(bot, chat_id, loading_message_id)
+    await bot.send_message(chat_id, text, reply_markup=markup)
+
+
+async def delete_loading(bot: Bot, chat_id: int, message_id: int | None) -> None:
+    """Удалить сообщение о загрузке (ошибки игнорируем — сообщение могли удалить)"""
+    if not message_id:
+        return
+    try:
+        await bot.delete_message(chat_id, message_id)
+    except Exception as e:
+        logging.warning(f"Failed to delete loading message {message_id}: {e}")
+
+
+@timed("db_usage")
+async def charge_usage(tg_id: int, charge: bool) -> int:
+    """Списать запрос (или только прочитать счётчик при повторном выполнении)"""
+    async with session_maker() as session:
+        if charge:
+            count = await increment_usage(tg_id, session)
+            in_flight.mark_charged()
+            return count
+        return await get_usage_count(tg_id, session)
+
+
+@timed("telegram_send")
+async def send_reply(bot: Bot, chat_id: int, assistant_id: str, reply: str, usage: int,
+                     loading_message_id: int | None = None) -> None:
+    usage_info = format_usage_info(usage, DAILY_REQUEST_LIMIT)
+    await deliver_message(
+        bot, chat_id, loading_message_id,
+        f"{format_title(assistant_id)}:\n\n{reply}\n\n{usage_info}",
+        assistant_id
+    )
+
+
+async def run_text_request(
+    bot: Bot,
+    chat_id: int,
+    tg_id: int,
+    assistant_id: str,
+    text: str,
+    loading_message_id: int | None,
+    charge: bool = True
+) -> None:
+    """Выполнить текстовый запрос к ассистенту и отправить ответ"""
+    try:
+        new_count = await charge_usage(tg_id, charge)
+
+        # Один запрос пользователя за раз — иначе реплики перезапишут last_response_id
+        async with (
+            loading_action(bot, chat_id),
+            track_request(tg_id, assistant_id, "text", TEXT),
+            session_maker() as session,
+            user_lock(tg_id, session)
+        ):
+            reply, _, _ = await ask_assistant_v2(
+                tg_id=tg_id,
+                assistant_id=assistant_id,
+                user_message=text,
+                session=session
+            )
+
+        await send_reply(bot, chat_id, assistant_id, reply, new_count, loading_message_id)
+
+    except TimeoutError:
+        await deliver_message(
+            bot, chat_id, loading_message_id,
+            "⏱️ Ассистент не успел ответить за отведённое время.\n"
+            "Попробуйте повторить запрос или сформулировать вопрос короче.",
+            assistant_id
+        )
+
+    except Exception as e:
+        logging.error(f"ERROR for user {tg_id}: {type(e).__name__}: {e}")
+        await deliver_message(
+            bot, chat_id, loading_message_id,
+            "⚠️ Ошибка обращения к ассистенту. Попробуйте ещё раз.",
+            assistant_id
+        )
+
+
+async def run_file_request(
+    bot: Bot,
+    chat_id: int,
+    tg_id: int,
+    assistant_id: str,
+    file_id: str,
+    filename: str,
+    is_photo: bool,
+    loading_message_id: int | None,
+    charge: bool = True,
+    allow_background: bool = True
+) -> None:
+    """Скачать файл из Telegram, отправить ассистенту и доставить ответ"""
+    filepath = get_safe_filepath(filename)
+
+    try:
+        async with loading_action(bot, chat_id, "upload_document"):
+            tg_file = await bot.get_file(file_id)
+            downloaded = await bot.download_file(tg_file.file_path)
+
+            with open(filepath, "wb") as f:
+                f.write(downloaded.read())
+
+            # Документы (code_interpreter) анализируются долго — отдаём в background-режим
+            mime, _ = mimetypes.guess_type(filepath)
+            use_background = (
+                allow_background
+                and BACKGROUND_FILE_JOBS
+                and not is_photo
+                and not (mime or "").startswith("image/")
+            )
+
+            new_count = await charge_usage(tg_id, charge)
+
+            if use_background and not loading_message_id:
+                # Ответ может прийти через минуты — chat action столько не живёт, нужен индикатор-сообщение
+                loading_message_id = await send_loading(
+                    bot, chat_id, f"⏳ {format_title(assistant_id)} анализирует файл...", force=True
+                )
+
+            # Background-задачу пишет в request_log job_poller, когда она завершится:
+            # здесь была бы только отправка — без токенов и с задержкой в доли секунды
+            file_type = input_type("file", is_photo, os.path.getsize(filepath))
+            request_log = (
+                contextlib.nullcontext() if use_background
+                else track_request(tg_id, assistant_id, "file", file_type)
+            )
+            async with request_log, session_maker() as session, user_lock(tg_id, session):
+                if use_background:
+                    try:
+                        await job_poller.submit(
+                            tg_id=tg_id,
+                            chat_id=chat_id,
+                            assistant_id=assistant_id,
+                            filepath=filepath,
+                            loading_message_id=loading_message_id,
+                            session=session,
+                            input_type=file_type
+                        )
+                    except Exception as e:
+                        await record_request(tg_id, assistant_id, "file",
+                                             "timeout" if isinstance(e, TimeoutError) else "error")
+                        raise
+                    return
+
+                reply, _, _ = await ask_assistant_file_v2(
+                    tg_id=tg_id,
+                    assistant_id=assistant_id,
+                    filepath=filepath,
+                    session=session
+                )
+
+        await send_reply(bot, chat_id, assistant_id, reply, new_count, loading_message_id)
+
+    except TimeoutError:
+        await deliver_message(
+            bot, chat_id, loading_message_id,
+            "⏱️ Ассистент не успел ответить за отведённое время.\n"
+            "Попробуйте повторить запрос или отправить файл меньшего размера.",
+            assistant_id
+        )
+
+    except Exception as e:
+        logging.error(f"FILE ERROR for user {tg_id}: {type(e).__name__}: {e}")
+        await deliver_message(
+            bot, chat_id, loading_message_id,
+            "⚠️ Ошибка обработки файла. Попробуйте ещё раз или обратитесь в поддержку.",
+            assistant_id
+        )
+
+    finally:
+        if os.path.exists(filepath):
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+
+
+async def deliver_background_reply(bot: Bot, job: BackgroundJobs, reply: str | None) -> None:
+    """Доставить пользователю результат background-анализа файла"""
+    if reply is None:
+        await deliver_message(
+            bot, job.chat_id, job.loading_message_id,
+            "⚠️ Ошибка обработки файла. Попробуйте ещё раз или обратитесь в поддержку.",
+            job.assistant_id
+        )
+        return
+
+    async with session_maker() as session:
+        usage = await get_usage_count(job.tg_id, session)
+
+    await send_reply(bot, job.chat_id, job.assistant_id, reply, usage, job.loading_message_id)
+
+
+async def run_task(
+    bot: Bot,
+    kind: str,
+    tg_id: int,
+    chat_id: int,
+    assistant_id: str,
+    payload: dict,
+    loading_message_id: int | None,
+    charge: bool = True,
+    allow_background: bool = True
+) -> None:
+    """Выполнить запрос по описанию задачи (task_queue, pending_jobs)"""
+    if kind == "text":
+        await run_text_request(
+            bot,
+            chat_id=chat_id,
+            tg_id=tg_id,
+            assistant_id=assistant_id,
+            text=payload["text"],
+            loading_message_id=loading_message_id,
+            charge=charge
+        )
+    elif kind == "file":
+        await run_file_request(
+            bot,
+            chat_id=chat_id,
+            tg_id=tg_id,
+            assistant_id=assistant_id,
+            file_id=payload["file_id"],
+            filename=payload["filename"],
+            is_photo=payload.get("is_photo", False),
+            loading_message_id=loading_message_id,
+            charge=charge,
+            allow_background=allow_background
+        )
+    else:
+        logging.error(f"Unknown task kind {kind!r} for user {tg_id}")
+
+
+async def resume_pending_jobs(bot: Bot) -> list[asyncio.Task]:
+    """
+    Подхватить запросы, прерванные остановкой прошлого процесса:
+    свежие выполнить заново (без повторного списания), старые — вернуть в лимит.
+    """
+    tasks = []
+    border = datetime.utcnow() - timedelta(seconds=PENDING_JOB_MAX_AGE)
+
+    for job in await claim_pending():
+        if job.started_at >= border:
+            tasks.append(asyncio.create_task(resume_job(bot, job)))
+            continue
+
+        try:
+            if job.charged_on:
+                async with session_maker() as session:
+                    await refund_usage(job.tg_id, job.charged_on, session)
+            await deliver_message(
+                bot, job.chat_id, job.loading_message_id,
+                "⚠️ Бот перезапускался, и запрос не был выполнен. Он не учтён в лимите — отправьте его ещё раз.",
+                job.assistant_id
+            )
+        except Exception as e:
+            logging.warning(f"Failed to refund interrupted request of user {job.tg_id}: {e}")
+
+    if tasks:
+        logging.info(f"Resumed {len(tasks)} requests interrupted by the previous shutdown")
+    return tasks
+
+
+async def resume_job(bot: Bot, job) -> None:
+    payload = json.loads(job.payload)
+    tracked = InFlightJob(job.tg_id, job.chat_id, job.assistant_id, job.kind, payload,
+                          job.loading_message_id, charged_on=job.charged_on)
+    # Если и этот процесс остановят — запрос снова попадёт в pending_jobs
+    with in_flight.track(tracked):
+        await run_task(bot, job.kind, job.tg_id, job.chat_id, job.assistant_id, payload,
+                       job.loading_message_id, charge=job.charged_on is None)
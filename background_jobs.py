@@ -0,0 +1,281 @@
+"""
+Поллер background-задач Responses API.
+
+Долгие анализы файлов запускаются с background=True и сохраняются в таблицу
+background_jobs. Поллер опрашивает их с растущим интервалом и доставляет
+результат пользователю. После редеплоя незавершённые задачи подхватываются заново.
+
+Итог задачи (статус, токены, задержка от создания) пишется в request_log
+при завершении — отправку задачи run_file_request в журнал не пишет.
+
+Срок BACKGROUND_JOB_TIMEOUT считается от создания задачи (рестарт его не продлевает)
+и проверяется и при ошибках опроса. Удалённый ответ (404) — сразу ошибка:
+задача завершается, пользователь получает сообщение вместо вечного «анализирует файл...».
+
+Несколько процессов (реплики бота, воркеры QUEUE_MODE): задачу опрашивает только
+владелец и обновляет heartbeat; задачу без heartbeat дольше LEASE_TIMEOUT забирает
+другой процесс условным UPDATE, как в broadcast.py. Завершение — тоже условный UPDATE
+по статусу: журнал и доставка выполняются ровно один раз.
+
+Готовый ответ продолжает диалог, только если пользователь не писал, пока файл
+анализировался (last_response_id всё ещё тот, от которого задача запущена).
+Иначе цепочка не трогается: ответ доставляется, но в контекст не попадает.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+from openai import NotFoundError
+from sqlalchemy import select, update, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import BACKGROUND_POLL_MIN, BACKGROUND_POLL_MAX, BACKGROUND_JOB_TIMEOUT
+from database import session_maker, BackgroundJobs
+from openai_client_v2 import (
+    client, submit_file_job_v2, advance_response_id, extract_reply_text,
+    response_input_tokens, response_container_id
+)
+from coordination import user_lock
+from analytics import record_request
+
+ACTIVE_STATUSES = ("queued", "in_progress")
+# Итог задачи -> статус request_log
+LOG_STATUSES = {"completed": "ok", "expired": "timeout"}
+
+# Задачу без heartbeat дольше этого времени забирает другой процесс (секунды)
+LEASE_TIMEOUT = 60
+
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# deliver(job, reply): reply=None означает, что задача завершилась ошибкой
+DeliverCallback = Callable[[BackgroundJobs, "str | None"], Awaitable[None]]
+
+
+class JobPoller:
+    """Опрашивает background-ответы и доставляет результаты"""
+
+    def __init__(self):
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._deliver: DeliverCallback | None = None
+        self._watch_task: asyncio.Task | None = None
+
+    async def start(self, deliver: DeliverCallback) -> None:
+        """Запустить поллер: подхватить брошенные задачи из БД и следить за новыми"""
+        self._deliver = deliver
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        """Остановить опрос (задачи остаются в БД и будут подхвачены при следующем старте)"""
+        tasks = list(self._tasks.values())
+        if self._watch_task is not None:
+            tasks.append(self._watch_task)
+            self._watch_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+        # Отпускаем владение сразу, не дожидаясь LEASE_TIMEOUT
+        async with session_maker() as session:
+            await session.execute(
+                update(BackgroundJobs)
+                .where(BackgroundJobs.owner == INSTANCE_ID, BackgroundJobs.status.in_(ACTIVE_STATUSES))
+                .values(owner=None)
+            )
+            await session.commit()
+
+    def track(self, job_id: int, response_id: str, created_at: datetime | None = None) -> None:
+        if job_id in self._tasks:
+            return
+        task = asyncio.create_task(self._poll(job_id, response_id, created_at))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def submit(
+        self,
+        tg_id: int,
+        chat_id: int,
+        assistant_id: str,
+        filepath: str,
+        loading_message_id: int | None,
+        session: AsyncSession,
+        input_type: str | None = None
+    ) -> BackgroundJobs:
+        """Отправить файл в background-режиме и поставить задачу на опрос"""
+        response_id, model, previous_response_id = await submit_file_job_v2(tg_id, assistant_id, filepath, session)
+
+        job = BackgroundJobs(
+            tg_id=tg_id,
+            chat_id=chat_id,
+            assistant_id=assistant_id,
+            response_id=response_id,
+            previous_response_id=previous_response_id,
+            model=model,
+            input_type=input_type,
+            loading_message_id=loading_message_id,
+            status="queued",
+            created_at=datetime.utcnow(),
+            owner=INSTANCE_ID,
+            heartbeat_at=datetime.utcnow()
+        )
+        session.add(job)
+        await session.commit()
+
+        self.track(job.id, response_id, job.created_at)
+        return job
+
+    async def _watch(self) -> None:
+        while True:
+            try:
+                await self._heartbeat()
+                await self._claim_abandoned()
+            except Exception as e:
+                logging.warning(f"Failed to check background jobs: {e}")
+            await asyncio.sleep(LEASE_TIMEOUT / 3)
+
+    async def _heartbeat(self) -> None:
+        """Продлить владение своими задачами; задачи, забранные другим процессом, перестать опрашивать"""
+        if not self._tasks:
+            return
+        ids = list(self._tasks)
+        async with session_maker() as session:
+            await session.execute(
+                update(BackgroundJobs)
+                .where(BackgroundJobs.id.in_(ids), BackgroundJobs.owner == INSTANCE_ID)
+                .values(heartbeat_at=datetime.utcnow())
+            )
+            await session.commit()
+            result = await session.execute(
+                select(BackgroundJobs.id).where(
+                    BackgroundJobs.id.in_(ids),
+                    BackgroundJobs.status.in_(ACTIVE_STATUSES),
+                    or_(BackgroundJobs.owner.is_(None), BackgroundJobs.owner != INSTANCE_ID)
+                )
+            )
+            lost = result.scalars().all()
+
+        for job_id in lost:
+            logging.info(f"Background job {job_id} taken over by another process")
+            task = self._tasks.get(job_id)
+            if task is not None:
+                task.cancel()
+
+    async def _claim_abandoned(self) -> None:
+        border = datetime.utcnow() - timedelta(seconds=LEASE_TIMEOUT)
+        # Свои задачи, которые этот процесс не опрашивает, — от прошлого запуска с тем же INSTANCE_ID
+        abandoned = or_(
+            BackgroundJobs.owner.is_(None),
+            BackgroundJobs.owner == INSTANCE_ID,
+            BackgroundJobs.heartbeat_at.is_(None),
+            BackgroundJobs.heartbeat_at < border
+        )
+
+        async with session_maker() as session:
+            result = await session.execute(
+                select(BackgroundJobs).where(BackgroundJobs.status.in_(ACTIVE_STATUSES), abandoned)
+            )
+            jobs = [job for job in result.scalars().all() if job.id not in self._tasks]
+
+            claimed = 0
+            for job in jobs:
+                # Условный UPDATE — задачу забирает только один процесс
+                result = await session.execute(
+                    update(BackgroundJobs)
+                    .where(BackgroundJobs.id == job.id, BackgroundJobs.status.in_(ACTIVE_STATUSES), abandoned)
+                    .values(owner=INSTANCE_ID, heartbeat_at=datetime.utcnow())
+                )
+                await session.commit()
+                if result.rowcount == 1:
+                    claimed += 1
+                    self.track(job.id, job.response_id, job.created_at)
+
+        if claimed:
+            logging.info(f"Resumed polling of {claimed} background jobs")
+
+    async def _poll(self, job_id: int, response_id: str, created_at: datetime | None) -> None:
+        interval = BACKGROUND_POLL_MIN
+        # У задач, созданных до появления created_at, срок считается от подхвата
+        deadline = (created_at or datetime.utcnow()) + timedelta(seconds=BACKGROUND_JOB_TIMEOUT)
+
+        while True:
+            await asyncio.sleep(interval)
+            interval = min(interval * 1.5, BACKGROUND_POLL_MAX)
+
+            try:
+                response = await client.responses.retrieve(response_id)
+            except NotFoundError as e:
+                logging.error(f"Background response {response_id} not found: {e}")
+                await self._finish(job_id, None, "failed")
+                return
+            except Exception as e:
+                logging.warning(f"Failed to poll background response {response_id}: {e}")
+                if datetime.utcnow() < deadline:
+                    continue
+                await self._finish(job_id, None, "expired")
+                return
+
+            if response.status in ACTIVE_STATUSES:
+                if datetime.utcnow() < deadline:
+                    continue
+                try:
+                    response = await client.responses.cancel(response_id)
+                except Exception as e:
+                    logging.warning(f"Failed to cancel background response {response_id}: {e}")
+
+            await self._finish(job_id, response)
+            return
+
+    async def _finish(self, job_id: int, response, status: str | None = None) -> None:
+        """Завершить задачу; response=None — ответ не получить, status задаёт итог"""
+        if status is None:
+            status = response.status if response.status not in ACTIVE_STATUSES else "expired"
+        completed = status == "completed"
+
+        # Условный UPDATE: если задачу уже завершил другой процесс, второй раз не пишем и не доставляем
+        async with session_maker() as session:
+            result = await session.execute(
+                update(BackgroundJobs)
+                .where(BackgroundJobs.id == job_id, BackgroundJobs.status.in_(ACTIVE_STATUSES))
+                .values(status=status, owner=None)
+            )
+            await session.commit()
+            if result.rowcount != 1:
+                logging.info(f"Background job {job_id} already finished by another process")
+                return
+            job = await session.get(BackgroundJobs, job_id)
+
+        usage = response.usage if response is not None else None
+        await record_request(
+            job.tg_id, job.assistant_id, "file", LOG_STATUSES.get(status, "error"),
+            latency_ms=int((datetime.utcnow() - job.created_at).total_seconds() * 1000) if job.created_at else None,
+            model=job.model,
+            input_type=job.input_type,
+            input_tokens=(usage.input_tokens or 0) if usage else 0,
+            output_tokens=(usage.output_tokens or 0) if usage else 0
+        )
+
+        if completed:
+            async with session_maker() as session, user_lock(job.tg_id, session):
+                advanced = await advance_response_id(
+                    job.tg_id, job.assistant_id, job.previous_response_id, response.id, session,
+                    response_input_tokens(response), response_container_id(response)
+                )
+            if not advanced:
+                logging.info(f"Background job {job_id}: conversation moved on, reply kept out of the chain")
+        else:
+            logging.error(f"Background job {job_id} finished with status {status}")
+
+        reply = extract_reply_text(response) if completed else None
+
+        try:
+            await self._deliver(job, reply)
+        except Exception as e:
+            logging.error(f"Failed to deliver background job {job_id}: {type(e).__name__}: {e}")
+
+
+job_poller = JobPoller()
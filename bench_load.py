@@ -0,0 +1,378 @@
+"""
+Нагрузочный бенчмарк бота без сети.
+
+Поднимает заглушки Telegram Bot API и OpenAI (fake_servers.py) в отдельном процессе,
+направляет на них бота (TELEGRAM_API_URL, OPENAI_BASE_URL), создаёт временную SQLite
+и подаёт синтетические апдейты в dp.feed_update: каждый пользователь выбирает
+одного из ассистентов и отправляет несколько сообщений подряд.
+
+Отчёт: апдейтов в секунду, p50/p95/p99 по стадиям (из трасс tracing.py),
+SQL-запросов на апдейт, вызовов Bot API на апдейт (по методам), пиковый RSS. Результат можно сохранить как baseline
+и сравнивать с ним следующие прогоны.
+
+Запуск:
+    python bench_load.py --users 2000 --messages 3 --latency 0.5 --save baseline
+    python bench_load.py --users 2000 --messages 3 --latency 0.5 --compare baseline
+    python bench_load.py --queue   # QUEUE_MODE: dispatcher + воркер в одном процессе
+    python bench_load.py --loading-mode action   # индикатор загрузки через sendChatAction
+    python bench_load.py --latency 1 --slow-start 5 --slow-duration 20 --slow-factor 8 --admission-p95 3
+        # деградация OpenAI: уровни admission.py в отчёте
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+BASELINE_DIR = "bench_baselines"
+
+# Вопросы вперемешку: по базе знаний, с расчётами (code_interpreter)
+# и реплики, которым поиск не нужен (благодарность, ответ на уточняющий вопрос)
+QUESTIONS = (
+    "как поднять конверсию карточки?",
+    "посчитай маржинальность при цене 1990 и себестоимости 740",
+    "спасибо!",
+    "какие фото лучше ставить первыми?",
+    "женская одежда",
+    "рассчитай, сколько заказов нужно для выхода в ноль при рекламе 30000",
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк с заглушками Telegram и OpenAI")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=3, help="Сообщений от каждого пользователя")
+    parser.add_argument("--concurrency", type=int, default=50, help="Одновременно активных пользователей")
+    parser.add_argument("--latency", type=float, default=0.5, help="Медиана задержки OpenAI, секунды")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--input-tokens", type=int, default=1500)
+    parser.add_argument("--output-tokens", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0, help="Seed задержек и ошибок заглушки OpenAI")
+    parser.add_argument("--container-cold-start", type=float, default=0.0,
+                        help="Задержка создания контейнера code_interpreter в заглушке, секунды")
+    parser.add_argument("--file-search-latency", type=float, default=0.0,
+                        help="Задержка, которую заглушка добавляет запросам с file_search, секунды "
+                             "(задаётся, а не измеряется; реальная — bench_retrieval.py --responses)")
+    parser.add_argument("--slow-start", type=float, default=0.0,
+                        help="Через сколько секунд заглушка OpenAI начинает тормозить")
+    parser.add_argument("--slow-duration", type=float, default=0.0,
+                        help="Сколько секунд заглушка OpenAI тормозит (0 — без деградации)")
+    parser.add_argument("--slow-factor", type=float, default=1.0,
+                        help="Во сколько раз растёт задержка OpenAI во время деградации")
+    parser.add_argument("--admission-p95", type=float, help="Порог p95 OpenAI для контроля допуска (ADMISSION_P95)")
+    parser.add_argument("--admission-max-in-flight", type=int,
+                        help="Порог запросов в работе для контроля допуска (ADMISSION_MAX_IN_FLIGHT)")
+    parser.add_argument("--admission-window", type=float, help="ADMISSION_WINDOW, секунды")
+    parser.add_argument("--admission-cooldown", type=float, help="ADMISSION_COOLDOWN, секунды")
+    parser.add_argument("--queue", action="store_true", help="Режим очереди: воркер в этом же процессе")
+    parser.add_argument("--loading-mode", choices=("message", "edit", "action"), default="edit",
+                        help="Индикатор загрузки (LOADING_MODE)")
+    parser.add_argument("--db-url", help="БД бота (по умолчанию — временная SQLite)")
+    parser.add_argument("--save", metavar="NAME", help="Сохранить результат как baseline")
+    parser.add_argument("--compare", metavar="NAME", help="Сравнить с сохранённым baseline")
+    return parser.parse_args()
+
+
+def start_stubs(args: argparse.Namespace) -> multiprocessing.Process:
+    """Заглушки в отдельном процессе — чтобы не делить event loop с ботом"""
+    from fake_servers import StubConfig, run
+
+    telegram_port, openai_port = free_port(), free_port()
+    config = StubConfig(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        input_tokens=args.input_tokens,
+        output_tokens=args.output_tokens,
+        seed=args.seed,
+        container_cold_start=args.container_cold_start,
+        file_search_latency=args.file_search_latency,
+        slow_start=args.slow_start,
+        slow_duration=args.slow_duration,
+        slow_factor=args.slow_factor
+    )
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=run, args=(telegram_port, openai_port, config, ready), daemon=True)
+    process.start()
+    if not ready.wait(10):
+        sys.exit("Заглушки не запустились")
+
+    # Окружение бота — до импорта его модулей (клиенты создаются при импорте)
+    db_url = args.db_url or f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:BENCH",
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{telegram_port}",
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "DATABASE_URL": db_url,
+        "DAILY_REQUEST_LIMIT": "1000000",
+        "QUEUE_MODE": "true" if args.queue else "false",
+        "SLOW_UPDATE_THRESHOLD": "1e9",
+        "METRICS_PORT": "0",
+        "LOADING_MODE": args.loading_mode,
+    })
+    for name, value in (("ADMISSION_P95", args.admission_p95),
+                        ("ADMISSION_MAX_IN_FLIGHT", args.admission_max_in_flight),
+                        ("ADMISSION_WINDOW", args.admission_window),
+                        ("ADMISSION_COOLDOWN", args.admission_cooldown)):
+        if value is not None:
+            os.environ[name] = str(value)
+    return process
+
+
+class Collector:
+    """Собирает длительности спанов из завершённых трасс"""
+
+    def __init__(self):
+        self.stages: dict[str, list[float]] = defaultdict(list)
+        self.db_statements: list[int] = []
+        self.admission_tiers: dict[str, int] = defaultdict(int)
+
+    def __call__(self, trace) -> None:
+        self.db_statements.append(trace.db_statements)
+
+        container = trace.attrs.get("container")
+        file_search = trace.attrs.get("file_search")
+        tier = trace.attrs.get("admission_tier")
+        if tier:
+            self.admission_tiers[tier] += 1
+
+        def walk(span, prefix):
+            name = f"{prefix}{span.name}"
+            self.stages[name].append(span.duration)
+            if span.name == "openai" and container:
+                # Задержка OpenAI отдельно по режиму контейнера code_interpreter и с/без file_search
+                self.stages[f"{name}[{container}]"].append(span.duration)
+                self.stages[f"{name}[file_search={'on' if file_search else 'off'}]"].append(span.duration)
+            if span.name == "openai" and tier:
+                self.stages[f"{name}[{tier}]"].append(span.duration)
+            for child in span.children:
+                walk(child, prefix + "  ")
+
+        walk(trace.root, "")
+
+
+def make_updates(user_index: int, assistant_ids: list[str], messages: int, update_ids):
+    from aiogram.types import Update, Message, CallbackQuery, Chat, User
+
+    tg_id = 10_000_000 + user_index
+    user = User(id=tg_id, is_bot=False, first_name=f"User{user_index}")
+    chat = Chat(id=tg_id, type="private")
+    now = datetime.now()
+    assistant_id = assistant_ids[user_index % len(assistant_ids)]
+
+    updates = [Update(
+        update_id=next(update_ids),
+        callback_query=CallbackQuery(
+            id=f"cb{user_index}",
+            from_user=user,
+            chat_instance="bench",
+            data=f"set_assistant:{assistant_id}",
+            message=Message(message_id=1, date=now, chat=chat, from_user=user, text="menu")
+        )
+    )]
+    for i in range(messages):
+        updates.append(Update(
+            update_id=next(update_ids),
+            message=Message(message_id=2 + i, date=now, chat=chat, from_user=user,
+                            text=QUESTIONS[(user_index + i) % len(QUESTIONS)])
+        ))
+    return updates
+
+
+async def wait_queue_empty() -> None:
+    from sqlalchemy import select, func
+    from database import session_maker, TaskQueue
+
+    while True:
+        async with session_maker() as session:
+            left = (await session.execute(select(func.count()).select_from(TaskQueue))).scalar_one()
+        if not left:
+            return
+        await asyncio.sleep(0.2)
+
+
+@contextlib.asynccontextmanager
+async def bot_under_test(args: argparse.Namespace):
+    """Dispatcher и бот, направленные на заглушки; в режиме --queue — ещё и воркер"""
+    from main import dp, bot
+    from database import create_db
+    from tracing import TRACE_LISTENERS
+    from coordination import start_coordination, stop_coordination
+
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    collector = Collector()
+    TRACE_LISTENERS.append(collector)
+
+    await create_db()
+    await start_coordination()
+
+    worker_task, stop = None, asyncio.Event()
+    if args.queue:
+        from worker import run_worker
+        worker_task = asyncio.create_task(run_worker(bot=bot, stop=stop))
+
+    try:
+        yield dp, bot, collector
+    finally:
+        if worker_task:
+            stop.set()
+            await worker_task
+        else:
+            await stop_coordination()
+            await bot.session.close()
+
+
+async def telegram_calls() -> dict[str, int]:
+    """Счётчики вызовов Bot API из заглушки Telegram"""
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{os.environ['TELEGRAM_API_URL']}/stats") as response:
+            return await response.json()
+
+
+async def openai_calls() -> dict[str, int]:
+    """Счётчики заглушки OpenAI (запросы, ошибки, созданные и переиспользованные контейнеры)"""
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{os.environ['OPENAI_BASE_URL'].removesuffix('/v1')}/stats") as response:
+            return await response.json()
+
+
+def summarize(args: argparse.Namespace, collector: Collector, total_updates: int, elapsed: float,
+              calls: dict[str, int], openai: dict[str, int] | None = None) -> dict:
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "params": {k: v for k, v in vars(args).items() if k not in ("save", "compare")},
+        "updates": total_updates,
+        "elapsed_s": round(elapsed, 2),
+        "updates_per_s": round(total_updates / elapsed, 1),
+        "db_statements_per_trace": round(sum(collector.db_statements) / max(len(collector.db_statements), 1), 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "bot_api_calls_per_update": round(sum(calls.values()) / total_updates, 2),
+        "bot_api_calls": calls,
+        "openai_calls": openai or {},
+        "admission_tiers": dict(collector.admission_tiers),
+        "stages": {
+            name: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+            }
+            for name, values in collector.stages.items()
+        },
+    }
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    from keyboards import ASSISTANTS
+
+    update_ids = itertools.count(1)
+    assistant_ids = list(ASSISTANTS)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with bot_under_test(args) as (dp, bot, collector):
+        async def simulate_user(index: int) -> None:
+            async with semaphore:
+                for update in make_updates(index, assistant_ids, args.messages, update_ids):
+                    await dp.feed_update(bot, update)
+
+        print(f"👥 Пользователей: {args.users}, сообщений: {args.messages}, ассистентов: {len(assistant_ids)}, "
+              f"одновременно: {args.concurrency}, режим: {'queue' if args.queue else 'inline'}")
+
+        started = time.monotonic()
+        await asyncio.gather(*(simulate_user(i) for i in range(args.users)))
+        if args.queue:
+            await wait_queue_empty()
+        elapsed = time.monotonic() - started
+        calls, openai = await telegram_calls(), await openai_calls()
+
+    return summarize(args, collector, args.users * (args.messages + 1), elapsed, calls, openai)
+
+
+def print_report(result: dict, baseline: dict | None = None) -> None:
+    def delta(current: float, previous: float | None) -> str:
+        if not previous:
+            return ""
+        return f" ({(current - previous) / previous:+.0%})"
+
+    base_stages = (baseline or {}).get("stages", {})
+
+    print("\n" + "=" * 70)
+    print(f"Апдейтов: {result['updates']} за {result['elapsed_s']}s")
+    print(f"Апдейтов в секунду: {result['updates_per_s']}{delta(result['updates_per_s'], (baseline or {}).get('updates_per_s'))}")
+    print(f"SQL-запросов на трассу: {result['db_statements_per_trace']}"
+          f"{delta(result['db_statements_per_trace'], (baseline or {}).get('db_statements_per_trace'))}")
+    print(f"Пиковый RSS: {result['peak_rss_mb']} MB{delta(result['peak_rss_mb'], (baseline or {}).get('peak_rss_mb'))}")
+    print(f"Вызовов Bot API на апдейт: {result['bot_api_calls_per_update']}"
+          f"{delta(result['bot_api_calls_per_update'], (baseline or {}).get('bot_api_calls_per_update'))}")
+    print("   " + ", ".join(f"{method}: {count}" for method, count in sorted(result["bot_api_calls"].items())))
+    if result.get("openai_calls"):
+        print("OpenAI: " + ", ".join(f"{name}: {count}" for name, count in sorted(result["openai_calls"].items())))
+    if result.get("admission_tiers"):
+        print("Уровни допуска: " + ", ".join(f"{tier}: {count}" for tier, count in result["admission_tiers"].items()))
+    print("-" * 70)
+    print(f"{'стадия':<28}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, s in result["stages"].items():
+        print(f"{name:<28}{s['count']:>8}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}"
+              f"{delta(s['p95_ms'], base_stages.get(name, {}).get('p95_ms'))}")
+    print("=" * 70)
+
+
+def load_baseline(name: str | None) -> dict | None:
+    if not name:
+        return None
+    with open(os.path.join(BASELINE_DIR, f"{name}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(name: str, result: dict) -> None:
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"💾 Baseline сохранён: {path}")
+
+
+def main() -> None:
+    args = parse_args()
+    baseline = load_baseline(args.compare)
+
+    stubs = start_stubs(args)
+    try:
+        result = asyncio.run(run_benchmark(args))
+    finally:
+        stubs.terminate()
+
+    print_report(result, baseline)
+    if args.save:
+        save_baseline(args.save, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Сравнение локального поиска (local_retrieval.py) с hosted file_search.
+
+Для каждого вопроса из файла (по одному на строку):
+    - задержка локального поиска и vector_stores.search;
+    - совпадение источников: доля файлов из top-k file_search, найденных локально
+      (только по вопросам, прошедшим локальный порог, — иначе в нём смешались бы
+      отсечения порогом и расхождение ранжирования). Файлы сравниваются по пути
+      из attributes, который пишет sync_vector_store.py (имя загруженного файла
+      может отличаться); у загруженных вручную — по имени файла;
+    - сколько вопросов локальный порог релевантности отсекает целиком.
+
+С --responses каждый вопрос дополнительно отправляется в Responses API (модель
+и инструкции ассистента) с file_search и без — реальная цена инструмента
+в полном ответе, а не заданная задержка заглушки из bench_load.py.
+Это платные запросы к живому API.
+
+Использование:
+    python bench_retrieval.py --assistant asst_QfzzLwaL8JHcve4Y80IVKq9E --questions questions.txt
+    python bench_retrieval.py --assistant asst_QfzzLwaL8JHcve4Y80IVKq9E --questions questions.txt --responses
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from config import LOCAL_RETRIEVAL_TOP_K
+from local_retrieval import client, retrieve, get_index
+from openai_client_v2 import (
+    ASSISTANT_VECTOR_STORES, ASSISTANT_MODELS, ASSISTANT_INSTRUCTIONS, DEFAULT_MODEL, build_tools
+)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def source_key(path: str) -> str:
+    """Путь источника для сравнения: относительный, через «/», без учёта регистра"""
+    return path.replace("\\", "/").strip("/").lower()
+
+
+async def hosted_search(vector_store_id: str, query: str, top_k: int) -> tuple[list[str], float]:
+    """Источники top-k file_search: путь из attributes, без него — имя файла"""
+    started = time.monotonic()
+    page = await client.vector_stores.search(vector_store_id, query=query, max_num_results=top_k)
+    latency = time.monotonic() - started
+    return [source_key((result.attributes or {}).get("path") or result.filename) for result in page.data], latency
+
+
+async def response_latency(assistant_id: str, question: str, file_search: bool) -> float:
+    """Полный ответ Responses API с file_search или без (code_interpreter не подключается)"""
+    started = time.monotonic()
+    await client.responses.create(
+        model=ASSISTANT_MODELS.get(assistant_id, DEFAULT_MODEL),
+        instructions=ASSISTANT_INSTRUCTIONS.get(assistant_id),
+        input=question,
+        tools=build_tools(assistant_id, use_file_search=file_search, use_code_interpreter=False),
+        store=False
+    )
+    return time.monotonic() - started
+
+
+def print_latency(title: str, values: list[float]) -> None:
+    print(f"{title:<18}p50 {percentile(values, 0.5) * 1000:.0f}ms, p95 {percentile(values, 0.95) * 1000:.0f}ms")
+
+
+async def run_benchmark(assistant_id: str, questions: list[str], top_k: int, responses: bool = False) -> None:
+    vector_store_id = ASSISTANT_VECTOR_STORES.get(assistant_id)
+    if not vector_store_id:
+        sys.exit(f"У ассистента {assistant_id} нет Vector Store")
+    if get_index(assistant_id) is None:
+        sys.exit("Локальный индекс не найден, соберите его: python local_retrieval.py build ...")
+
+    local_latency, hosted_latency, agreement = [], [], []
+    with_search, without_search = [], []
+    skipped = 0
+
+    for i, question in enumerate(questions, 1):
+        local = await retrieve(assistant_id, question, top_k)
+        hosted_files, latency = await hosted_search(vector_store_id, question, top_k)
+
+        local_latency.append(local.latency)
+        hosted_latency.append(latency)
+
+        local_paths = {source_key(chunk.source) for chunk in local.chunks}
+        local_names = {os.path.basename(path) for path in local_paths}
+        if not local.relevant:
+            skipped += 1
+        elif hosted_files:
+            # Путь совпадает целиком; файл без пути в attributes — по имени
+            hits = sum(1 for key in set(hosted_files) if key in local_paths or key in local_names)
+            agreement.append(hits / len(set(hosted_files)))
+
+        mark = "✅" if local.relevant else "⏭️"
+        print(f"   [{i}/{len(questions)}] {mark} local {local.latency * 1000:.0f}ms, "
+              f"file_search {latency * 1000:.0f}ms — {question[:60]}")
+
+        if responses:
+            # Порядок чередуется, чтобы дрейф задержки API не ложился на один вариант
+            for file_search in ((True, False) if i % 2 else (False, True)):
+                (with_search if file_search else without_search).append(
+                    await response_latency(assistant_id, question, file_search)
+                )
+            print(f"      ответ: с file_search {with_search[-1] * 1000:.0f}ms, "
+                  f"без {without_search[-1] * 1000:.0f}ms")
+
+    print("\n" + "=" * 60)
+    print(f"Вопросов: {len(questions)}, top-k: {top_k}")
+    print_latency("Локальный поиск:", local_latency)
+    print_latency("file_search:", hosted_latency)
+    if responses:
+        print_latency("Ответ с поиском:", with_search)
+        print_latency("Ответ без поиска:", without_search)
+    if agreement:
+        print(f"Совпадение источников с file_search: {statistics.mean(agreement):.0%} "
+              f"(по {len(agreement)} вопросам, прошедшим порог)")
+    print(f"Отсечено порогом релевантности: {skipped} ({skipped / len(questions):.0%})")
+    print("=" * 60)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Локальный поиск vs file_search")
+    parser.add_argument("--assistant", required=True)
+    parser.add_argument("--questions", required=True, help="Файл с вопросами, по одному на строку")
+    parser.add_argument("--top-k", type=int, default=LOCAL_RETRIEVAL_TOP_K)
+    parser.add_argument("--responses", action="store_true",
+                        help="Замерить полный ответ Responses API с file_search и без (живой API)")
+    args = parser.parse_args()
+
+    with open(args.questions, encoding="utf-8") as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    asyncio.run(run_benchmark(args.assistant, questions, args.top_k, args.responses))
+
+
+if __name__ == "__main__":
+    main()
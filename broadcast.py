@@ -0,0 +1,388 @@
+"""
+Рассылка администратора всем пользователям бота (/broadcast).
+
+Получатели читаются из user_state пачками по возрастанию tg_id (keyset, без
+OFFSET и без долгой транзакции). После каждой пачки курсор last_tg_id и счётчики
+сохраняются в broadcasts, поэтому после рестарта рассылка продолжается с места
+остановки — повторно может уйти не больше одной пачки.
+
+Отправка: не больше BROADCAST_CONCURRENCY запросов одновременно и не быстрее
+BROADCAST_RATE сообщений в секунду на процесс. Через send_queue рассылка идёт
+с самым низким приоритетом и получает только остаток лимита после живого трафика.
+
+Пользователи, заблокировавшие бота, попадают в blocked_users и не получают
+следующие рассылки, пока снова не нажмут /start.
+
+Несколько реплик: рассылку выполняет инстанс-владелец и обновляет heartbeat
+по таймеру (пачка может отправляться дольше LEASE_TIMEOUT — низкий приоритет
+в send_queue, паузы retry_after); рассылку без heartbeat дольше LEASE_TIMEOUT
+подхватывает любой другой инстанс.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import socket
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from sqlalchemy import select, update, delete, func, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_BATCH
+from database import session_maker, Broadcasts, BlockedUsers, UserState
+from keyboards import build_broadcast_keyboard
+from metrics import BROADCAST_MESSAGES
+from send_queue import TokenBucket, send_priority, PRIORITY_BROADCAST
+
+# Рассылку без heartbeat дольше этого времени подхватывает другой инстанс (секунды)
+LEASE_TIMEOUT = 60
+# Как часто обновлять сообщение с прогрессом у администратора (секунды)
+REPORT_INTERVAL = 5
+MAX_RETRIES = 3
+
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+STATUS_TITLES = {
+    "draft": "📝 ждёт подтверждения",
+    "running": "⏳ идёт",
+    "done": "✅ завершена",
+    "cancelled": "⛔ остановлена",
+}
+
+
+def _not_blocked():
+    return UserState.tg_id.not_in(select(BlockedUsers.tg_id))
+
+
+async def count_recipients(session: AsyncSession) -> int:
+    result = await session.execute(select(func.count()).select_from(UserState).where(_not_blocked()))
+    return result.scalar_one()
+
+
+async def next_recipients(session: AsyncSession, after_tg_id: int, limit: int) -> list[int]:
+    """Следующая пачка получателей после курсора"""
+    result = await session.execute(
+        select(UserState.tg_id)
+        .where(UserState.tg_id > after_tg_id, _not_blocked())
+        .order_by(UserState.tg_id)
+        .limit(limit)
+    )
+    return list(result.scalars().all())
+
+
+async def create_broadcast(admin_id: int, text: str, session: AsyncSession) -> Broadcasts:
+    """Черновик рассылки — уходит после подтверждения администратором"""
+    broadcast = Broadcasts(
+        admin_id=admin_id,
+        text=text,
+        status="draft",
+        total=await count_recipients(session),
+        last_tg_id=0,
+        sent=0,
+        blocked=0,
+        failed=0
+    )
+    session.add(broadcast)
+    await session.commit()
+    return broadcast
+
+
+async def unblock_user(tg_id: int, session: AsyncSession) -> None:
+    """Пользователь снова запустил бота — вернуть его в рассылки"""
+    await session.execute(delete(BlockedUsers).where(BlockedUsers.tg_id == tg_id))
+    await session.commit()
+
+
+async def get_recent_broadcasts(session: AsyncSession, limit: int = 5) -> list[Broadcasts]:
+    result = await session.execute(select(Broadcasts).order_by(Broadcasts.id.desc()).limit(limit))
+    return list(result.scalars().all())
+
+
+def format_progress(broadcast: Broadcasts) -> str:
+    """Прогресс и статистика доставки для администратора"""
+    done = broadcast.sent + broadcast.blocked + broadcast.failed
+    percent = min(100, done * 100 // broadcast.total) if broadcast.total else 100
+    elapsed = 0.0
+    if broadcast.started_at:
+        elapsed = ((broadcast.finished_at or datetime.utcnow()) - broadcast.started_at).total_seconds()
+    rate = done / elapsed if elapsed else 0.0
+
+    return (
+        f"📣 <b>Рассылка #{broadcast.id}</b> — {STATUS_TITLES.get(broadcast.status, broadcast.status)}\n\n"
+        f"Обработано: {done}/{broadcast.total} ({percent}%)\n"
+        f"Доставлено: {broadcast.sent}\n"
+        f"Заблокировали бота: {broadcast.blocked}\n"
+        f"Ошибки: {broadcast.failed}\n"
+        f"Скорость: {rate:.1f} сообщ./с, прошло {elapsed:.0f} с"
+    )
+
+
+class Broadcaster:
+    """Выполняет рассылки этого инстанса и подхватывает брошенные"""
+
+    def __init__(self, rate: float, concurrency: int, batch: int):
+        self.bucket = TokenBucket(rate, 1)
+        self.concurrency = concurrency
+        self.batch = batch
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._cancelled: set[int] = set()
+        self._watch_task: asyncio.Task | None = None
+        self._bot: Bot | None = None
+
+    async def start(self, bot: Bot) -> None:
+        """Запустить слежение за брошенными рассылками (в т.ч. незавершёнными до рестарта)"""
+        self._bot = bot
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def stop(self) -> None:
+        """Остановить рассылки; они продолжатся при следующем старте или на другом инстансе"""
+        tasks = list(self._tasks.values())
+        if self._watch_task is not None:
+            tasks.append(self._watch_task)
+            self._watch_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Отпускаем владение сразу, не дожидаясь LEASE_TIMEOUT
+        async with session_maker() as session:
+            await session.execute(
+                update(Broadcasts)
+                .where(Broadcasts.owner == INSTANCE_ID, Broadcasts.status == "running")
+                .values(owner=None)
+            )
+            await session.commit()
+
+    async def launch(self, bot: Bot, broadcast_id: int, report_chat_id: int, report_message_id: int) -> bool:
+        """Запустить подтверждённый черновик; False — уже запущен или отменён"""
+        async with session_maker() as session:
+            result = await session.execute(
+                update(Broadcasts)
+                .where(Broadcasts.id == broadcast_id, Broadcasts.status == "draft")
+                .values(
+                    status="running",
+                    total=await count_recipients(session),
+                    owner=INSTANCE_ID,
+                    heartbeat_at=datetime.utcnow(),
+                    started_at=datetime.utcnow(),
+                    report_chat_id=report_chat_id,
+                    report_message_id=report_message_id
+                )
+            )
+            await session.commit()
+
+        if result.rowcount != 1:
+            return False
+        self._spawn(bot, broadcast_id)
+        return True
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        """Отменить черновик или остановить идущую рассылку"""
+        async with session_maker() as session:
+            result = await session.execute(
+                update(Broadcasts)
+                .where(Broadcasts.id == broadcast_id, Broadcasts.status.in_(("draft", "running")))
+                .values(status="cancelled", finished_at=datetime.utcnow())
+            )
+            await session.commit()
+
+        # Своя рассылка останавливается сразу, чужая — после текущей пачки
+        if broadcast_id in self._tasks:
+            self._cancelled.add(broadcast_id)
+        return result.rowcount == 1
+
+    def _spawn(self, bot: Bot, broadcast_id: int) -> None:
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+
+        def done(_):
+            self._tasks.pop(broadcast_id, None)
+            self._cancelled.discard(broadcast_id)
+
+        task.add_done_callback(done)
+
+    async def _watch(self) -> None:
+        while True:
+            try:
+                await self._claim_abandoned()
+            except Exception as e:
+                logging.warning(f"Failed to check abandoned broadcasts: {e}")
+            await asyncio.sleep(LEASE_TIMEOUT / 2)
+
+    async def _claim_abandoned(self) -> None:
+        border = datetime.utcnow() - timedelta(seconds=LEASE_TIMEOUT)
+        abandoned = or_(Broadcasts.owner.is_(None), Broadcasts.heartbeat_at < border)
+
+        async with session_maker() as session:
+            result = await session.execute(
+                select(Broadcasts.id).where(Broadcasts.status == "running", abandoned)
+            )
+            for broadcast_id in result.scalars().all():
+                # Условный UPDATE — рассылку забирает только один инстанс
+                claimed = await session.execute(
+                    update(Broadcasts)
+                    .where(Broadcasts.id == broadcast_id, Broadcasts.status == "running", abandoned)
+                    .values(owner=INSTANCE_ID, heartbeat_at=datetime.utcnow())
+                )
+                await session.commit()
+                if claimed.rowcount == 1:
+                    logging.info(f"Resuming broadcast #{broadcast_id}")
+                    self._spawn(self._bot, broadcast_id)
+
+    async def _heartbeat(self, broadcast_id: int) -> None:
+        """Продлевать владение, пока идёт рассылка, независимо от скорости пачек"""
+        while True:
+            await asyncio.sleep(LEASE_TIMEOUT / 3)
+            try:
+                async with session_maker() as session:
+                    await session.execute(
+                        update(Broadcasts)
+                        .where(Broadcasts.id == broadcast_id, Broadcasts.owner == INSTANCE_ID)
+                        .values(heartbeat_at=datetime.utcnow())
+                    )
+                    await session.commit()
+            except Exception as e:
+                logging.warning(f"Failed to refresh broadcast #{broadcast_id} heartbeat: {e}")
+
+    async def _run(self, bot: Bot, broadcast_id: int) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat(broadcast_id))
+        try:
+            await self._send_all(bot, broadcast_id)
+        finally:
+            heartbeat.cancel()
+
+    async def _send_all(self, bot: Bot, broadcast_id: int) -> None:
+        async with session_maker() as session:
+            broadcast = await session.get(Broadcasts, broadcast_id)
+        text, cursor = broadcast.text, broadcast.last_tg_id
+        semaphore = asyncio.Semaphore(self.concurrency)
+        reported = 0.0
+
+        while True:
+            async with session_maker() as session:
+                recipients = await next_recipients(session, cursor, self.batch)
+            if not recipients:
+                break
+
+            results = await asyncio.gather(
+                *(self._deliver(bot, broadcast_id, tg_id, text, semaphore) for tg_id in recipients)
+            )
+            cursor = recipients[-1]
+
+            if not await self._save_progress(broadcast_id, cursor, list(zip(recipients, results))):
+                logging.info(f"Broadcast #{broadcast_id} stopped (cancelled or taken over)")
+                await self._report(bot, broadcast_id, final=True)
+                return
+
+            if time.monotonic() - reported >= REPORT_INTERVAL:
+                reported = time.monotonic()
+                await self._report(bot, broadcast_id)
+
+        async with session_maker() as session:
+            await session.execute(
+                update(Broadcasts)
+                .where(Broadcasts.id == broadcast_id, Broadcasts.owner == INSTANCE_ID, Broadcasts.status == "running")
+                .values(status="done", finished_at=datetime.utcnow())
+            )
+            await session.commit()
+
+        logging.info(f"Broadcast #{broadcast_id} finished")
+        await self._report(bot, broadcast_id, final=True)
+
+    async def _throttle(self) -> None:
+        while (delay := self.bucket.delay(time.monotonic())) > 0:
+            await asyncio.sleep(delay)
+        self.bucket.take()
+
+    async def _deliver(
+        self,
+        bot: Bot,
+        broadcast_id: int,
+        tg_id: int,
+        text: str,
+        semaphore: asyncio.Semaphore
+    ) -> tuple[str, str | None]:
+        """Отправить одно сообщение: (sent | blocked | failed | skipped, причина)"""
+        async with semaphore:
+            result = "failed", "retry_after"
+            for _ in range(MAX_RETRIES + 1):
+                if broadcast_id in self._cancelled:
+                    return "skipped", None
+                await self._throttle()
+                try:
+                    with send_priority(PRIORITY_BROADCAST):
+                        await bot.send_message(tg_id, text)
+                    result = "sent", None
+                except TelegramForbiddenError as e:
+                    result = "blocked", e.message
+                except TelegramBadRequest as e:
+                    # Пользователь удалил аккаунт или никогда не запускал бота
+                    result = ("blocked" if "chat not found" in e.message.lower() else "failed"), e.message
+                except TelegramRetryAfter as e:
+                    logging.warning(f"Broadcast #{broadcast_id}: flood control, retry after {e.retry_after}s")
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except Exception as e:
+                    result = "failed", str(e)
+                break
+
+        BROADCAST_MESSAGES.labels(result[0]).inc()
+        return result
+
+    async def _save_progress(self, broadcast_id: int, cursor: int, results: list) -> bool:
+        """Сохранить курсор, счётчики и заблокировавших; False — рассылку надо остановить"""
+        counts = Counter(result for _, (result, _) in results)
+        blocked = {tg_id: reason for tg_id, (result, reason) in results if result == "blocked"}
+
+        async with session_maker() as session:
+            broadcast = await session.get(Broadcasts, broadcast_id)
+            if broadcast is None or broadcast.owner != INSTANCE_ID:
+                return False
+
+            broadcast.last_tg_id = cursor
+            broadcast.sent += counts["sent"]
+            broadcast.blocked += counts["blocked"]
+            broadcast.failed += counts["failed"]
+            broadcast.heartbeat_at = datetime.utcnow()
+
+            if blocked:
+                # Параллельная рассылка могла уже отметить кого-то из них
+                existing = await session.execute(
+                    select(BlockedUsers.tg_id).where(BlockedUsers.tg_id.in_(blocked))
+                )
+                for tg_id in existing.scalars().all():
+                    blocked.pop(tg_id)
+                session.add_all(BlockedUsers(tg_id=tg_id, reason=reason) for tg_id, reason in blocked.items())
+
+            await session.commit()
+            return broadcast.status == "running"
+
+    async def _report(self, bot: Bot, broadcast_id: int, final: bool = False) -> None:
+        async with session_maker() as session:
+            broadcast = await session.get(Broadcasts, broadcast_id)
+        if broadcast is None or broadcast.report_chat_id is None:
+            return
+
+        text = format_progress(broadcast)
+        try:
+            await bot.edit_message_text(
+                text,
+                chat_id=broadcast.report_chat_id,
+                message_id=broadcast.report_message_id,
+                reply_markup=None if final else build_broadcast_keyboard(broadcast_id, running=True)
+            )
+            if final:
+                # Отдельное сообщение — чтобы администратор получил уведомление
+                await bot.send_message(broadcast.report_chat_id, text)
+        except Exception as e:
+            logging.warning(f"Failed to report broadcast #{broadcast_id} progress: {e}")
+
+
+broadcaster = Broadcaster(BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_BATCH)
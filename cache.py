@@ -0,0 +1,98 @@
+"""
+In-process кэши с TTL (состояние пользователя, членство в группе, счётчики лимитов,
+отрисованная история диалога).
+
+Инвалидация между репликами — через coordination.invalidate (LISTEN/NOTIFY на PostgreSQL).
+Кэшу истории инвалидация не нужна: в ключе last_response_id, новый ответ — новый ключ.
+"""
+from __future__ import annotations
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from config import MEMBERSHIP_CACHE_TTL, USER_STATE_CACHE_TTL, USAGE_CACHE_TTL, HISTORY_CACHE_TTL, HISTORY_CACHE_SIZE
+
+MISSING = object()
+
+
+class TTLCache:
+    """Ограниченный по размеру кэш с временем жизни записей (при переполнении вытесняется давно не читанное)"""
+
+    def __init__(self, name: str, ttl: float, maxsize: int = 10000):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._loading: dict = {}
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return MISSING
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return MISSING
+        self._data.move_to_end(key)
+        return value
+
+    async def get_or_load(self, key, load: Callable[[], Awaitable]):
+        """
+        Значение из кэша или load(); одновременные промахи по одному ключу
+        ждут одну загрузку. None не кэшируется (пусто или ошибка — попробуем ещё раз).
+        """
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+
+        future = self._loading.get(key)
+        if future is not None:
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # отменили самого ожидающего
+                # Отменили того, кто загружал, — загружаем сами
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await load()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ожидающих может не быть — без «exception was never retrieved»
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            self._loading.pop(key, None)
+
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def set(self, key, value) -> None:
+        if self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+membership_cache = TTLCache("membership", MEMBERSHIP_CACHE_TTL)
+user_state_cache = TTLCache("user_state", USER_STATE_CACHE_TTL)
+usage_cache = TTLCache("usage", USAGE_CACHE_TTL)
+history_cache = TTLCache("history", HISTORY_CACHE_TTL, maxsize=HISTORY_CACHE_SIZE)
+
+CACHES = {c.name: c for c in (membership_cache, user_state_cache, usage_cache)}
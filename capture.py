@@ -0,0 +1,187 @@
+"""
+Запись входящего трафика для последующего воспроизведения (replay.py).
+
+CaptureMiddleware (outer-middleware на update) обезличивает апдейт и вместе
+со временем получения и длительностью обработки кладёт в очередь; фоновый
+писатель сбрасывает очередь в CAPTURE_PATH (JSON Lines) пачками.
+
+Обезличивание:
+    - id пользователей и чатов заменяются стабильными псевдонимами (HMAC с CAPTURE_SALT;
+      без него соль создаётся при первом запуске и хранится рядом с записью в CAPTURE_PATH.salt,
+      поэтому псевдонимы совпадают между рестартами и сессиями записи);
+    - имена, username и телефоны удаляются или заменяются заглушками;
+    - текст и подписи заменяются заглушкой той же длины и с теми же пробелами;
+    - file_id и имена файлов хэшируются (расширение сохраняется).
+
+Включается CAPTURE_UPDATES=true.
+"""
+from __future__ import annotations
+import asyncio
+import functools
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from config import CAPTURE_PATH, CAPTURE_SALT
+
+# Как часто сбрасывать буфер на диск (секунды) и максимальный размер пачки
+FLUSH_INTERVAL = 1.0
+FLUSH_BATCH = 500
+# Не даём буферу расти бесконечно, если диск не успевает
+MAX_PENDING = 10_000
+
+ID_FIELDS = {"id", "user_id", "chat_id"}
+DROP_FIELDS = {"last_name", "username", "phone_number", "bio"}
+# Обязательные поля Telegram-типов — заменяем, а не удаляем, иначе апдейт не распарсится
+REPLACE_FIELDS = {"first_name": "User", "title": "Chat"}
+TEXT_FIELDS = {"text", "caption"}
+FILE_FIELDS = {"file_id", "file_unique_id"}
+
+_WORD_RE = re.compile(r"\S")
+
+
+@functools.cache
+def _salt() -> bytes:
+    """CAPTURE_SALT или соль из CAPTURE_PATH.salt (создаётся атомарно, если её ещё нет)"""
+    if CAPTURE_SALT:
+        return CAPTURE_SALT.encode()
+
+    path = f"{CAPTURE_PATH}.salt"
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(os.urandom(16).hex())
+        try:
+            # link не перезаписывает: если соль успел создать другой процесс, берём его соль
+            os.link(tmp, path)
+            logging.info(f"Generated capture salt in {path}")
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+
+    with open(path) as f:
+        return f.read().strip().encode()
+
+
+def pseudonym(value: int) -> int:
+    """Стабильный псевдоним id (знак сохраняется: группы/каналы остаются отрицательными)"""
+    digest = hmac.new(_salt(), str(abs(value)).encode(), hashlib.sha256).digest()
+    alias = int.from_bytes(digest[:6], "big") % 9_000_000_000 + 1_000_000_000
+    return -alias if value < 0 else alias
+
+
+def _hash_text(value: str) -> str:
+    return hmac.new(_salt(), value.encode(), hashlib.sha256).hexdigest()[:24]
+
+
+def anonymize(data, key: str | None = None):
+    """Рекурсивно обезличить dump апдейта"""
+    if isinstance(data, dict):
+        result = {}
+        for k, v in data.items():
+            if k in DROP_FIELDS:
+                continue
+            result[k] = REPLACE_FIELDS[k] if k in REPLACE_FIELDS else anonymize(v, k)
+        return result
+    if isinstance(data, list):
+        return [anonymize(item, key) for item in data]
+    if key in ID_FIELDS and isinstance(data, int):
+        return pseudonym(data)
+    if key in TEXT_FIELDS and isinstance(data, str):
+        # Команды оставляем как есть — от них зависит маршрут в dispatcher
+        if data.startswith("/"):
+            return data.split()[0]
+        return _WORD_RE.sub("x", data)
+    if key in FILE_FIELDS and isinstance(data, str):
+        return _hash_text(data)
+    if key == "file_name" and isinstance(data, str):
+        return _hash_text(data) + os.path.splitext(data)[1]
+    return data
+
+
+class JsonlWriter:
+    """
+    Буферизованная фоновая запись в JSONL: put не блокирует event loop,
+    запись на диск — пачками в потоке (asyncio.to_thread).
+    Используется и для лога медленных запросов (tracing.py).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=MAX_PENDING)
+        self._task: asyncio.Task | None = None
+        self.dropped = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logging.info(f"Writing {self.path} in background")
+
+    async def stop(self) -> None:
+        """Остановить писатель, дописав всё, что осталось в буфере"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self._flush()
+        if self.dropped:
+            logging.warning(f"{self.path}: dropped {self.dropped} records (buffer full)")
+
+    def put(self, record: dict) -> None:
+        self.start()
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self._flush()
+
+    async def _flush(self) -> None:
+        while not self._queue.empty():
+            batch = []
+            while not self._queue.empty() and len(batch) < FLUSH_BATCH:
+                batch.append(self._queue.get_nowait())
+            lines = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in batch)
+            try:
+                await asyncio.to_thread(self._write, lines)
+            except OSError as e:
+                logging.warning(f"Failed to write {self.path}: {e}")
+                return
+
+    def _write(self, lines: str) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+
+capture_writer = JsonlWriter(CAPTURE_PATH)
+
+
+class CaptureMiddleware(BaseMiddleware):
+    """Outer-middleware на update: запись обезличенного апдейта и длительности обработки"""
+
+    async def __call__(self, handler, event: Update, data):
+        received = time.time()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                capture_writer.put({
+                    "ts": round(received, 3),
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                    "update": anonymize(event.model_dump(mode="json", exclude_none=True)),
+                })
+            except Exception as e:
+                logging.warning(f"Failed to capture update {event.update_id}: {e}")
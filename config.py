@@ -6,6 +6,7 @@ load_dotenv()
 
 # Telegram Bot
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # свой Bot API сервер (пусто = api.telegram.org)
 GROUP_ID = int(os.getenv("GROUP_ID", "-1003442983833"))
 
 # Admin IDs (для команд администратора)
@@ -35,3 +36,120 @@ MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", str(10 * 1024 * 1024)))  # 10 MB
 
 # OpenAI timeouts
 OPENAI_RUN_TIMEOUT = int(os.getenv("OPENAI_RUN_TIMEOUT", "120"))  # секунды
+
+# Сжатие длинных диалогов: при таком размере контекста (input tokens) цепочка previous_response_id
+# заменяется резюме, 0 = выключено
+COMPACT_INPUT_TOKENS = int(os.getenv("COMPACT_INPUT_TOKENS", "30000"))
+COMPACT_MODEL = os.getenv("COMPACT_MODEL", "gpt-4.1-mini")
+
+# Бюджет сообщения пользователя в токенах: длиннее — обрезается до запроса к OpenAI
+# (для отдельных ассистентов — ASSISTANT_INPUT_BUDGETS), 0 = без ограничения
+INPUT_TOKEN_BUDGET = int(os.getenv("INPUT_TOKEN_BUDGET", "3000"))
+
+# Локальный классификатор хода: без него file_search подключается к каждому запросу RAG-ассистентов
+TOOL_CLASSIFIER = os.getenv("TOOL_CLASSIFIER", "true").lower() == "true"
+
+# Контейнер code_interpreter переиспользуется, пока не истёк (OpenAI удаляет его после 20 минут простоя)
+CONTAINER_TTL = int(os.getenv("CONTAINER_TTL", "1140"))  # секунды
+
+# Model routing (fallback при деградации модели)
+MODEL_SLO_P95 = float(os.getenv("MODEL_SLO_P95", "40"))  # секунды
+MODEL_SLO_ERROR_RATE = float(os.getenv("MODEL_SLO_ERROR_RATE", "0.25"))
+MODEL_STATS_WINDOW = int(os.getenv("MODEL_STATS_WINDOW", "300"))  # секунды
+MODEL_STATS_MIN_SAMPLES = int(os.getenv("MODEL_STATS_MIN_SAMPLES", "10"))
+MODEL_HEDGE_DELAY = float(os.getenv("MODEL_HEDGE_DELAY", "0"))  # секунды, 0 = без hedging
+
+# Background-режим для долгого анализа файлов
+BACKGROUND_FILE_JOBS = os.getenv("BACKGROUND_FILE_JOBS", "true").lower() == "true"
+BACKGROUND_POLL_MIN = float(os.getenv("BACKGROUND_POLL_MIN", "2"))  # секунды
+BACKGROUND_POLL_MAX = float(os.getenv("BACKGROUND_POLL_MAX", "30"))  # секунды
+BACKGROUND_JOB_TIMEOUT = int(os.getenv("BACKGROUND_JOB_TIMEOUT", "1800"))  # секунды
+
+# Остановка бота: сколько ждать запросы в работе; недождавшиеся сохраняются в pending_jobs
+# и выполняются следующим процессом, а старше PENDING_JOB_MAX_AGE — возвращаются в лимит
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "25"))  # секунды
+PENDING_JOB_MAX_AGE = int(os.getenv("PENDING_JOB_MAX_AGE", "600"))  # секунды
+
+# Контроль допуска при перегрузке (admission.py): пороги сигналов, окно p95 и пауза перед шагом вниз
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "150"))  # запросов в работе на процесс
+ADMISSION_QUEUE_WAIT = float(os.getenv("ADMISSION_QUEUE_WAIT", "60"))  # секунды ожидания в task_queue
+ADMISSION_P95 = float(os.getenv("ADMISSION_P95", "30"))  # секунды
+ADMISSION_WINDOW = float(os.getenv("ADMISSION_WINDOW", "60"))  # секунды
+ADMISSION_COOLDOWN = float(os.getenv("ADMISSION_COOLDOWN", "30"))  # секунды
+DEGRADED_MAX_OUTPUT_TOKENS = int(os.getenv("DEGRADED_MAX_OUTPUT_TOKENS", "600"))
+
+# Очередь задач: dispatcher кладёт задачи в БД, worker.py их выполняет
+QUEUE_MODE = os.getenv("QUEUE_MODE", "false").lower() == "true"
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "8"))  # задач на процесс
+QUEUE_VISIBILITY_TIMEOUT = int(os.getenv("QUEUE_VISIBILITY_TIMEOUT", "600"))  # секунды
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+
+# In-process кэши (секунды, 0 = не кэшировать)
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", "300"))
+USER_STATE_CACHE_TTL = int(os.getenv("USER_STATE_CACHE_TTL", "600"))
+USAGE_CACHE_TTL = int(os.getenv("USAGE_CACHE_TTL", "60"))
+# История диалога («📜 История»): ключ меняется с каждым новым ответом, TTL только освобождает память
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "3600"))
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "2000"))  # записей (LRU)
+
+# Скрипты выгрузки: сколько запросов к OpenAI выполнять одновременно
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "8"))
+
+# Локальный поиск по базе знаний (local_retrieval.py)
+# off — только hosted file_search; prefilter — file_search только для релевантных вопросов;
+# replace — найденные фрагменты подставляются в запрос вместо file_search
+LOCAL_RETRIEVAL_MODE = os.getenv("LOCAL_RETRIEVAL_MODE", "off").lower()
+LOCAL_RETRIEVAL_DIR = os.getenv("LOCAL_RETRIEVAL_DIR", "retrieval_index")
+LOCAL_RETRIEVAL_TOP_K = int(os.getenv("LOCAL_RETRIEVAL_TOP_K", "5"))
+LOCAL_RETRIEVAL_MIN_SIMILARITY = float(os.getenv("LOCAL_RETRIEVAL_MIN_SIMILARITY", "0.35"))  # косинус
+LOCAL_RETRIEVAL_MIN_BM25 = float(os.getenv("LOCAL_RETRIEVAL_MIN_BM25", "5"))  # если индекс без эмбеддингов
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Метрики Prometheus: порт /metrics (0 = выключено). Воркеры занимают следующие порты
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Трассировка: апдейты дольше порога пишутся в slow log (JSON Lines)
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", "20"))  # секунды
+SLOW_LOG_PATH = os.getenv("SLOW_LOG_PATH", "slow_updates.jsonl")
+# Выгрузка всех трасс в формате OpenTelemetry (нужен opentelemetry-sdk), пусто = выключено
+OTEL_TRACE_FILE = os.getenv("OTEL_TRACE_FILE", "")
+
+# Запись трафика для replay.py (обезличенные апдейты, JSON Lines)
+CAPTURE_UPDATES = os.getenv("CAPTURE_UPDATES", "false").lower() == "true"
+CAPTURE_PATH = os.getenv("CAPTURE_PATH", "captured_updates.jsonl")
+# Соль псевдонимов id; пусто — генерируется один раз и хранится в CAPTURE_PATH.salt
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "")
+
+# Очередь исходящих сообщений Telegram
+SEND_QUEUE = os.getenv("SEND_QUEUE", "true").lower() == "true"
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))  # запросов в секунду на весь бот
+# Между сколькими процессами делится SEND_GLOBAL_RATE: по умолчанию бот + воркеры QUEUE_MODE одной реплики
+SEND_PROCESSES = int(os.getenv("SEND_PROCESSES", "0")) or (1 + WORKER_PROCESSES if QUEUE_MODE else 1)
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # сообщений в секунду в один чат
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+
+# Индикатор загрузки:
+# message — сообщение «думает...», потом удаляется и отправляется ответ (3 запроса к Bot API);
+# edit    — сообщение «думает...» превращается в ответ правкой (2 запроса);
+# action  — только chat action «печатает...», пока идёт запрос, и одно сообщение с ответом
+LOADING_MODE = os.getenv("LOADING_MODE", "edit").lower()
+
+# Рассылка администратора (/broadcast): лимиты на процесс
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # сообщений в секунду
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))  # одновременных запросов
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))  # получателей между сохранениями прогресса
+
+# Дедупликация апдейтов Telegram: сколько последних апдейтов помнить (в памяти и в БД), 0 = выключено
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "10000"))
+
+# Аналитика (/stats): как часто сворачивать request_log в дневные сводки и сколько хранить сырой журнал
+ANALYTICS_INTERVAL = int(os.getenv("ANALYTICS_INTERVAL", "60"))  # секунды
+ANALYTICS_RETENTION_DAYS = int(os.getenv("ANALYTICS_RETENTION_DAYS", "90"))  # 0 = хранить всё
+
+# Оценка времени ответа (eta.py) по request_log: период полураспада статистики, как часто её догонять,
+# с какого числа запросов доверять оценке
+ETA_HALF_LIFE = float(os.getenv("ETA_HALF_LIFE", "1800"))  # секунды
+ETA_REFRESH_INTERVAL = float(os.getenv("ETA_REFRESH_INTERVAL", "15"))  # секунды
+ETA_MIN_SAMPLES = int(os.getenv("ETA_MIN_SAMPLES", "5"))
@@ -0,0 +1,157 @@
+"""
+Координация между репликами бота.
+
+PostgreSQL:
+    - per-user advisory locks (pg_advisory_xact_lock) вокруг запросов к ассистенту
+      и обновления счётчиков UsageLog;
+    - LISTEN/NOTIFY для инвалидации in-process кэшей на всех инстансах.
+SQLite:
+    - только in-process asyncio.Lock и локальная инвалидация.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import CACHES
+from database import engine
+from tracing import span
+
+IS_POSTGRES = engine.dialect.name == "postgresql"
+
+NOTIFY_CHANNEL = "titan_cache_invalidation"
+
+# Пространства имён блокировок (старшие биты ключа advisory lock)
+LOCK_CONVERSATION = 1
+LOCK_USAGE = 2
+
+_local_locks: dict[tuple[int, int], asyncio.Lock] = {}
+_local_waiters: dict[tuple[int, int], int] = {}
+_listener_task: asyncio.Task | None = None
+
+
+def _advisory_key(namespace: int, tg_id: int) -> int:
+    # tg_id < 2^40, namespace — в старших битах; результат помещается в bigint
+    return (namespace << 44) | (tg_id & ((1 << 44) - 1))
+
+
+@asynccontextmanager
+async def user_lock(tg_id: int, session: AsyncSession | None = None, namespace: int = LOCK_CONVERSATION):
+    """
+    Эксклюзивная блокировка пользователя.
+
+    Внутри процесса — asyncio.Lock. На PostgreSQL дополнительно берётся
+    pg_advisory_xact_lock в транзакции session: она держится до commit/rollback
+    этой сессии, поэтому коммит состояния диалога и есть момент освобождения.
+    """
+    key = (namespace, tg_id)
+    lock = _local_locks.setdefault(key, asyncio.Lock())
+    _local_waiters[key] = _local_waiters.get(key, 0) + 1
+
+    try:
+        # Ожидание блокировки — отдельный спан: это частая причина «бот висел»
+        with span("user_lock_wait"):
+            await lock.acquire()
+        try:
+            if IS_POSTGRES and session is not None:
+                with span("advisory_lock_wait"):
+                    await session.execute(
+                        text("SELECT pg_advisory_xact_lock(:key)"),
+                        {"key": _advisory_key(namespace, tg_id)}
+                    )
+            yield
+        finally:
+            lock.release()
+    finally:
+        _local_waiters[key] -= 1
+        if not _local_waiters[key]:
+            _local_waiters.pop(key, None)
+            _local_locks.pop(key, None)
+
+
+async def invalidate(cache_name: str, key, session: AsyncSession | None = None) -> None:
+    """
+    Сбросить запись кэша локально и на остальных инстансах.
+    Если передана session — NOTIFY уйдёт вместе с её коммитом.
+    """
+    CACHES[cache_name].invalidate(key)
+
+    if not IS_POSTGRES:
+        return
+
+    payload = f"{cache_name}:{key}"
+    try:
+        if session is not None:
+            await session.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": NOTIFY_CHANNEL, "payload": payload}
+            )
+        else:
+            async with engine.begin() as conn:
+                await conn.execute(
+                    text("SELECT pg_notify(:channel, :payload)"),
+                    {"channel": NOTIFY_CHANNEL, "payload": payload}
+                )
+    except Exception as e:
+        logging.warning(f"Failed to publish cache invalidation {payload}: {e}")
+
+
+def _on_notification(connection, pid, channel, payload: str) -> None:
+    cache_name, _, raw_key = payload.partition(":")
+    cache = CACHES.get(cache_name)
+    if cache is None:
+        return
+    if raw_key == "*":
+        cache.clear()
+        return
+    try:
+        cache.invalidate(int(raw_key))
+    except ValueError:
+        cache.invalidate(raw_key)
+
+
+async def _listen_forever() -> None:
+    """Держит отдельное соединение с LISTEN и переподключается при обрывах"""
+    while True:
+        try:
+            async with engine.connect() as conn:
+                raw = await conn.get_raw_connection()
+                driver = raw.driver_connection
+                await driver.add_listener(NOTIFY_CHANNEL, _on_notification)
+                logging.info(f"Listening for cache invalidations on {NOTIFY_CHANNEL}")
+
+                # После переподключения могли пропустить уведомления — сбрасываем всё
+                for cache in CACHES.values():
+                    cache.clear()
+
+                while not driver.is_closed():
+                    await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Cache invalidation listener failed: {e}")
+
+        await asyncio.sleep(5)
+
+
+async def start_coordination() -> None:
+    """Запустить слушатель LISTEN/NOTIFY (только для PostgreSQL)"""
+    global _listener_task
+    if not IS_POSTGRES or _listener_task is not None:
+        return
+    _listener_task = asyncio.create_task(_listen_forever())
+
+
+async def stop_coordination() -> None:
+    global _listener_task
+    if _listener_task is None:
+        return
+    _listener_task.cancel()
+    try:
+        await _listener_task
+    except asyncio.CancelledError:
+        pass
+    _listener_task = None
@@ -1,11 +1,14 @@
-from datetime import date
+import logging
+from datetime import date, datetime
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import Date, func, String, Integer
+from sqlalchemy import Date, DateTime, func, inspect, text, String, Integer, BigInteger, Text, UniqueConstraint
 
 from config import DB_URL, DEBUG
+from tracing import instrument_engine
 
 engine = create_async_engine(DB_URL, echo=DEBUG)
+instrument_engine(engine)
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
@@ -13,6 +16,24 @@ session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_c
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
+
+
+def add_missing_columns(sync_conn) -> None:
+    """create_all не меняет существующие таблицы — добавляем новые nullable-колонки"""
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=sync_conn.dialect)
+            # Реплики стартуют одновременно — на PostgreSQL не падаем, если колонку уже добавили
+            if_not_exists = "IF NOT EXISTS " if sync_conn.dialect.name == "postgresql" else ""
+            sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {if_not_exists}{column.name} {column_type}"))
+            logging.info(f"Added column {table.name}.{column.name}")
 
 
 async def drop_db():
@@ -61,3 +82,151 @@ class Conversations(Base):
     tg_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
     assistant_id: Mapped[str] = mapped_column(String, nullable=False, index=True)
     last_response_id: Mapped[str] = mapped_column(String, nullable=True)
+    input_tokens: Mapped[int] = mapped_column(Integer, nullable=True)  # размер контекста цепочки на последнем ходе
+    summary: Mapped[str] = mapped_column(Text, nullable=True)  # резюме диалога до сжатия — начало новой цепочки
+    container_id: Mapped[str] = mapped_column(String, nullable=True)  # контейнер code_interpreter
+    container_expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+
+class BackgroundJobs(Base):
+    """Долгие запросы Responses API в background-режиме (переживают рестарт)"""
+    __tablename__ = 'background_jobs'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    tg_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    chat_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    assistant_id: Mapped[str] = mapped_column(String, nullable=False)
+    response_id: Mapped[str] = mapped_column(String, nullable=False, unique=True)
+    previous_response_id: Mapped[str] = mapped_column(String, nullable=True)  # от какого ответа продолжен диалог
+    input_type: Mapped[str] = mapped_column(String, nullable=True)  # тип входа для оценки времени ответа (eta.py)
+    model: Mapped[str] = mapped_column(String, nullable=True)
+    loading_message_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    status: Mapped[str] = mapped_column(String, nullable=False, default="queued", index=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)  # от него считается BACKGROUND_JOB_TIMEOUT
+    owner: Mapped[str] = mapped_column(String, nullable=True)  # процесс, который опрашивает задачу
+    heartbeat_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+
+class TaskQueue(Base):
+    """Очередь задач ассистентов для воркеров (QUEUE_MODE)"""
+    __tablename__ = 'task_queue'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    tg_id: Mapped[int] = mapped_column(Integer, nullable=False, index=True)
+    chat_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    assistant_id: Mapped[str] = mapped_column(String, nullable=False)
+    kind: Mapped[str] = mapped_column(String, nullable=False)  # text / file
+    payload: Mapped[str] = mapped_column(Text, nullable=False)  # JSON
+    loading_message_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    status: Mapped[str] = mapped_column(String, nullable=False, default="pending", index=True)
+    worker: Mapped[str] = mapped_column(String, nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    locked_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    enqueued_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)  # для сигнала queue_wait (admission.py)
+
+
+class Broadcasts(Base):
+    """Рассылки администратора: текст, курсор по tg_id и счётчики доставки"""
+    __tablename__ = 'broadcasts'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    admin_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    text: Mapped[str] = mapped_column(Text, nullable=False)
+    status: Mapped[str] = mapped_column(String, nullable=False, default="draft", index=True)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    last_tg_id: Mapped[int] = mapped_column(Integer, default=0)  # получатели с tg_id <= уже обработаны
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    blocked: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    report_chat_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    report_message_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    owner: Mapped[str] = mapped_column(String, nullable=True)
+    heartbeat_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    started_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    finished_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+
+class BlockedUsers(Base):
+    """Пользователи, заблокировавшие бота (исключаются из рассылок до следующего /start)"""
+    __tablename__ = 'blocked_users'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    tg_id: Mapped[int] = mapped_column(Integer, nullable=False, unique=True, index=True)
+    reason: Mapped[str] = mapped_column(String, nullable=True)
+
+
+class PendingJobs(Base):
+    """Запросы к ассистентам, прерванные остановкой бота (pending_jobs.py): выполняются заново или возвращаются в лимит"""
+    __tablename__ = 'pending_jobs'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    tg_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    chat_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    assistant_id: Mapped[str] = mapped_column(String, nullable=False)
+    kind: Mapped[str] = mapped_column(String, nullable=False)  # text / file
+    payload: Mapped[str] = mapped_column(Text, nullable=False)  # JSON, как в task_queue
+    loading_message_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    charged_on: Mapped[date] = mapped_column(Date, nullable=True)  # день списания запроса (None — не списан)
+    started_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+
+class ProcessedUpdates(Base):
+    """Кольцо обработанных апдейтов Telegram (dedup.py): слот = update_id % DEDUP_WINDOW"""
+    __tablename__ = 'processed_updates'
+
+    slot: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    update_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    message_key: Mapped[str] = mapped_column(String, nullable=True)
+
+
+class RequestLog(Base):
+    """Журнал запросов к ассистентам (сырьё для дневных сводок analytics.py)"""
+    __tablename__ = 'request_log'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    tg_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    assistant_id: Mapped[str] = mapped_column(String, nullable=True)
+    kind: Mapped[str] = mapped_column(String, nullable=False)  # text / file
+    input_type: Mapped[str] = mapped_column(String, nullable=True)  # text / photo / document / document_large (eta.py)
+    status: Mapped[str] = mapped_column(String, nullable=False)  # ok / error / timeout / limit
+    model: Mapped[str] = mapped_column(String, nullable=True)
+    input_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    output_tokens: Mapped[int] = mapped_column(Integer, default=0)
+    estimated_tokens: Mapped[int] = mapped_column(Integer, nullable=True)  # локальная оценка входа (token_budget.py)
+    latency_ms: Mapped[int] = mapped_column(Integer, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+
+
+class DailyStats(Base):
+    """Дневная сводка по ассистенту (инкрементально из request_log)"""
+    __tablename__ = 'daily_stats'
+    __table_args__ = (UniqueConstraint('day', 'assistant_id'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    day: Mapped[date] = mapped_column(Date, nullable=False, index=True)
+    assistant_id: Mapped[str] = mapped_column(String, nullable=False)
+    requests: Mapped[int] = mapped_column(Integer, default=0)
+    errors: Mapped[int] = mapped_column(Integer, default=0)
+    timeouts: Mapped[int] = mapped_column(Integer, default=0)
+    limit_hits: Mapped[int] = mapped_column(Integer, default=0)
+    input_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    output_tokens: Mapped[int] = mapped_column(BigInteger, default=0)
+    latency_sum_ms: Mapped[int] = mapped_column(BigInteger, default=0)
+    latency_buckets: Mapped[str] = mapped_column(Text, nullable=False)  # JSON: счётчики по LATENCY_BUCKETS_MS
+
+
+class DailyActiveUsers(Base):
+    """Уникальные пользователи за день"""
+    __tablename__ = 'daily_active_users'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    day: Mapped[date] = mapped_column(Date, nullable=False, unique=True)
+    users: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class RollupState(Base):
+    """Водяные знаки агрегаторов: до какого id журнал уже учтён"""
+    __tablename__ = 'rollup_state'
+
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    last_id: Mapped[int] = mapped_column(Integer, default=0)
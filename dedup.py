@@ -0,0 +1,120 @@
+"""
+Идемпотентная обработка апдейтов Telegram.
+
+После рестарта (offset не успел подтвердиться) или при ретраях webhook Telegram
+присылает тот же апдейт повторно — без защиты это второе списание лимита
+и второй платный запрос к OpenAI. DedupMiddleware (outer-middleware на update)
+отбрасывает апдейт, если уже видел его update_id или то же сообщение
+(chat_id, message_id; для правок — ещё и edit_date).
+
+Окно последних DEDUP_WINDOW апдейтов держится в памяти, а на диске — кольцо
+processed_updates фиксированного размера: слот = update_id % DEDUP_WINDOW.
+Апдейт записывается в кольцо до обработки, поэтому после падения повтор
+отбрасывается, не доходя до OpenAI (at-most-once: апдейт, на котором процесс
+упал, не переобрабатывается). На старте кольцо загружается в память.
+
+Апдейты получает только один процесс бота (polling), поэтому окно в памяти —
+источник истины, а кольцо — только для переживания рестарта.
+"""
+from __future__ import annotations
+import logging
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+from config import DEDUP_WINDOW
+from database import session_maker, ProcessedUpdates
+from metrics import DUPLICATE_UPDATES
+
+
+def message_key(event: Update) -> str | None:
+    """Ключ сообщения апдейта: тот же message_id в чате — то же сообщение"""
+    if event.message:
+        return f"m:{event.message.chat.id}:{event.message.message_id}"
+    if event.edited_message:
+        message = event.edited_message
+        return f"e:{message.chat.id}:{message.message_id}:{message.edit_date}"
+    return None
+
+
+class UpdateDeduplicator:
+    """Окно последних апдейтов в памяти + кольцо в БД"""
+
+    def __init__(self, window: int = DEDUP_WINDOW):
+        self.window = window
+        self._update_ids: OrderedDict[int, None] = OrderedDict()
+        self._message_keys: OrderedDict[str, None] = OrderedDict()
+
+    async def load(self) -> None:
+        """Поднять кольцо из БД после рестарта"""
+        if self.window <= 0:
+            return
+        async with session_maker() as session:
+            result = await session.execute(select(ProcessedUpdates).order_by(ProcessedUpdates.update_id))
+            rows = result.scalars().all()
+        for row in rows:
+            self._remember(row.update_id, row.message_key)
+        if rows:
+            logging.info(f"Dedup window loaded: {len(rows)} updates, last {rows[-1].update_id}")
+
+    def check(self, update_id: int, key: str | None) -> str | None:
+        """Запомнить апдейт; если он уже был — вернуть, по какому ключу (update_id / message)"""
+        if update_id in self._update_ids:
+            return "update_id"
+        if key is not None and key in self._message_keys:
+            return "message"
+        self._remember(update_id, key)
+        return None
+
+    def _remember(self, update_id: int, key: str | None) -> None:
+        self._update_ids[update_id] = None
+        if len(self._update_ids) > self.window:
+            self._update_ids.popitem(last=False)
+        if key is not None:
+            self._message_keys[key] = None
+            if len(self._message_keys) > self.window:
+                self._message_keys.popitem(last=False)
+
+    async def persist(self, update_id: int, key: str | None) -> None:
+        """Записать апдейт в кольцо (ошибки записи не мешают обработке)"""
+        slot = update_id % self.window
+        try:
+            async with session_maker() as session:
+                result = await session.execute(
+                    update(ProcessedUpdates)
+                    .where(ProcessedUpdates.slot == slot)
+                    .values(update_id=update_id, message_key=key)
+                )
+                if result.rowcount == 0:
+                    session.add(ProcessedUpdates(slot=slot, update_id=update_id, message_key=key))
+                try:
+                    await session.commit()
+                except IntegrityError:
+                    # Слот заняли параллельно — апдейт всё равно уже в окне в памяти
+                    await session.rollback()
+        except Exception as e:
+            logging.warning(f"Failed to persist update {update_id} to dedup ring: {e}")
+
+
+class DedupMiddleware(BaseMiddleware):
+    """Outer-middleware: повторный апдейт не доходит до хэндлеров"""
+
+    async def __call__(self, handler, event: Update, data):
+        if deduplicator.window <= 0:
+            return await handler(event, data)
+
+        key = message_key(event)
+        duplicate = deduplicator.check(event.update_id, key)
+        if duplicate:
+            DUPLICATE_UPDATES.labels(duplicate).inc()
+            logging.info(f"Dropped duplicate update {event.update_id} (by {duplicate})")
+            return None
+
+        await deduplicator.persist(event.update_id, key)
+        return await handler(event, data)
+
+
+deduplicator = UpdateDeduplicator()
@@ -0,0 +1,236 @@
+"""
+Оценка времени ответа ассистента по недавним запросам.
+
+Вместо зашитых «5-30 секунд» индикатор загрузки и /status показывают
+p50-p90 времени ответа для (ассистент, модель, тип входа). Источник — request_log:
+его пишут все процессы (бот, воркеры QUEUE_MODE), а бот раз в ETA_REFRESH_INTERVAL
+догоняет строки после своего водяного знака. На старте подхватываются
+запросы последних часов — оценка тёплая сразу после деплоя.
+
+Каждая тройка — LatencySketch: гистограмма с логарифмическими бакетами
+(0.1 с … 15 мин, шаг 10%) и экспоненциальным забыванием с полураспадом
+ETA_HALF_LIFE. Размер фиксирован и не зависит от числа запросов; троек —
+не больше, чем ассистентов × моделей × типов входа.
+Квантили публикуются как titan_eta_seconds{assistant, model, input, quantile}.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func
+
+from admission import admission
+from config import ETA_HALF_LIFE, ETA_MIN_SAMPLES, QUEUE_MODE
+from database import session_maker, RequestLog
+from metrics import ETA_SECONDS
+from openai_client_v2 import expected_model
+
+# Бакеты: от MIN_LATENCY до MAX_LATENCY секунд, каждый следующий в GAMMA раз шире
+MIN_LATENCY = 0.1
+MAX_LATENCY = 900.0
+GAMMA = 1.1
+BUCKETS = math.ceil(math.log(MAX_LATENCY / MIN_LATENCY) / math.log(GAMMA))
+
+# Какие квантили публиковать в метриках; диапазон ETA — p50-p90
+QUANTILES = (0.5, 0.9, 0.95)
+
+TEXT, PHOTO, DOCUMENT, DOCUMENT_LARGE = "text", "photo", "document", "document_large"
+# Документы больше этого размера анализируются заметно дольше
+LARGE_FILE = 1024 * 1024
+
+# Пока запросов мало — прежние оценки
+DEFAULT_ETA = {TEXT: (5, 30), PHOTO: (10, 60), DOCUMENT: (10, 60), DOCUMENT_LARGE: (10, 60)}
+
+# Строк request_log за один запрос к БД и глубина подгрузки на старте (в периодах полураспада)
+REFRESH_BATCH = 5000
+WARMUP_HALF_LIVES = 4
+
+
+def input_type(kind: str, is_photo: bool = False, file_size: int = 0) -> str:
+    if kind == "text":
+        return TEXT
+    if is_photo:
+        return PHOTO
+    return DOCUMENT_LARGE if file_size >= LARGE_FILE else DOCUMENT
+
+
+def _bucket(seconds: float) -> int:
+    if seconds <= MIN_LATENCY:
+        return 0
+    return min(BUCKETS - 1, int(math.log(seconds / MIN_LATENCY) / math.log(GAMMA)))
+
+
+class LatencySketch:
+    """Гистограмма задержек фиксированного размера, старые замеры со временем теряют вес"""
+
+    def __init__(self, half_life: float = ETA_HALF_LIFE):
+        self.half_life = half_life
+        self.counts = [0.0] * BUCKETS
+        self.total = 0.0
+        self._decayed_at = time.monotonic()
+
+    def _decay(self) -> None:
+        now = time.monotonic()
+        factor = 0.5 ** ((now - self._decayed_at) / self.half_life)
+        self._decayed_at = now
+        if factor < 1.0:
+            self.counts = [count * factor for count in self.counts]
+            self.total *= factor
+
+    def add(self, seconds: float, age: float = 0.0) -> None:
+        """Учесть замер; age — сколько секунд назад он сделан"""
+        self._decay()
+        weight = 0.5 ** (max(age, 0.0) / self.half_life)
+        self.counts[_bucket(seconds)] += weight
+        self.total += weight
+
+    def merge(self, other: LatencySketch) -> None:
+        self._decay()
+        other._decay()
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    def weight(self) -> float:
+        """Сколько «свежих» замеров в гистограмме"""
+        self._decay()
+        return self.total
+
+    def quantile(self, q: float) -> float | None:
+        self._decay()
+        if self.total <= 0:
+            return None
+        rank = q * self.total
+        seen = 0.0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        # Середина бакета (в логарифмической шкале)
+        return MIN_LATENCY * GAMMA ** (i + 0.5)
+
+
+class LatencyEstimator:
+    """Гистограммы по (ассистент, модель, тип входа), которые догоняют request_log"""
+
+    def __init__(self, half_life: float = ETA_HALF_LIFE, min_samples: int = ETA_MIN_SAMPLES):
+        self.half_life = half_life
+        self.min_samples = min_samples
+        self._sketches: dict[tuple[str, str, str], LatencySketch] = {}
+        self._last_id: int | None = None
+
+    def record(self, assistant_id: str, model: str, input_type: str, seconds: float, age: float = 0.0) -> None:
+        key = (assistant_id, model, input_type)
+        if key not in self._sketches:
+            self._sketches[key] = LatencySketch(self.half_life)
+        self._sketches[key].add(seconds, age)
+
+    def estimate(self, assistant_id: str, model: str, input_type: str) -> tuple[float, float] | None:
+        """(p50, p90) в секундах; мало данных по модели — по всем моделям ассистента; совсем мало — None"""
+        sketch = self._sketches.get((assistant_id, model, input_type))
+        if sketch is None or sketch.weight() < self.min_samples:
+            sketch = LatencySketch(self.half_life)
+            for (a, _, kind), other in self._sketches.items():
+                if a == assistant_id and kind == input_type:
+                    sketch.merge(other)
+            if sketch.weight() < self.min_samples:
+                return None
+        return sketch.quantile(0.5), sketch.quantile(0.9)
+
+    def export(self) -> None:
+        for (assistant_id, model, kind), sketch in self._sketches.items():
+            for q in QUANTILES:
+                value = sketch.quantile(q)
+                if value is not None:
+                    ETA_SECONDS.labels(assistant_id, model, kind, str(q)).set(value)
+
+    async def refresh(self) -> int:
+        """
+        Учесть новые строки request_log. Строку, закоммиченную позже строки
+        с большим id, пропустим — для оценки это не важно.
+        """
+        now = datetime.now()
+        query = select(RequestLog).where(
+            RequestLog.status.in_(("ok", "timeout")),
+            RequestLog.input_type.is_not(None),  # нет у неудачных отправок background-задач
+            RequestLog.latency_ms.is_not(None),
+            RequestLog.model.is_not(None)
+        )
+        if self._last_id is None:
+            query = query.where(RequestLog.created_at >= now - timedelta(seconds=self.half_life * WARMUP_HALF_LIVES))
+
+        added = 0
+        async with session_maker() as session:
+            while True:
+                result = await session.execute(
+                    query.where(RequestLog.id > (self._last_id or 0)).order_by(RequestLog.id).limit(REFRESH_BATCH)
+                )
+                rows = result.scalars().all()
+                for row in rows:
+                    age = (now - row.created_at).total_seconds()
+                    self.record(row.assistant_id, row.model, row.input_type, row.latency_ms / 1000, age)
+                if rows:
+                    self._last_id = rows[-1].id
+                added += len(rows)
+                if len(rows) < REFRESH_BATCH:
+                    break
+
+            if self._last_id is None:
+                # Свежих запросов нет — дальше читаем после последней строки журнала
+                self._last_id = (await session.execute(select(func.max(RequestLog.id)))).scalar_one() or 0
+        return added
+
+    async def run(self, interval: float) -> None:
+        """Фоновое обновление оценок и метрик"""
+        while True:
+            try:
+                await self.refresh()
+                self.export()
+            except Exception as e:
+                logging.warning(f"ETA refresh failed: {e}")
+            await asyncio.sleep(interval)
+
+
+def _plural(n: int, forms: tuple[str, str, str]) -> str:
+    if 11 <= n % 100 <= 14:
+        return forms[2]
+    if n % 10 == 1:
+        return forms[0]
+    if 2 <= n % 10 <= 4:
+        return forms[1]
+    return forms[2]
+
+
+def format_eta(low: float, high: float) -> str:
+    """«8-25 секунд», «10 секунд», «2-4 минуты»"""
+    if high < 90:
+        low, high = max(1, round(low)), max(1, round(high))
+        unit = _plural(high, ("секунду", "секунды", "секунд"))
+    else:
+        low, high = max(1, round(low / 60)), max(1, math.ceil(high / 60))
+        unit = _plural(high, ("минуту", "минуты", "минут"))
+    if low >= high:
+        return f"{high} {unit}"
+    return f"{low}-{high} {unit}"
+
+
+def expected_wait(assistant_id: str, kind: str) -> tuple[float, float, bool]:
+    """(от, до) в секундах с учётом очереди; False — данных мало и это прежняя оценка"""
+    estimate = estimator.estimate(assistant_id, expected_model(assistant_id), kind)
+    low, high = estimate or DEFAULT_ETA[kind]
+    if QUEUE_MODE:
+        # Задача сначала ждёт свободного воркера
+        wait = admission.queue_wait()
+        low, high = low + wait, high + wait
+    return low, high, estimate is not None
+
+
+def eta_text(assistant_id: str, kind: str) -> str:
+    """Строка для индикатора загрузки"""
+    low, high, live = expected_wait(assistant_id, kind)
+    return f"{'Сейчас' if live else 'Обычно'} это занимает {format_eta(low, high)}"
+
+
+estimator = LatencyEstimator()
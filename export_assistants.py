@@ -2,18 +2,72 @@
 Скрипт для выгрузки инструкций всех ассистентов из OpenAI.
 Запустить ОДИН РАЗ для сохранения данных перед миграцией.
 
+Ассистенты читаются постраничным списком (одним-двумя запросами вместо
+запроса на каждого; страницы перестают читаться, когда найдены все нужные),
+недостающие — параллельным retrieve. При повторном запуске ассистент, у которого
+created_at, хэш metadata и содержимого совпадают с прошлым бэкапом, берётся
+из бэкапа целиком; retrieve — только для тех, кого нет в списке.
+
 Использование:
     python export_assistants.py
 """
 import asyncio
+import hashlib
 import json
 from datetime import datetime
 from openai import AsyncOpenAI
 from config import OPENAI_API_KEY
 from keyboards import ASSISTANTS
+from export_common import Progress, gather_bounded, load_previous_backup, save_backup
 
 client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
+BACKUP_PREFIX = "assistants_backup"
+
+
+def content_hash(data: dict) -> str:
+    """Хэш содержимого ассистента (без служебных полей)"""
+    payload = {k: data.get(k) for k in ("name", "model", "instructions", "tools", "metadata")}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def metadata_hash(metadata: dict | None) -> str:
+    return hashlib.sha256(json.dumps(metadata or {}, sort_keys=True).encode()).hexdigest()
+
+
+def unchanged(assistant, prev: dict | None) -> bool:
+    """Ассистент из списка совпадает с записью прошлого бэкапа"""
+    if prev is None or prev.get("created_at") != assistant.created_at:
+        return False
+    if prev.get("metadata_hash") != metadata_hash(assistant.metadata):
+        return False
+    # Инструкции правят, не трогая metadata, — сверяем и содержимое (оно уже есть в списке)
+    return prev.get("content_hash") == content_hash({
+        "name": assistant.name,
+        "model": assistant.model,
+        "instructions": assistant.instructions,
+        "tools": [tool.model_dump() for tool in assistant.tools] if assistant.tools else [],
+        "metadata": assistant.metadata,
+    })
+
+
+async def list_assistants(wanted: set[str]) -> dict:
+    """Нужные ассистенты из постраничного списка; страницы читаются, пока не найдены все"""
+    found = {}
+    async for assistant in client.beta.assistants.list(limit=100):
+        if assistant.id in wanted:
+            found[assistant.id] = assistant
+            if len(found) == len(wanted):
+                break
+    return found
+
+
+async def retrieve_assistant(assistant_id: str):
+    try:
+        return await client.beta.assistants.retrieve(assistant_id)
+    except Exception as e:
+        return e
+
 
 async def export_all_assistants():
     """Выгружает все ассистенты и сохраняет в JSON"""
@@ -22,53 +76,79 @@ async def export_all_assistants():
     print("ЭКСПОРТ АССИСТЕНТОВ ИЗ OPENAI")
     print("=" * 60)
 
-    exported = []
+    previous = {item["id"]: item for item in load_previous_backup(BACKUP_PREFIX) or [] if "error" not in item}
 
-    for assistant_id, local_data in ASSISTANTS.items():
-        print(f"\n📥 Загружаю: {local_data['emoji']} {local_data['title']}...")
-
-        try:
-            # Получаем полные данные ассистента из OpenAI
-            assistant = await client.beta.assistants.retrieve(assistant_id)
-
-            data = {
-                "id": assistant.id,
-                "name": assistant.name,
-                "model": assistant.model,
-                "instructions": assistant.instructions,
-                "tools": [tool.model_dump() for tool in assistant.tools] if assistant.tools else [],
-                "metadata": assistant.metadata,
-                "local_title": local_data["title"],
-                "local_emoji": local_data["emoji"],
-                "local_desc": local_data["desc"],
-                "exported_at": datetime.now().isoformat()
-            }
+    # Ассистенты организации — постранично, до последнего нужного
+    print("\n📥 Загружаю список ассистентов...")
+    try:
+        found = await list_assistants(set(ASSISTANTS))
+    except Exception as e:
+        print(f"   ⚠️ Не удалось получить список: {e}")
+        found = {}
 
-            exported.append(data)
+    # Тех, кого нет в списке, запрашиваем параллельно
+    missing = [asst_id for asst_id in ASSISTANTS if asst_id not in found]
+    if missing:
+        progress = Progress("ассистент", len(missing))
+        retrieved = await gather_bounded(missing, retrieve_assistant, progress=progress)
+        found.update(zip(missing, retrieved))
 
-            print(f"   ✅ Модель: {assistant.model}")
-            print(f"   ✅ Инструкции: {len(assistant.instructions or '')} символов")
-            print(f"   ✅ Инструменты: {len(assistant.tools or [])} шт")
+    exported = []
+    changed = 0
 
-        except Exception as e:
-            print(f"   ❌ Ошибка: {e}")
+    for assistant_id, local_data in ASSISTANTS.items():
+        print(f"\n📥 {local_data['emoji']} {local_data['title']}...")
+        assistant = found[assistant_id]
+
+        prev = previous.get(assistant_id)
+        if not isinstance(assistant, Exception) and unchanged(assistant, prev):
+            # Локальные названия берутся из keyboards.py — их могли поменять
+            exported.append({**prev, "local_title": local_data["title"], "local_emoji": local_data["emoji"],
+                             "local_desc": local_data["desc"]})
+            print("   ⏭️ Без изменений с прошлого бэкапа")
+            continue
+
+        if isinstance(assistant, Exception):
+            print(f"   ❌ Ошибка: {assistant}")
             exported.append({
                 "id": assistant_id,
-                "error": str(e),
+                "error": str(assistant),
                 "local_title": local_data["title"],
                 "local_emoji": local_data["emoji"],
                 "exported_at": datetime.now().isoformat()
             })
+            continue
+
+        data = {
+            "id": assistant.id,
+            "name": assistant.name,
+            "model": assistant.model,
+            "instructions": assistant.instructions,
+            "tools": [tool.model_dump() for tool in assistant.tools] if assistant.tools else [],
+            "metadata": assistant.metadata,
+            "created_at": assistant.created_at,
+            "metadata_hash": metadata_hash(assistant.metadata),
+            "local_title": local_data["title"],
+            "local_emoji": local_data["emoji"],
+            "local_desc": local_data["desc"],
+            "exported_at": datetime.now().isoformat()
+        }
+        data["content_hash"] = content_hash(data)
+
+        changed += 1
+        print(f"   ✅ Модель: {assistant.model}")
+        print(f"   ✅ Инструкции: {len(assistant.instructions or '')} символов")
+        print(f"   ✅ Инструменты: {len(assistant.tools or [])} шт")
+
+        exported.append(data)
 
     # Сохраняем в файл
-    filename = f"assistants_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(exported, f, ensure_ascii=False, indent=2)
+    filename = save_backup(BACKUP_PREFIX, exported)
 
     print("\n" + "=" * 60)
     print(f"✅ ЭКСПОРТ ЗАВЕРШЁН")
     print(f"📁 Файл: {filename}")
+    print(f"🔄 Изменилось: {changed} из {len(exported)}")
     print("=" * 60)
 
     # Также выводим инструкции в консоль для удобства
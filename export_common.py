@@ -0,0 +1,78 @@
+"""
+Общий движок для скриптов выгрузки (export_assistants.py, export_vector_stores.py).
+
+- параллельные запросы с ограничением конкурентности;
+- полная пагинация списков OpenAI;
+- прогресс в консоли;
+- инкрементальность: чтение предыдущего бэкапа, чтобы не запрашивать то, что не менялось.
+"""
+from __future__ import annotations
+import asyncio
+import glob
+import json
+from datetime import datetime
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable, TypeVar
+
+from config import EXPORT_CONCURRENCY
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class Progress:
+    """Простой счётчик прогресса для консоли"""
+
+    def __init__(self, title: str, total: int):
+        self.title = title
+        self.total = total
+        self.done = 0
+
+    def step(self, label: str = "") -> None:
+        self.done += 1
+        suffix = f" {label}" if label else ""
+        print(f"      [{self.done}/{self.total}] {self.title}{suffix}")
+
+
+async def gather_bounded(
+    items: Iterable[T],
+    fn: Callable[[T], Awaitable[R]],
+    limit: int = EXPORT_CONCURRENCY,
+    progress: Progress | None = None,
+    label: Callable[[T, R], str] | None = None
+) -> list[R]:
+    """asyncio.gather по items не более чем с limit одновременными вызовами fn"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(item: T) -> R:
+        async with semaphore:
+            result = await fn(item)
+        if progress:
+            progress.step(label(item, result) if label else "")
+        return result
+
+    return await asyncio.gather(*(run(item) for item in items))
+
+
+async def collect_pages(pages: AsyncIterable[T]) -> list[T]:
+    """Собрать все элементы со всех страниц (AsyncPaginator сам ходит по cursor)"""
+    return [item async for item in pages]
+
+
+def load_previous_backup(prefix: str) -> Any | None:
+    """Загрузить последний бэкап вида {prefix}_YYYYmmdd_HHMMSS.json"""
+    files = sorted(glob.glob(f"{prefix}_*.json"))
+    if not files:
+        return None
+
+    with open(files[-1], encoding="utf-8") as f:
+        data = json.load(f)
+    print(f"📂 Предыдущий бэкап: {files[-1]}")
+    return data
+
+
+def save_backup(prefix: str, data: Any) -> str:
+    """Сохранить бэкап и вернуть имя файла"""
+    filename = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    return filename
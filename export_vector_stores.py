@@ -1,14 +1,19 @@
 """
 Скрипт для выгрузки информации о Vector Stores ассистентов.
+
+Список файлов читается целиком (все страницы), детали файлов запрашиваются
+параллельно. При повторном запуске детали берутся из предыдущего бэкапа,
+запрашиваются только новые файлы.
 """
 import asyncio
-import json
-from datetime import datetime
 from openai import AsyncOpenAI
 from config import OPENAI_API_KEY
+from export_common import Progress, gather_bounded, collect_pages, load_previous_backup, save_backup
 
 client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
+BACKUP_PREFIX = "vector_stores_backup"
+
 # Ассистенты с file_search
 ASSISTANTS_WITH_RAG = {
     "asst_QfzzLwaL8JHcve4Y80IVKq9E": "Ящик Пандоры",
@@ -16,82 +21,120 @@ ASSISTANTS_WITH_RAG = {
 }
 
 
+def previous_files_index(previous: list | None) -> dict[str, dict]:
+    """file_id -> данные файла из прошлого бэкапа (без записей с ошибками)"""
+    index = {}
+    for vs in previous or []:
+        for f in vs.get("files", []):
+            if "error" not in f:
+                index[f["id"]] = f
+    return index
+
+
+async def fetch_file(vs_file) -> dict:
+    """Получить детали файла"""
+    try:
+        file_obj = await client.files.retrieve(vs_file.id)
+        return {
+            "id": vs_file.id,
+            "filename": file_obj.filename,
+            "bytes": file_obj.bytes,
+            "created_at": file_obj.created_at,
+            "status": vs_file.status
+        }
+    except Exception as e:
+        return {
+            "id": vs_file.id,
+            "error": str(e)
+        }
+
+
+async def export_vector_store(assistant_id: str, name: str, vs_id: str, known_files: dict) -> dict | None:
+    """Выгрузить один Vector Store со всеми файлами"""
+    try:
+        vs = await client.vector_stores.retrieve(vs_id)
+    except Exception as e:
+        print(f"   ❌ Ошибка получения VS {vs_id}: {e}")
+        return None
+
+    print(f"\n   📁 Vector Store: {vs.name or vs_id}")
+    print(f"      ID: {vs.id}")
+    print(f"      Файлов: {vs.file_counts.completed}")
+    print(f"      Статус: {vs.status}")
+
+    # Все страницы списка файлов (по 100 на страницу)
+    vs_files = await collect_pages(client.vector_stores.files.list(vs_id, limit=100))
+
+    cached = {f.id: {**known_files[f.id], "status": f.status} for f in vs_files if f.id in known_files}
+    new_files = [f for f in vs_files if f.id not in known_files]
+    print(f"      Из прошлого бэкапа: {len(cached)}, новых: {len(new_files)}")
+
+    progress = Progress("файл", len(new_files))
+    fetched = await gather_bounded(
+        new_files,
+        fetch_file,
+        progress=progress,
+        label=lambda f, info: info.get("filename") or f"{f.id} (ошибка: {info.get('error')})"
+    )
+    fetched_by_id = {info["id"]: info for info in fetched}
+
+    # Сохраняем порядок, в котором файлы отдаёт API
+    files_info = [cached.get(f.id) or fetched_by_id[f.id] for f in vs_files]
+
+    return {
+        "assistant_id": assistant_id,
+        "assistant_name": name,
+        "vector_store_id": vs.id,
+        "vector_store_name": vs.name,
+        "file_count": vs.file_counts.completed,
+        "status": vs.status,
+        "files": files_info
+    }
+
+
+async def get_vector_store_ids(assistant_id: str, name: str) -> list[str]:
+    """Vector Store IDs из tool_resources ассистента"""
+    print(f"\n📦 Проверяю: {name}...")
+
+    try:
+        assistant = await client.beta.assistants.retrieve(assistant_id)
+    except Exception as e:
+        print(f"   ❌ Ошибка: {e}")
+        return []
+
+    if not assistant.tool_resources:
+        print("   ⚠️ Нет tool_resources")
+        return []
+
+    file_search = assistant.tool_resources.file_search
+    if not file_search or not file_search.vector_store_ids:
+        print("   ⚠️ Нет Vector Stores")
+        return []
+
+    print(f"   ✅ Найдены Vector Stores: {file_search.vector_store_ids}")
+    return file_search.vector_store_ids
+
+
 async def export_vector_stores():
     print("=" * 60)
     print("ЭКСПОРТ VECTOR STORES")
     print("=" * 60)
 
-    all_data = []
+    known_files = previous_files_index(load_previous_backup(BACKUP_PREFIX))
+
+    # Ассистенты — параллельно
+    items = list(ASSISTANTS_WITH_RAG.items())
+    vs_ids = await gather_bounded(items, lambda item: get_vector_store_ids(*item))
 
-    for assistant_id, name in ASSISTANTS_WITH_RAG.items():
-        print(f"\n📦 Проверяю: {name}...")
-
-        try:
-            # Получаем ассистента
-            assistant = await client.beta.assistants.retrieve(assistant_id)
-
-            # Проверяем tool_resources
-            if assistant.tool_resources:
-                file_search = assistant.tool_resources.file_search
-                if file_search and file_search.vector_store_ids:
-                    print(f"   ✅ Найдены Vector Stores: {file_search.vector_store_ids}")
-
-                    for vs_id in file_search.vector_store_ids:
-                        # Получаем информацию о Vector Store
-                        try:
-                            vs = await client.vector_stores.retrieve(vs_id)
-                            print(f"\n   📁 Vector Store: {vs.name or vs_id}")
-                            print(f"      ID: {vs.id}")
-                            print(f"      Файлов: {vs.file_counts.completed}")
-                            print(f"      Статус: {vs.status}")
-
-                            # Получаем список файлов
-                            files_list = await client.vector_stores.files.list(vs_id)
-                            files_info = []
-
-                            for f in files_list.data:
-                                try:
-                                    # Получаем детали файла
-                                    file_obj = await client.files.retrieve(f.id)
-                                    files_info.append({
-                                        "id": f.id,
-                                        "filename": file_obj.filename,
-                                        "bytes": file_obj.bytes,
-                                        "created_at": file_obj.created_at,
-                                        "status": f.status
-                                    })
-                                    print(f"      - {file_obj.filename} ({file_obj.bytes} bytes)")
-                                except Exception as e:
-                                    files_info.append({
-                                        "id": f.id,
-                                        "error": str(e)
-                                    })
-                                    print(f"      - {f.id} (ошибка: {e})")
-
-                            all_data.append({
-                                "assistant_id": assistant_id,
-                                "assistant_name": name,
-                                "vector_store_id": vs.id,
-                                "vector_store_name": vs.name,
-                                "file_count": vs.file_counts.completed,
-                                "status": vs.status,
-                                "files": files_info
-                            })
-
-                        except Exception as e:
-                            print(f"   ❌ Ошибка получения VS {vs_id}: {e}")
-                else:
-                    print(f"   ⚠️ Нет Vector Stores")
-            else:
-                print(f"   ⚠️ Нет tool_resources")
-
-        except Exception as e:
-            print(f"   ❌ Ошибка: {e}")
+    all_data = []
+    for (assistant_id, name), ids in zip(items, vs_ids):
+        for vs_id in ids:
+            data = await export_vector_store(assistant_id, name, vs_id, known_files)
+            if data:
+                all_data.append(data)
 
     # Сохраняем
-    filename = f"vector_stores_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(all_data, f, ensure_ascii=False, indent=2, default=str)
+    filename = save_backup(BACKUP_PREFIX, all_data)
 
     print("\n" + "=" * 60)
     print(f"✅ ЭКСПОРТ ЗАВЕРШЁН: {filename}")
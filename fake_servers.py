@@ -0,0 +1,279 @@
+"""
+Локальные заглушки Telegram Bot API и OpenAI Responses API для нагрузочных тестов.
+
+Bot API:    /bot<token>/<method>  (sendMessage, getChatMember, deleteMessage, ...)
+Responses:  /v1/responses, /v1/responses/<id>, /v1/files
+
+Бот направляется на заглушки через TELEGRAM_API_URL и OPENAI_BASE_URL.
+Задержка ответа OpenAI — логнормальная с медианой --latency, доля ошибок 500 — --error-rate.
+code_interpreter с {"type": "auto"} создаёт новый контейнер (+ --container-cold-start секунд),
+с id контейнера — переиспользует его без задержки. Запрос с file_search — +--file-search-latency
+(это входной параметр, а не замер: реальную цену file_search показывают
+titan_openai_file_search_duration_seconds и bench_retrieval.py --responses).
+max_output_tokens ограничивает output_tokens и укорачивает генерацию (70% задержки — пропорционально
+длине ответа). Деградация OpenAI: с --slow-start секунды от запуска в течение --slow-duration
+задержка умножается на --slow-factor (проверка контроля допуска, admission.py).
+
+Запуск отдельно:
+    python fake_servers.py --telegram-port 8081 --openai-port 8082 --latency 1.5
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+from aiohttp import web
+
+
+@dataclass
+class StubConfig:
+    latency: float = 1.0          # медиана задержки OpenAI, секунды
+    latency_sigma: float = 0.5    # разброс (sigma логнормального распределения)
+    error_rate: float = 0.0       # доля ответов 500
+    input_tokens: int = 1500
+    output_tokens: int = 400
+    seed: int | None = None       # фиксированный seed — воспроизводимые задержки и ошибки
+    container_cold_start: float = 0.0  # задержка создания нового контейнера code_interpreter
+    file_search_latency: float = 0.0   # дополнительная задержка запросов с file_search
+    slow_start: float = 0.0       # через сколько секунд после запуска OpenAI «тормозит»
+    slow_duration: float = 0.0    # сколько секунд длится деградация (0 — не тормозит)
+    slow_factor: float = 1.0      # во сколько раз растёт задержка во время деградации
+
+
+# ======================================================
+#                   TELEGRAM BOT API
+# ======================================================
+def build_telegram_app() -> web.Application:
+    message_ids = itertools.count(1_000_000)
+    calls: Counter = Counter()
+
+    def message(chat_id, text: str = "") -> dict:
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text,
+        }
+
+    async def handle(request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        calls[method] += 1
+
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+
+        if method in ("sendMessage", "editMessageText"):
+            result = message(int(params.get("chat_id", 0)), params.get("text", ""))
+        elif method == "getChatMember":
+            result = {
+                "status": "member",
+                "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "Load"},
+            }
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif method == "getFile":
+            result = {"file_id": params.get("file_id"), "file_unique_id": "u", "file_path": "documents/file.txt"}
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def download(request: web.Request) -> web.Response:
+        calls["download"] += 1
+        return web.Response(body=b"fake file content\n")
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(dict(calls))
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    app.router.add_get("/file/bot{token}/{path:.*}", download)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+# ======================================================
+#                   OPENAI RESPONSES API
+# ======================================================
+def build_openai_app(config: StubConfig) -> web.Application:
+    response_ids = itertools.count(1)
+    calls: Counter = Counter()
+    responses: dict[str, dict] = {}
+    rng = random.Random(config.seed)
+
+    container_ids = itertools.count(1)
+    started = time.monotonic()
+
+    def code_interpreter_call(container_id: str) -> dict:
+        return {
+            "type": "code_interpreter_call",
+            "id": f"ci_{container_id}_{next(response_ids)}",
+            "code": "print(1)",
+            "container_id": container_id,
+            "outputs": [],
+            "status": "completed",
+        }
+
+    def make_response(model: str, container_id: str | None = None, output_tokens: int | None = None) -> dict:
+        response_id = f"resp_fake_{next(response_ids)}"
+        calls_output = [code_interpreter_call(container_id)] if container_id else []
+        return {
+            "id": response_id,
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": model,
+            "status": "completed",
+            "output": calls_output + [{
+                "type": "message",
+                "id": f"msg_{response_id}",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": "Тестовый ответ ассистента.", "annotations": []}],
+            }],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": {
+                "input_tokens": config.input_tokens,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": config.input_tokens + output_tokens,
+            },
+        }
+
+    def server_error() -> web.Response:
+        return web.json_response(
+            {"error": {"message": "Stub error", "type": "server_error", "code": None, "param": None}},
+            status=500
+        )
+
+    async def create(request: web.Request) -> web.Response:
+        calls["responses.create"] += 1
+        body = await request.json()
+        model = body.get("model", "gpt-4.1-mini")
+        calls[f"model:{model}"] += 1
+
+        output_tokens = config.output_tokens
+        if body.get("max_output_tokens"):
+            calls["max_output_tokens"] += 1
+            output_tokens = min(output_tokens, body["max_output_tokens"])
+        delay = rng.lognormvariate(0, config.latency_sigma) * config.latency
+        delay *= 0.3 + 0.7 * output_tokens / max(config.output_tokens, 1)
+        if config.slow_start <= time.monotonic() - started < config.slow_start + config.slow_duration:
+            delay *= config.slow_factor
+        await asyncio.sleep(delay)
+        if rng.random() < config.error_rate:
+            calls["errors"] += 1
+            return server_error()
+
+        container_id = None
+        for tool in body.get("tools") or []:
+            if tool.get("type") == "file_search":
+                calls["file_search"] += 1
+                await asyncio.sleep(config.file_search_latency)
+            if tool.get("type") != "code_interpreter":
+                continue
+            if isinstance(tool.get("container"), str):
+                calls["containers.reused"] += 1
+                container_id = tool["container"]
+            else:
+                calls["containers.created"] += 1
+                container_id = f"cntr_fake_{next(container_ids)}"
+                await asyncio.sleep(config.container_cold_start)
+
+        data = make_response(model, container_id, output_tokens)
+        responses[data["id"]] = data
+        return web.json_response(data)
+
+    async def retrieve(request: web.Request) -> web.Response:
+        calls["responses.retrieve"] += 1
+        data = responses.get(request.match_info["response_id"])
+        if data is None:
+            return web.json_response({"error": {"message": "Not found", "type": "invalid_request_error"}}, status=404)
+        return web.json_response(data)
+
+    async def upload(request: web.Request) -> web.Response:
+        calls["files.create"] += 1
+        await request.read()
+        return web.json_response({
+            "id": f"file_fake_{next(response_ids)}", "object": "file", "bytes": 0,
+            "created_at": int(time.time()), "filename": "file.txt", "purpose": "assistants", "status": "processed",
+        })
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(dict(calls))
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/v1/responses", create)
+    app.router.add_get("/v1/responses/{response_id}", retrieve)
+    app.router.add_post("/v1/files", upload)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+async def serve(telegram_port: int, openai_port: int, config: StubConfig, ready=None) -> None:
+    runners = []
+    for app, port in ((build_telegram_app(), telegram_port), (build_openai_app(config), openai_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        runners.append(runner)
+
+    if ready is not None:
+        ready.set()
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def run(telegram_port: int, openai_port: int, config: StubConfig, ready=None) -> None:
+    """Точка входа для отдельного процесса"""
+    asyncio.run(serve(telegram_port, openai_port, config, ready))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Заглушки Telegram Bot API и OpenAI")
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--openai-port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--input-tokens", type=int, default=1500)
+    parser.add_argument("--output-tokens", type=int, default=400)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--container-cold-start", type=float, default=0.0)
+    parser.add_argument("--file-search-latency", type=float, default=0.0)
+    parser.add_argument("--slow-start", type=float, default=0.0)
+    parser.add_argument("--slow-duration", type=float, default=0.0)
+    parser.add_argument("--slow-factor", type=float, default=1.0)
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        input_tokens=args.input_tokens,
+        output_tokens=args.output_tokens,
+        seed=args.seed,
+        container_cold_start=args.container_cold_start,
+        file_search_latency=args.file_search_latency,
+        slow_start=args.slow_start,
+        slow_duration=args.slow_duration,
+        slow_factor=args.slow_factor
+    )
+    print(f"Telegram: http://127.0.0.1:{args.telegram_port}, OpenAI: http://127.0.0.1:{args.openai_port}/v1")
+    print(json.dumps(config.__dict__))
+    run(args.telegram_port, args.openai_port, config)
+
+
+if __name__ == "__main__":
+    main()
@@ -84,6 +84,19 @@ def build_assistant_selection_keyboard():
     return kb.as_markup()
 
 
+def build_broadcast_keyboard(broadcast_id: int, running: bool = False):
+    """Подтверждение рассылки администратором / остановка идущей"""
+    kb = InlineKeyboardBuilder()
+    if running:
+        kb.button(text="⛔ Остановить", callback_data=f"broadcast_cancel:{broadcast_id}")
+        return kb.as_markup()
+
+    kb.button(text="✅ Отправить", callback_data=f"broadcast_start:{broadcast_id}")
+    kb.button(text="❌ Отмена", callback_data=f"broadcast_cancel:{broadcast_id}")
+    kb.adjust(2)
+    return kb.as_markup()
+
+
 def build_loading_keyboard():
     """Клавиатура при загрузке (без кнопок)"""
     return None
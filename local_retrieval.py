@@ -0,0 +1,367 @@
+"""
+Локальный гибридный поиск по базе знаний (BM25 + эмбеддинги на NumPy).
+
+Используется вместо hosted file_search или как фильтр перед ним
+(LOCAL_RETRIEVAL_MODE = prefilter / replace). Если релевантность найденных
+фрагментов ниже порога — поиск по базе знаний для этого сообщения пропускается.
+
+Индекс хранится на диске в LOCAL_RETRIEVAL_DIR/<assistant_id>/ в виде .npy файлов,
+которые открываются через mmap — старт бота не зависит от размера базы.
+
+Сборка индекса из локальной папки (той же, что для sync_vector_store.py):
+    python local_retrieval.py build --assistant asst_QfzzLwaL8JHcve4Y80IVKq9E --dir knowledge/pandora
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import html
+import json
+import logging
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+import numpy as np
+from openai import AsyncOpenAI
+
+from config import (
+    OPENAI_API_KEY, LOCAL_RETRIEVAL_DIR, LOCAL_RETRIEVAL_TOP_K,
+    LOCAL_RETRIEVAL_MIN_SIMILARITY, LOCAL_RETRIEVAL_MIN_BM25, EMBEDDING_MODEL
+)
+
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Размер фрагмента и перекрытие (символы)
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Константа Reciprocal Rank Fusion
+RRF_K = 60
+
+TEXT_EXTENSIONS = {".txt", ".md", ".csv", ".json", ".html", ".htm"}
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def tokenize(text: str) -> list[str]:
+    """Токены в нижнем регистре; длинные слова обрезаются до 6 символов (грубый стемминг для русского)"""
+    return [t[:6] for t in _TOKEN_RE.findall(text.lower()) if len(t) > 1]
+
+
+@dataclass
+class Chunk:
+    text: str
+    source: str
+    score: float
+
+
+@dataclass
+class RetrievalResult:
+    chunks: list[Chunk]
+    relevant: bool
+    top_similarity: float | None
+    top_bm25: float
+    latency: float
+
+
+class RetrievalIndex:
+    """Индекс одного ассистента, открытый с диска через mmap"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "vocab.json"), encoding="utf-8") as f:
+            self.vocab: dict[str, int] = json.load(f)
+
+        def load(name: str):
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        self.indptr = load("postings_indptr.npy")
+        self.postings_docs = load("postings_docs.npy")
+        self.postings_tf = load("postings_tf.npy")
+        self.doc_len = load("doc_len.npy")
+        self.text_offsets = load("text_offsets.npy")
+        self.source_ids = load("source_ids.npy")
+        self.sources: list[str] = self.meta["sources"]
+
+        emb_path = os.path.join(path, "embeddings.npy")
+        self.embeddings = np.load(emb_path, mmap_mode="r") if os.path.exists(emb_path) else None
+
+        self.n_docs = int(self.meta["chunks"])
+        self.avg_len = float(self.meta["avg_len"])
+        self._texts = open(os.path.join(path, "texts.bin"), "rb")
+
+    def text(self, doc: int) -> str:
+        start, end = int(self.text_offsets[doc]), int(self.text_offsets[doc + 1])
+        self._texts.seek(start)
+        return self._texts.read(end - start).decode("utf-8")
+
+    def bm25(self, query: str) -> np.ndarray:
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocab.get(term)
+            if term_id is None:
+                continue
+            start, end = int(self.indptr[term_id]), int(self.indptr[term_id + 1])
+            docs = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end]
+            df = end - start
+            idf = math.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[docs] / self.avg_len)
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    def search(self, query: str, query_embedding: np.ndarray | None, top_k: int) -> tuple[list[Chunk], float | None, float]:
+        """Гибридный поиск: ранги BM25 и косинусной близости объединяются через RRF"""
+        bm25 = self.bm25(query)
+        candidates = min(self.n_docs, top_k * 10)
+
+        fused: dict[int, float] = {}
+        bm25_top = np.argsort(-bm25)[:candidates]
+        for rank, doc in enumerate(bm25_top):
+            if bm25[doc] > 0:
+                fused[int(doc)] = fused.get(int(doc), 0.0) + 1 / (RRF_K + rank)
+
+        top_similarity = None
+        similarity = None
+        if self.embeddings is not None and query_embedding is not None:
+            similarity = self.embeddings @ query_embedding
+            dense_top = np.argsort(-similarity)[:candidates]
+            top_similarity = float(similarity[dense_top[0]]) if len(dense_top) else None
+            for rank, doc in enumerate(dense_top):
+                fused[int(doc)] = fused.get(int(doc), 0.0) + 1 / (RRF_K + rank)
+
+        ranked = sorted(fused.items(), key=lambda item: -item[1])[:top_k]
+        chunks = [
+            Chunk(self.text(doc), self.sources[int(self.source_ids[doc])], score)
+            for doc, score in ranked
+        ]
+        top_bm25 = float(bm25.max()) if self.n_docs else 0.0
+        return chunks, top_similarity, top_bm25
+
+
+_indexes: dict[str, RetrievalIndex | None] = {}
+
+
+def get_index(assistant_id: str) -> RetrievalIndex | None:
+    """Индекс ассистента (открывается один раз) или None, если не собран"""
+    if assistant_id not in _indexes:
+        path = os.path.join(LOCAL_RETRIEVAL_DIR, assistant_id)
+        try:
+            _indexes[assistant_id] = RetrievalIndex(path) if os.path.exists(os.path.join(path, "meta.json")) else None
+        except Exception as e:
+            logging.error(f"Failed to load retrieval index {path}: {e}")
+            _indexes[assistant_id] = None
+    return _indexes[assistant_id]
+
+
+async def embed(texts: list[str], model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Нормализованные эмбеддинги (float32)"""
+    response = await client.embeddings.create(model=model, input=texts)
+    vectors = np.array([item.embedding for item in response.data], dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    return vectors
+
+
+async def retrieve(assistant_id: str, query: str, top_k: int = LOCAL_RETRIEVAL_TOP_K) -> RetrievalResult | None:
+    """
+    Найти фрагменты базы знаний для запроса.
+    None — если индекса для ассистента нет (нужен hosted file_search).
+    """
+    index = get_index(assistant_id)
+    if index is None:
+        return None
+
+    started = time.monotonic()
+    query_embedding = None
+    if index.embeddings is not None:
+        try:
+            query_embedding = (await embed([query], index.meta["embedding_model"]))[0]
+        except Exception as e:
+            logging.warning(f"Query embedding failed, using BM25 only: {e}")
+
+    chunks, top_similarity, top_bm25 = index.search(query, query_embedding, top_k)
+
+    # Порог по косинусной близости (если есть эмбеддинги), иначе по BM25
+    if top_similarity is not None:
+        relevant = top_similarity >= LOCAL_RETRIEVAL_MIN_SIMILARITY
+    else:
+        relevant = top_bm25 >= LOCAL_RETRIEVAL_MIN_BM25
+
+    return RetrievalResult(
+        chunks=chunks if relevant else [],
+        relevant=relevant,
+        top_similarity=top_similarity,
+        top_bm25=top_bm25,
+        latency=time.monotonic() - started
+    )
+
+
+def format_context(chunks: list[Chunk]) -> str:
+    """Текст для подстановки в запрос вместо результатов file_search"""
+    parts = [f"[{i}] {chunk.text}" for i, chunk in enumerate(chunks, 1)]
+    return "Фрагменты базы знаний, относящиеся к вопросу:\n\n" + "\n\n".join(parts)
+
+
+# ======================================================
+#                   СБОРКА ИНДЕКСА
+# ======================================================
+def read_document(path: str) -> str | None:
+    """Извлечь текст из файла базы знаний (pdf/docx — если установлены pypdf / python-docx)"""
+    ext = os.path.splitext(path)[1].lower()
+
+    if ext in TEXT_EXTENSIONS:
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            text = f.read()
+        if ext in (".html", ".htm"):
+            text = html.unescape(_TAG_RE.sub(" ", text))
+        return text
+
+    if ext == ".pdf":
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            print(f"   ⚠️ {path}: pypdf не установлен, файл пропущен")
+            return None
+        return "\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+
+    if ext == ".docx":
+        try:
+            import docx
+        except ImportError:
+            print(f"   ⚠️ {path}: python-docx не установлен, файл пропущен")
+            return None
+        return "\n".join(p.text for p in docx.Document(path).paragraphs)
+
+    print(f"   ⚠️ {path}: неподдерживаемый формат, файл пропущен")
+    return None
+
+
+def split_chunks(text: str) -> list[str]:
+    text = re.sub(r"\s+", " ", text).strip()
+    step = CHUNK_SIZE - CHUNK_OVERLAP
+    return [text[i:i + CHUNK_SIZE] for i in range(0, max(len(text) - CHUNK_OVERLAP, 1), step) if text[i:i + CHUNK_SIZE].strip()]
+
+
+async def build_index(assistant_id: str, directory: str, with_embeddings: bool = True) -> str:
+    from export_common import Progress, gather_bounded
+
+    out = os.path.join(LOCAL_RETRIEVAL_DIR, assistant_id)
+    os.makedirs(out, exist_ok=True)
+
+    texts, source_ids, sources = [], [], []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            document = read_document(path)
+            if not document:
+                continue
+            sources.append(os.path.relpath(path, directory).replace(os.sep, "/"))
+            for chunk in split_chunks(document):
+                texts.append(chunk)
+                source_ids.append(len(sources) - 1)
+
+    if not texts:
+        sys.exit("Не найдено ни одного фрагмента текста")
+    print(f"📄 Документов: {len(sources)}, фрагментов: {len(texts)}")
+
+    # Обратный индекс BM25 в формате CSR
+    doc_terms = [Counter(tokenize(t)) for t in texts]
+    vocab: dict[str, int] = {}
+    postings: dict[int, list[tuple[int, int]]] = {}
+    for doc, counts in enumerate(doc_terms):
+        for term, tf in counts.items():
+            term_id = vocab.setdefault(term, len(vocab))
+            postings.setdefault(term_id, []).append((doc, tf))
+
+    indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+    docs_list, tf_list = [], []
+    for term_id in range(len(vocab)):
+        entries = postings[term_id]
+        indptr[term_id + 1] = indptr[term_id] + len(entries)
+        docs_list.extend(d for d, _ in entries)
+        tf_list.extend(tf for _, tf in entries)
+
+    doc_len = np.array([sum(c.values()) for c in doc_terms], dtype=np.float32)
+
+    encoded = [t.encode("utf-8") for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    with open(os.path.join(out, "texts.bin"), "wb") as f:
+        for e in encoded:
+            f.write(e)
+
+    np.save(os.path.join(out, "postings_indptr.npy"), indptr)
+    np.save(os.path.join(out, "postings_docs.npy"), np.array(docs_list, dtype=np.int32))
+    np.save(os.path.join(out, "postings_tf.npy"), np.array(tf_list, dtype=np.float32))
+    np.save(os.path.join(out, "doc_len.npy"), doc_len)
+    np.save(os.path.join(out, "text_offsets.npy"), offsets)
+    np.save(os.path.join(out, "source_ids.npy"), np.array(source_ids, dtype=np.int32))
+    with open(os.path.join(out, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(vocab, f, ensure_ascii=False)
+
+    emb_path = os.path.join(out, "embeddings.npy")
+    if with_embeddings:
+        print(f"🧮 Эмбеддинги ({EMBEDDING_MODEL})...")
+        batches = [texts[i:i + 100] for i in range(0, len(texts), 100)]
+        vectors = await gather_bounded(batches, embed, progress=Progress("batch", len(batches)))
+        np.save(emb_path, np.vstack(vectors).astype(np.float32))
+    elif os.path.exists(emb_path):
+        os.remove(emb_path)
+
+    meta = {
+        "assistant_id": assistant_id,
+        "chunks": len(texts),
+        "avg_len": float(doc_len.mean()),
+        "sources": sources,
+        "embedding_model": EMBEDDING_MODEL if with_embeddings else None,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(os.path.join(out, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    print(f"✅ Индекс сохранён: {out}")
+    return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Локальный индекс базы знаний")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="Собрать индекс из папки")
+    build.add_argument("--assistant", required=True)
+    build.add_argument("--dir", required=True)
+    build.add_argument("--no-embeddings", action="store_true", help="Только BM25")
+
+    query = sub.add_parser("query", help="Проверить поиск")
+    query.add_argument("--assistant", required=True)
+    query.add_argument("text")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        asyncio.run(build_index(args.assistant, args.dir, not args.no_embeddings))
+        return
+
+    result = asyncio.run(retrieve(args.assistant, args.text))
+    if result is None:
+        sys.exit("Индекс не найден")
+    print(f"relevant={result.relevant} similarity={result.top_similarity} "
+          f"bm25={result.top_bm25:.2f} latency={result.latency * 1000:.1f}ms")
+    for chunk in result.chunks:
+        print(f"\n[{chunk.score:.4f}] {chunk.source}\n{chunk.text[:300]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,50 +2,81 @@ from __future__ import annotations
 import asyncio
 import logging
 import os
-import uuid
 import tempfile
+from functools import partial
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import CommandStart, Command
-from aiogram.enums import ParseMode
-from aiogram.client.default import DefaultBotProperties
-from aiogram.types import CallbackQuery
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.types import CallbackQuery, FSInputFile
 from sqlalchemy import select
 
 from config import (
-    TELEGRAM_TOKEN, DAILY_REQUEST_LIMIT, MAX_FILE_SIZE, ADMIN_IDS
+    DAILY_REQUEST_LIMIT, MAX_FILE_SIZE, ADMIN_IDS, QUEUE_MODE, METRICS_PORT, CAPTURE_UPDATES,
+    ANALYTICS_INTERVAL, SHUTDOWN_DRAIN_TIMEOUT, ETA_REFRESH_INTERVAL
 )
-from middleware import GroupCheckMiddleware, CallbackGroupCheckMiddleware
+from middleware import GroupCheckMiddleware, CallbackGroupCheckMiddleware, on_group_member_update
 from database import session_maker, create_db, drop_db, UserState
 from keyboards import (
     build_assistant_keyboard, build_assistant_selection_keyboard,
-    get_assistant_card, ASSISTANTS
+    get_assistant_card, build_broadcast_keyboard, ASSISTANTS
 )
-from openai_client_v2 import (
-    ask_assistant_v2, ask_assistant_file_v2, get_conversation_history_v2
+from openai_client_v2 import get_conversation, fetch_history, preload_tokenizers
+from rate_limit import check_rate_limit, get_usage_count
+from background_jobs import job_poller
+from assistant_service import (
+    create_bot, format_usage_info, run_text_request, run_file_request,
+    deliver_background_reply, send_loading, resume_pending_jobs
 )
-from rate_limit import check_rate_limit, increment_usage, get_usage_count
+from task_queue import enqueue_task, track_queue_depth
+from cache import user_state_cache, history_cache, MISSING
+from coordination import invalidate, start_coordination, stop_coordination
+from metrics import MetricsMiddleware, start_metrics_server, timed, ADMISSION_REQUESTS
+from tracing import TracingMiddleware, set_attribute, slow_log
+from capture import CaptureMiddleware, capture_writer
+from broadcast import broadcaster, create_broadcast, unblock_user, get_recent_broadcasts, format_progress
+from analytics import record_request, run_rollups, get_stats, format_stats, export_csv, EXPORTS
+from dedup import DedupMiddleware, deduplicator
+from pending_jobs import in_flight, InFlightJob
+from admission import admission, TIER_NAMES, TIER_REJECT
+from eta import estimator, eta_text, expected_wait, format_eta, input_type, TEXT
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-bot = Bot(TELEGRAM_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot = create_bot()
 dp = Dispatcher()
 
+# Метрики и трассировка — на весь апдейт, до проверок доступа
+dp.update.outer_middleware(MetricsMiddleware())
+dp.update.outer_middleware(TracingMiddleware())
+# Повторно доставленный апдейт не должен второй раз списать лимит и сходить в OpenAI
+dp.update.outer_middleware(DedupMiddleware())
+if CAPTURE_UPDATES:
+    dp.update.outer_middleware(CaptureMiddleware())
+
 # Защита и message, и callback_query
 dp.message.middleware(GroupCheckMiddleware())
 dp.callback_query.middleware(CallbackGroupCheckMiddleware())
+dp.chat_member.register(on_group_member_update)
 
 
 # ======================================================
 #            РАБОТА С USER STATE В БД
 # ======================================================
+@timed("db_user_state")
 async def get_user_assistant(tg_id: int, session) -> str | None:
     """Получить выбранного ассистента из БД"""
+    cached = user_state_cache.get(tg_id)
+    if cached is not MISSING:
+        return cached
+
     result = await session.execute(
         select(UserState).where(UserState.tg_id == tg_id)
     )
     state = result.scalar_one_or_none()
-    return state.assistant_id if state else None
+    assistant_id = state.assistant_id if state else None
+    user_state_cache.set(tg_id, assistant_id)
+    return assistant_id
 
 
 async def set_user_assistant(tg_id: int, assistant_id: str, session) -> None:
@@ -61,29 +92,19 @@ async def set_user_assistant(tg_id: int, assistant_id: str, session) -> None:
         state = UserState(tg_id=tg_id, assistant_id=assistant_id)
         session.add(state)
 
+    await invalidate("user_state", tg_id, session)
     await session.commit()
 
 
-def get_safe_filepath(original_filename: str) -> str:
-    """Генерирует безопасный путь для временного файла"""
-    safe_name = os.path.basename(original_filename)
-    unique_name = f"{uuid.uuid4().hex}_{safe_name}"
-    return os.path.join(tempfile.gettempdir(), unique_name)
-
-
-def format_usage_info(current: int, limit: int) -> str:
-    """Форматирует информацию о лимите"""
-    remaining = limit - current
-    if remaining <= 20:
-        return f"⚠️ Осталось запросов: {remaining}/{limit}"
-    return f"📊 Запросов: {current}/{limit}"
-
-
 # ======================================================
 #                   START COMMAND
 # ======================================================
 @dp.message(CommandStart())
 async def start(message: types.Message):
+    # Пользователь мог раньше заблокировать бота — снова включаем его в рассылки
+    async with session_maker() as session:
+        await unblock_user(message.from_user.id, session)
+
     await message.answer(
         "👋 <b>Добро пожаловать в Titan AI!</b>\n\n"
         "Я — ваш помощник для работы с Wildberries.\n"
@@ -135,11 +156,17 @@ async def status_command(message: types.Message):
         a = ASSISTANTS[assistant_id]
         assistant_info = f"{a['emoji']} {a['title']}"
 
+    eta_info = ""
+    if assistant_id and assistant_id in ASSISTANTS:
+        low, high, _ = expected_wait(assistant_id, TEXT)
+        eta_info = f"<b>Ответ займёт:</b> {format_eta(low, high)}\n"
+
     remaining = DAILY_REQUEST_LIMIT - usage
 
     await message.answer(
         "<b>📊 Ваш статус</b>\n\n"
         f"<b>Ассистент:</b> {assistant_info}\n"
+        f"{eta_info}"
         f"<b>Запросов сегодня:</b> {usage}\n"
         f"<b>Осталось:</b> {remaining}/{DAILY_REQUEST_LIMIT}\n\n"
         "Лимит сбрасывается в полночь.",
@@ -147,6 +174,111 @@ async def status_command(message: types.Message):
     )
 
 
+# ======================================================
+#                   РАССЫЛКА (АДМИН)
+# ======================================================
+is_admin = F.from_user.id.in_(ADMIN_IDS)
+
+
+@dp.message(Command("broadcast"), is_admin)
+async def broadcast_command(message: types.Message, command: CommandObject):
+    # Текст — после команды или из сообщения, на которое админ ответил (с форматированием)
+    text = message.reply_to_message.html_text if message.reply_to_message else command.args
+    if not text:
+        await message.answer(
+            "Использование: <code>/broadcast текст</code> (HTML-разметка) "
+            "или ответ командой /broadcast на сообщение с текстом рассылки"
+        )
+        return
+
+    # Предпросмотр заодно проверяет разметку до отправки всем
+    try:
+        await message.answer(text)
+    except TelegramBadRequest as e:
+        await message.answer(f"⚠️ Telegram не принял текст: {e.message}")
+        return
+
+    async with session_maker() as session:
+        broadcast = await create_broadcast(message.from_user.id, text, session)
+
+    await message.answer(
+        f"📣 Рассылка #{broadcast.id}: сообщение выше получат {broadcast.total} пользователей. Отправить?",
+        reply_markup=build_broadcast_keyboard(broadcast.id)
+    )
+
+
+@dp.message(Command("broadcasts"), is_admin)
+async def broadcasts_command(message: types.Message):
+    async with session_maker() as session:
+        broadcasts = await get_recent_broadcasts(session)
+
+    if not broadcasts:
+        await message.answer("Рассылок ещё не было")
+        return
+    await message.answer("\n\n".join(format_progress(b) for b in broadcasts))
+
+
+@dp.callback_query(F.data.startswith("broadcast_start:"), is_admin)
+async def broadcast_start(cb: CallbackQuery):
+    broadcast_id = int(cb.data.split(":", 1)[1])
+
+    if not await broadcaster.launch(bot, broadcast_id, cb.message.chat.id, cb.message.message_id):
+        await cb.answer("Рассылка уже запущена или отменена", show_alert=True)
+        return
+
+    await cb.message.edit_reply_markup(reply_markup=build_broadcast_keyboard(broadcast_id, running=True))
+    await cb.answer("Рассылка запущена")
+
+
+@dp.callback_query(F.data.startswith("broadcast_cancel:"), is_admin)
+async def broadcast_cancel(cb: CallbackQuery):
+    broadcast_id = int(cb.data.split(":", 1)[1])
+    cancelled = await broadcaster.cancel(broadcast_id)
+
+    await cb.message.edit_reply_markup(reply_markup=None)
+    await cb.answer("Рассылка остановлена" if cancelled else "Рассылка уже завершена")
+
+
+# ======================================================
+#                   АНАЛИТИКА (АДМИН)
+# ======================================================
+def parse_days(value: str | None, default: int = 7) -> int:
+    try:
+        return max(1, min(int(value), 366)) if value else default
+    except ValueError:
+        return default
+
+
+@dp.message(Command("stats"), is_admin)
+async def stats_command(message: types.Message, command: CommandObject):
+    days = parse_days(command.args)
+
+    async with session_maker() as session:
+        per_day, per_assistant = await get_stats(session, days)
+
+    titles = {asst_id: f"{a['emoji']} {a['title']}" for asst_id, a in ASSISTANTS.items()}
+    await message.answer(format_stats(days, per_day, per_assistant, titles))
+
+
+@dp.message(Command("stats_csv"), is_admin)
+async def stats_csv_command(message: types.Message, command: CommandObject):
+    # /stats_csv [daily|requests] [дней]
+    args = (command.args or "").split()
+    kind = args[0] if args and args[0] in EXPORTS else "daily"
+    days = parse_days(args[-1] if args and args[-1].isdigit() else None, default=30)
+
+    path = os.path.join(tempfile.gettempdir(), f"stats_{kind}_{message.from_user.id}.csv")
+    try:
+        rows = await export_csv(kind, days, path)
+        await message.answer_document(
+            FSInputFile(path, filename=f"titan_{kind}_{days}d.csv"),
+            caption=f"📄 {kind}: {rows} строк за {days} дн."
+        )
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
 # ======================================================
 #           ВЫБОР / СМЕНА АССИСТЕНТА
 # ======================================================
@@ -231,12 +363,28 @@ async def show_status(cb: CallbackQuery):
 # ======================================================
 #                   SHOW HISTORY
 # ======================================================
+async def render_history(assistant: dict, conv) -> str | None:
+    """Текст «📜 История» (None — истории нет или её не удалось загрузить)"""
+    history = await fetch_history(conv, limit=5)
+    if not history:
+        return None
+
+    history_text = f"📜 <b>История ({assistant['emoji']} {assistant['title']})</b>\n\n"
+
+    for i, item in enumerate(history, 1):
+        role = "👤 Вы" if item["role"] == "user" else f"{assistant['emoji']} Ответ"
+        text = item["text"][:200] + "..." if len(item["text"]) > 200 else item["text"]
+        history_text += f"<b>{role}:</b>\n{text}\n\n"
+    return history_text
+
+
 @dp.callback_query(F.data == "show_history")
 async def show_history(cb: CallbackQuery):
     tg_id = cb.from_user.id
 
     async with session_maker() as session:
         assistant_id = await get_user_assistant(tg_id, session)
+        conv = await get_conversation(tg_id, assistant_id, session) if assistant_id else None
 
     if not assistant_id:
         await cb.answer("Сначала выберите ассистента", show_alert=True)
@@ -248,25 +396,30 @@ async def show_history(cb: CallbackQuery):
         return
 
     try:
-        async with session_maker() as session:
-            history = await get_conversation_history_v2(tg_id, assistant_id, session, limit=5)
+        if conv and conv.last_response_id:
+            # Новый ответ меняет last_response_id — старая запись просто перестаёт читаться
+            history_text = await history_cache.get_or_load(
+                (tg_id, assistant_id, conv.last_response_id),
+                lambda: render_history(assistant, conv)
+            )
+        else:
+            history_text = await render_history(assistant, conv)  # пусто или только резюме — без сети
 
-        if not history:
+        if not history_text:
             await cb.answer("История пуста. Задайте первый вопрос!", show_alert=True)
             return
 
-        history_text = f"📜 <b>История ({assistant['emoji']} {assistant['title']})</b>\n\n"
-
-        for i, item in enumerate(history, 1):
-            role = "👤 Вы" if item["role"] == "user" else f"{assistant['emoji']} Ответ"
-            text = item["text"][:200] + "..." if len(item["text"]) > 200 else item["text"]
-            history_text += f"<b>{role}:</b>\n{text}\n\n"
-
         await cb.message.edit_text(
             history_text,
             reply_markup=build_assistant_keyboard(assistant_id)
         )
 
+    except TelegramBadRequest as e:
+        # Повторное нажатие: та же история уже на экране
+        if "message is not modified" not in e.message:
+            logging.error(f"Error showing history: {e}")
+            await cb.answer("Не удалось загрузить историю", show_alert=True)
+
     except Exception as e:
         logging.error(f"Error getting history: {e}")
         await cb.answer("Не удалось загрузить историю", show_alert=True)
@@ -274,6 +427,16 @@ async def show_history(cb: CallbackQuery):
     await cb.answer()
 
 
+async def reject_if_overloaded(message: types.Message) -> bool:
+    """Перегрузка (уровень reject в admission.py) — честно отказать с ETA, не списывая лимит"""
+    if admission.tier() < TIER_REJECT:
+        return False
+    ADMISSION_REQUESTS.labels(TIER_NAMES[TIER_REJECT]).inc()
+    set_attribute("admission_tier", TIER_NAMES[TIER_REJECT])
+    await message.answer(admission.reject_text())
+    return True
+
+
 # ======================================================
 #                   ФАЙЛЫ / ФОТО
 # ======================================================
@@ -310,78 +473,65 @@ async def handle_file(message: types.Message):
             )
             return
 
-        allowed, current_count, _ = await check_rate_limit(tg_id, session)
+        allowed, _, _ = await check_rate_limit(tg_id, session)
         if not allowed:
+            await record_request(tg_id, assistant_id, "file", status="limit")
             await message.answer(
                 f"⛔ Вы достигли лимита в {DAILY_REQUEST_LIMIT} запросов на сегодня.\n"
                 "Лимит сбросится в полночь. Попробуйте завтра!"
             )
             return
 
-    # Отправляем сообщение о загрузке
-    loading_msg = await message.answer(
+    if await reject_if_overloaded(message):
+        return
+
+    # Индикатор загрузки (сообщение или chat action — см. LOADING_MODE)
+    loading_message_id = await send_loading(
+        bot,
+        message.chat.id,
         f"⏳ <b>{assistant['emoji']} {assistant['title']}</b> анализирует файл...\n\n"
-        "<i>Обычно это занимает 10-60 секунд</i>"
+        f"<i>{eta_text(assistant_id, input_type('file', bool(message.photo), file_size))}</i>"
     )
 
     original_filename = message.document.file_name if message.document else "image.jpg"
-    filepath = get_safe_filepath(original_filename)
-
-    try:
-        file_id = (
-            message.photo[-1].file_id
-            if message.photo
-            else message.document.file_id
-        )
-        tg_file = await bot.get_file(file_id)
-        downloaded = await bot.download_file(tg_file.file_path)
+    file_id = (
+        message.photo[-1].file_id
+        if message.photo
+        else message.document.file_id
+    )
 
-        with open(filepath, "wb") as f:
-            f.write(downloaded.read())
+    payload = {
+        "file_id": file_id,
+        "filename": original_filename,
+        "is_photo": bool(message.photo)
+    }
 
+    if QUEUE_MODE:
         async with session_maker() as session:
-            await increment_usage(tg_id, session)
-            new_count = current_count + 1
-
-            reply, _ = await ask_assistant_file_v2(
+            await enqueue_task(
+                session,
                 tg_id=tg_id,
+                chat_id=message.chat.id,
                 assistant_id=assistant_id,
-                filepath=filepath,
-                session=session
+                kind="file",
+                payload=payload,
+                loading_message_id=loading_message_id
             )
+        return
 
-        usage_info = format_usage_info(new_count, DAILY_REQUEST_LIMIT)
-        response_text = f"{assistant['emoji']} <b>{assistant['title']}</b>:\n\n{reply}\n\n{usage_info}"
-
-        await loading_msg.delete()
-        await message.answer(
-            response_text,
-            reply_markup=build_assistant_keyboard(assistant_id)
-        )
-
-    except TimeoutError:
-        await loading_msg.delete()
-        await message.answer(
-            "⏱️ Ассистент не успел ответить за отведённое время.\n"
-            "Попробуйте повторить запрос или отправить файл меньшего размера.",
-            reply_markup=build_assistant_keyboard(assistant_id)
-        )
-
-    except Exception as e:
-        logging.error(f"FILE ERROR for user {tg_id}: {type(e).__name__}: {e}")
-        await loading_msg.delete()
-        await message.answer(
-            "⚠️ Ошибка обработки файла. Попробуйте ещё раз или обратитесь в поддержку.",
-            reply_markup=build_assistant_keyboard(assistant_id)
+    # Если бот остановят посреди запроса, он попадёт в pending_jobs
+    with in_flight.track(InFlightJob(tg_id, message.chat.id, assistant_id, "file", payload, loading_message_id)):
+        await run_file_request(
+            bot,
+            chat_id=message.chat.id,
+            tg_id=tg_id,
+            assistant_id=assistant_id,
+            file_id=file_id,
+            filename=original_filename,
+            is_photo=bool(message.photo),
+            loading_message_id=loading_message_id
         )
 
-    finally:
-        if os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-            except OSError:
-                pass
-
 
 # ======================================================
 #                   ТЕКСТОВЫЕ СООБЩЕНИЯ
@@ -410,55 +560,49 @@ async def handle_message(message: types.Message):
             )
             return
 
-        allowed, current_count, _ = await check_rate_limit(tg_id, session)
+        allowed, _, _ = await check_rate_limit(tg_id, session)
         if not allowed:
+            await record_request(tg_id, assistant_id, "text", status="limit")
             await message.answer(
                 f"⛔ Вы достигли лимита в {DAILY_REQUEST_LIMIT} запросов на сегодня.\n"
                 "Лимит сбросится в полночь. Попробуйте завтра!"
             )
             return
 
-    # Отправляем сообщение о загрузке
-    loading_msg = await message.answer(
+    if await reject_if_overloaded(message):
+        return
+
+    # Индикатор загрузки (сообщение или chat action — см. LOADING_MODE)
+    loading_message_id = await send_loading(
+        bot,
+        message.chat.id,
         f"⏳ <b>{assistant['emoji']} {assistant['title']}</b> думает...\n\n"
-        "<i>Обычно это занимает 5-30 секунд</i>"
+        f"<i>{eta_text(assistant_id, TEXT)}</i>"
     )
 
-    try:
+    if QUEUE_MODE:
         async with session_maker() as session:
-            await increment_usage(tg_id, session)
-            new_count = current_count + 1
-
-            reply, _ = await ask_assistant_v2(
+            await enqueue_task(
+                session,
                 tg_id=tg_id,
+                chat_id=message.chat.id,
                 assistant_id=assistant_id,
-                user_message=message.text,
-                session=session
+                kind="text",
+                payload={"text": message.text},
+                loading_message_id=loading_message_id
             )
+        return
 
-        usage_info = format_usage_info(new_count, DAILY_REQUEST_LIMIT)
-        response_text = f"{assistant['emoji']} <b>{assistant['title']}</b>:\n\n{reply}\n\n{usage_info}"
-
-        await loading_msg.delete()
-        await message.answer(
-            response_text,
-            reply_markup=build_assistant_keyboard(assistant_id)
-        )
-
-    except TimeoutError:
-        await loading_msg.delete()
-        await message.answer(
-            "⏱️ Ассистент не успел ответить за отведённое время.\n"
-            "Попробуйте повторить запрос или сформулировать вопрос короче.",
-            reply_markup=build_assistant_keyboard(assistant_id)
-        )
-
-    except Exception as e:
-        logging.error(f"ERROR for user {tg_id}: {type(e).__name__}: {e}")
-        await loading_msg.delete()
-        await message.answer(
-            "⚠️ Ошибка обращения к ассистенту. Попробуйте ещё раз.",
-            reply_markup=build_assistant_keyboard(assistant_id)
+    # Если бот остановят посреди запроса, он попадёт в pending_jobs
+    payload = {"text": message.text}
+    with in_flight.track(InFlightJob(tg_id, message.chat.id, assistant_id, "text", payload, loading_message_id)):
+        await run_text_request(
+            bot,
+            chat_id=message.chat.id,
+            tg_id=tg_id,
+            assistant_id=assistant_id,
+            text=message.text,
+            loading_message_id=loading_message_id
         )
 
 
@@ -469,11 +613,41 @@ async def on_startup(bot: Bot):
     logging.info("Running startup...")
     await create_db()
     logging.info("DB ready")
+    await deduplicator.load()
+    await start_coordination()
+    await preload_tokenizers()
+    await job_poller.start(partial(deliver_background_reply, bot))
+    await broadcaster.start(bot)
+    start_metrics_server(METRICS_PORT)
+    if CAPTURE_UPDATES:
+        capture_writer.start()
+    if QUEUE_MODE:
+        background_tasks.add(asyncio.create_task(track_queue_depth()))
+    background_tasks.add(asyncio.create_task(run_rollups(ANALYTICS_INTERVAL)))
+    background_tasks.add(asyncio.create_task(estimator.run(ETA_REFRESH_INTERVAL)))
+    for task in await resume_pending_jobs(bot):
+        resumed_tasks.add(task)
+        task.add_done_callback(resumed_tasks.discard)
     logging.info("Bot started")
 
 
 async def on_shutdown(bot: Bot):
     logging.info("Bot shutting down...")
+    # Polling уже остановлен: ждём запросы в работе, недождавшиеся — в pending_jobs
+    await in_flight.drain(SHUTDOWN_DRAIN_TIMEOUT)
+    await job_poller.stop()
+    await broadcaster.stop()
+    for task in background_tasks:
+        task.cancel()
+    await capture_writer.stop()
+    await slow_log.stop()
+    await stop_coordination()
+
+
+# Фоновые задачи бота (отменяются при остановке)
+background_tasks: set[asyncio.Task] = set()
+# Запросы, подхваченные из pending_jobs (при остановке — как обычные запросы в работе)
+resumed_tasks: set[asyncio.Task] = set()
 
 
 # ======================================================
@@ -485,7 +659,8 @@ async def main() -> None:
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
-    await dp.start_polling(bot)
+    # chat_member нужен для сброса кэша членства в группе
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
 if __name__ == "__main__":
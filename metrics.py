@@ -0,0 +1,173 @@
+"""
+Метрики Prometheus.
+
+Эндпоинт /metrics поднимается на METRICS_PORT (0 — выключено).
+Стадии обработки запроса меряются декоратором @timed("стадия"),
+апдейты целиком — outer-middleware MetricsMiddleware.
+
+Стадии:
+    membership      — проверка членства в группе (Telegram getChatMember)
+    db_user_state   — чтение выбранного ассистента
+    db_rate_limit   — проверка лимита
+    db_usage        — списание запроса
+    openai          — Responses API (метка model — модель, которая ответила)
+    openai_history  — загрузка истории
+    telegram_send   — отправка ответа
+"""
+from __future__ import annotations
+import functools
+import inspect
+import logging
+import time
+from typing import Any, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from tracing import span
+
+# Ответы ассистентов занимают десятки секунд — бакеты до 5 минут
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+STAGE_LATENCY = Histogram(
+    "titan_stage_duration_seconds",
+    "Длительность стадии обработки запроса",
+    ["stage", "assistant", "model"],
+    buckets=BUCKETS
+)
+UPDATE_LATENCY = Histogram(
+    "titan_update_duration_seconds",
+    "Полная обработка апдейта Telegram",
+    ["event_type"],
+    buckets=BUCKETS
+)
+ERRORS = Counter(
+    "titan_errors_total",
+    "Ошибки по стадиям",
+    ["stage", "error"]
+)
+TIMEOUTS = Counter(
+    "titan_timeouts_total",
+    "Таймауты по стадиям",
+    ["stage", "assistant"]
+)
+RATE_LIMIT_DENIALS = Counter(
+    "titan_rate_limit_denials_total",
+    "Отказы по дневному лимиту запросов"
+)
+IN_FLIGHT = Gauge(
+    "titan_updates_in_flight",
+    "Апдейты, которые обрабатываются прямо сейчас",
+    ["event_type"]
+)
+QUEUE_DEPTH = Gauge(
+    "titan_queue_depth",
+    "Задачи в task_queue, ожидающие воркера"
+)
+CONTAINER_LATENCY = Histogram(
+    "titan_openai_container_duration_seconds",
+    "Запрос к Responses API по режиму контейнера code_interpreter (none / new / reused)",
+    ["assistant", "container"],
+    buckets=BUCKETS
+)
+FILE_SEARCH_LATENCY = Histogram(
+    "titan_openai_file_search_duration_seconds",
+    "Запрос к Responses API с file_search и без (on / off) — реальная цена поиска по базе знаний",
+    ["assistant", "file_search"],
+    buckets=BUCKETS
+)
+DUPLICATE_UPDATES = Counter(
+    "titan_duplicate_updates_total",
+    "Отброшенные повторные апдейты Telegram (по update_id или по сообщению)",
+    ["key"]
+)
+ADMISSION_TIER = Gauge(
+    "titan_admission_tier",
+    "Уровень деградации: 0 normal, 1 no_tools, 2 cheap_model, 3 short_output, 4 reject"
+)
+ADMISSION_PRESSURE = Gauge(
+    "titan_admission_pressure",
+    "Давление по сигналу контроля допуска (1 — на пороге)",
+    ["signal"]
+)
+ADMISSION_REQUESTS = Counter(
+    "titan_admission_requests_total",
+    "Запросы к ассистентам по уровню деградации, с которым они выполнены (reject — отклонены)",
+    ["tier"]
+)
+ETA_SECONDS = Gauge(
+    "titan_eta_seconds",
+    "Оценка времени ответа ассистента по недавним запросам (квантили eta.py)",
+    ["assistant", "model", "input", "quantile"]
+)
+BROADCAST_MESSAGES = Counter(
+    "titan_broadcast_messages_total",
+    "Сообщения рассылки по результату доставки",
+    ["result"]
+)
+
+
+def start_metrics_server(port: int) -> None:
+    """Поднять /metrics на порту (0 — метрики не публикуются)"""
+    if port <= 0:
+        return
+    try:
+        start_http_server(port)
+        logging.info(f"Metrics available on :{port}/metrics")
+    except OSError as e:
+        logging.warning(f"Failed to start metrics server on port {port}: {e}")
+
+
+def timed(stage: str, model: Callable[[Any], str] | None = None):
+    """
+    Декоратор async-функции: длительность, ошибки и таймауты стадии.
+    Метка assistant берётся из аргумента assistant_id, model — из результата.
+    Вызов также становится спаном текущей трассы (tracing.py).
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            assistant = signature.bind_partial(*args, **kwargs).arguments.get("assistant_id") or ""
+            started = time.perf_counter()
+            model_label = ""
+            try:
+                with span(stage, assistant=assistant or None) as current:
+                    result = await fn(*args, **kwargs)
+                    if model:
+                        model_label = model(result)
+                        if current is not None:
+                            current.attrs["model"] = model_label
+                return result
+            except TimeoutError:
+                TIMEOUTS.labels(stage, assistant).inc()
+                ERRORS.labels(stage, "TimeoutError").inc()
+                raise
+            except Exception as e:
+                ERRORS.labels(stage, type(e).__name__).inc()
+                raise
+            finally:
+                STAGE_LATENCY.labels(stage, assistant, model_label).observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Outer-middleware на update: длительность и количество апдейтов в обработке"""
+
+    async def __call__(self, handler, event: Update, data):
+        event_type = event.event_type
+        IN_FLIGHT.labels(event_type).inc()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            ERRORS.labels("handler", type(e).__name__).inc()
+            raise
+        finally:
+            UPDATE_LATENCY.labels(event_type).observe(time.perf_counter() - started)
+            IN_FLIGHT.labels(event_type).dec()
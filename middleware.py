@@ -1,9 +1,12 @@
 from __future__ import annotations
 import logging
 from aiogram import BaseMiddleware
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated
 
 from config import GROUP_ID
+from cache import membership_cache, MISSING
+from coordination import invalidate
+from metrics import timed
 
 
 class GroupCheckMiddleware(BaseMiddleware):
@@ -56,11 +59,26 @@ class CallbackGroupCheckMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+@timed("membership")
 async def check_user_membership(bot, user_id: int) -> bool:
     """Проверяет, является ли пользователь членом группы"""
+    cached = membership_cache.get(user_id)
+    if cached is not MISSING:
+        return cached
+
     try:
         member = await bot.get_chat_member(GROUP_ID, user_id)
-        return member.status in ["member", "creator", "administrator"]
+        allowed = member.status in ["member", "creator", "administrator"]
     except Exception as e:
         logging.warning(f"Failed to check membership for user {user_id}: {e}")
-        return False
+        return False  # ошибки не кэшируем
+
+    membership_cache.set(user_id, allowed)
+    return allowed
+
+
+async def on_group_member_update(event: ChatMemberUpdated):
+    """Сбрасывает кэш членства, когда пользователь вступил в группу или покинул её"""
+    if event.chat.id != GROUP_ID:
+        return
+    await invalidate("membership", event.new_chat_member.user.id)
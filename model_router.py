@@ -0,0 +1,203 @@
+"""
+Маршрутизация запросов между моделями с учётом задержек и ошибок.
+
+Для каждой модели хранится скользящее окно последних вызовов (латентность + успех).
+Если p95 или доля ошибок модели выходят за SLO — запросы уходят на следующую
+модель из цепочки fallback. Опционально через MODEL_HEDGE_DELAY секунд
+параллельно отправляется второй запрос на резервную модель.
+"""
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+from config import (
+    MODEL_SLO_P95, MODEL_SLO_ERROR_RATE, MODEL_STATS_WINDOW,
+    MODEL_STATS_MIN_SAMPLES, MODEL_HEDGE_DELAY, OPENAI_RUN_TIMEOUT
+)
+
+T = TypeVar("T")
+
+# Ошибки, при которых имеет смысл пробовать другую модель.
+# BadRequest и т.п. — проблема запроса, а не модели, их пробрасываем сразу.
+RETRYABLE_ERRORS = (
+    APIConnectionError, APITimeoutError, InternalServerError, RateLimitError, TimeoutError
+)
+
+
+class ModelStats:
+    """Скользящее окно вызовов одной модели"""
+
+    def __init__(self, window_seconds: int = MODEL_STATS_WINDOW, max_samples: int = 500):
+        self.window_seconds = window_seconds
+        self.samples: deque[tuple[float, float, bool]] = deque(maxlen=max_samples)
+
+    def record(self, latency: float, ok: bool) -> None:
+        self.samples.append((time.monotonic(), latency, ok))
+
+    def _prune(self) -> None:
+        border = time.monotonic() - self.window_seconds
+        while self.samples and self.samples[0][0] < border:
+            self.samples.popleft()
+
+    def p95(self) -> float | None:
+        self._prune()
+        latencies = sorted(s[1] for s in self.samples)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self) -> float:
+        self._prune()
+        if not self.samples:
+            return 0.0
+        return sum(1 for s in self.samples if not s[2]) / len(self.samples)
+
+    def is_healthy(self) -> bool:
+        """Модель здорова, пока данных мало или SLO не нарушены"""
+        self._prune()
+        if len(self.samples) < MODEL_STATS_MIN_SAMPLES:
+            return True
+        p95 = self.p95()
+        if p95 is not None and p95 > MODEL_SLO_P95:
+            return False
+        return self.error_rate() <= MODEL_SLO_ERROR_RATE
+
+
+class ModelRouter:
+    """Выбирает модель из цепочки fallback и выполняет запрос"""
+
+    def __init__(self, hedge_delay: float = MODEL_HEDGE_DELAY, timeout: float = OPENAI_RUN_TIMEOUT):
+        self.hedge_delay = hedge_delay
+        self.timeout = timeout
+        self._stats: dict[str, ModelStats] = {}
+
+    def stats(self, model: str) -> ModelStats:
+        if model not in self._stats:
+            self._stats[model] = ModelStats()
+        return self._stats[model]
+
+    def recent_p95(self, window_seconds: float) -> float | None:
+        """p95 латентности всех моделей за последние window_seconds (None — данных мало)"""
+        border = time.monotonic() - window_seconds
+        latencies = sorted(
+            latency
+            for stats in self._stats.values()
+            for at, latency, _ in stats.samples
+            if at >= border
+        )
+        if len(latencies) < MODEL_STATS_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def order_chain(self, chain: list[str]) -> list[str]:
+        """Здоровые модели — вперёд (с сохранением порядка), деградировавшие — в конец"""
+        healthy = [m for m in chain if self.stats(m).is_healthy()]
+        degraded = [m for m in chain if m not in healthy]
+        if degraded and healthy:
+            logging.warning(f"Model SLO breached: {degraded}, routing to {healthy[0]}")
+        return healthy + degraded
+
+    async def _attempt(
+        self, model: str, request: Callable[[str], Awaitable[T]], timeout: float, record: bool = True
+    ) -> T:
+        # Отменённый запрос (проигравший hedge, отмена вызывающего) не учитывается:
+        # его латентность неизвестна. Проигравшую основную модель учитывает _hedged
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(request(model), timeout=timeout)
+        except RETRYABLE_ERRORS:
+            if record:
+                self.stats(model).record(time.monotonic() - started, False)
+            raise
+        if record:
+            self.stats(model).record(time.monotonic() - started, True)
+        return result
+
+    async def call(
+        self, chain: list[str], request: Callable[[str], Awaitable[T]], hedge: bool = True, record: bool = True
+    ) -> tuple[T, str]:
+        """
+        Выполнить request(model) по цепочке моделей.
+        Возвращает (результат, модель, которая реально ответила).
+        Общий бюджет времени на все попытки — self.timeout.
+        hedge=False — без страхующих запросов, record=False — без учёта в статистике моделей
+        (отправка background-задач: второй запрос — вторая платная задача, а время отправки — не ответ модели).
+        """
+        models = self.order_chain(list(dict.fromkeys(chain)))
+        deadline = time.monotonic() + self.timeout
+        last_error: BaseException | None = None
+
+        i = 0
+        while i < len(models):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            model = models[i]
+            backup = models[i + 1] if hedge and i + 1 < len(models) else None
+
+            try:
+                if backup and self.hedge_delay > 0:
+                    return await self._hedged(model, backup, request, deadline)
+                return await self._attempt(model, request, remaining, record), model
+            except RETRYABLE_ERRORS as e:
+                last_error = e
+                logging.warning(f"Model {model} failed ({type(e).__name__}), trying next in chain")
+                # при hedging обе модели уже опробованы
+                i += 2 if backup and self.hedge_delay > 0 else 1
+
+        if isinstance(last_error, TimeoutError) or last_error is None:
+            raise TimeoutError(f"OpenAI не ответил за {int(self.timeout)} секунд")
+        raise last_error
+
+    async def _hedged(
+        self, model: str, backup: str, request: Callable[[str], Awaitable[T]], deadline: float
+    ) -> tuple[T, str]:
+        """
+        Основной запрос + страхующий запрос на backup через hedge_delay секунд.
+        Если основной упал раньше hedge_delay — backup запускается сразу
+        (call считает, что опробованы обе модели).
+        """
+        started = time.monotonic()
+        primary = asyncio.create_task(self._attempt(model, request, deadline - time.monotonic()))
+        secondary: asyncio.Task | None = None
+
+        # finally — и при отмене вызывающего: ни один запрос не остаётся висеть
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay)
+            if done:
+                error = primary.exception()
+                if not isinstance(error, RETRYABLE_ERRORS):
+                    return primary.result(), model
+                logging.warning(f"Model {model} failed ({type(error).__name__}) before hedge delay, trying {backup}")
+                return await self._attempt(backup, request, deadline - time.monotonic()), backup
+
+            logging.info(f"Hedging request: {model} slower than {self.hedge_delay}s, starting {backup}")
+            secondary = asyncio.create_task(self._attempt(backup, request, deadline - time.monotonic()))
+            tasks = {primary: model, secondary: backup}
+            pending = set(tasks)
+            last_error: BaseException | None = None
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if primary in pending:
+                            # Основная медленнее hedge_delay + ответа резервной — для SLO это промах
+                            self.stats(model).record(time.monotonic() - started, False)
+                        return task.result(), tasks[task]
+                    last_error = task.exception()
+
+            raise last_error
+        finally:
+            for task in (primary, secondary):
+                if task is not None and not task.done():
+                    task.cancel()
+
+
+router = ModelRouter()
@@ -38,79 +38,105 @@ async def get_or_create_thread(tg_id: int, assistant_id: str, session: AsyncSess
     return thread_id
 
 
-async def ask_assistant(tg_id, assistant_id, user_message, session):
-    # получаем или создаём thread
-    thread_id = await get_or_create_thread(tg_id, assistant_id, session)
+# Статусы run, при которых в thread нельзя добавлять сообщения
+ACTIVE_RUN_STATUSES = ("queued", "in_progress", "requires_action", "cancelling")
+TERMINAL_RUN_STATUSES = ("completed", "failed", "cancelled", "expired", "incomplete")
 
-    # === 1. Проверяем, есть ли активные run ===
-    active_runs = await client.beta.threads.runs.list(thread_id=thread_id)
-    for run in active_runs.data:
-        if run.status in ("queued", "in_progress", "requires_action"):
-            # ждём завершения
-            for _ in range(60):
-                run = await client.beta.threads.runs.retrieve(
-                    thread_id=thread_id,
-                    run_id=run.id
-                )
-                if run.status == "completed":
-                    break
-                await asyncio.sleep(1)
-
-            # если всё ещё активен — отменяем
-            if run.status not in ("completed", "failed", "cancelled"):
-                try:
-                    await client.beta.threads.runs.cancel(
-                        thread_id=thread_id, run_id=run.id
-                    )
-                except Exception as e:
-                    logging.warning(f"Failed to cancel run {run.id}: {e}")
-
-    # === 2. Теперь можно добавлять сообщение ===
-    await client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=[{"type": "text", "text": user_message}],
-    )
 
-    # === 3. Создаём новый run ===
-    run = await client.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=assistant_id,
-    )
+async def wait_for_run(thread_id: str, run_id: str, timeout: float):
+    """Ждать завершения run с растущим интервалом опроса (0.25с → 2с)"""
+    interval = 0.25
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
 
-    # === 4. Ждём выполнения с таймаутом ===
-    for _ in range(OPENAI_RUN_TIMEOUT):
-        run = await client.beta.threads.runs.retrieve(
-            thread_id=thread_id,
-            run_id=run.id,
-        )
-        if run.status == "completed":
-            break
-        if run.status in ("failed", "cancelled", "expired"):
-            raise RuntimeError(f"Run failed: {run.last_error}")
-        await asyncio.sleep(1)
-    else:
+    while True:
+        run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+        if run.status in TERMINAL_RUN_STATUSES or loop.time() >= deadline:
+            return run
+        await asyncio.sleep(min(interval, max(deadline - loop.time(), 0)))
+        interval = min(interval * 1.5, 2)
+
+
+async def cancel_active_runs(thread_id: str) -> None:
+    """Отменить зависшие run в thread (параллельно) и дождаться их остановки"""
+    runs = await client.beta.threads.runs.list(thread_id=thread_id, limit=5)
+    active = [run for run in runs.data if run.status in ACTIVE_RUN_STATUSES]
+    if not active:
+        return
+
+    async def cancel(run):
+        if run.status != "cancelling":
+            await cancel_run(thread_id, run.id)
+        await wait_for_run(thread_id, run.id, timeout=30)
+
+    await asyncio.gather(*(cancel(run) for run in active))
+
+
+async def cancel_run(thread_id: str, run_id: str) -> None:
+    try:
+        await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+    except Exception as e:
+        logging.warning(f"Failed to cancel run {run_id}: {e}")
+
+
+async def stream_run(thread_id: str, assistant_id: str, message: dict) -> str:
+    """
+    Создать run с сообщением пользователя и прочитать ответ из потока событий.
+    Сообщение передаётся через additional_messages — без отдельного messages.create.
+    Ответ — текст последнего сообщения run: промежуточные («Сейчас проанализирую
+    файл…») перед вызовом code_interpreter в него не попадают.
+    """
+    run_id = None
+    parts = []
+
+    try:
+        async with asyncio.timeout(OPENAI_RUN_TIMEOUT):
+            stream = await client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                additional_messages=[message],
+                stream=True,
+            )
+            # Выход из цикла по ошибке или таймауту закрывает HTTP-соединение потока
+            async with stream:
+                async for event in stream:
+                    if event.event == "thread.run.created":
+                        run_id = event.data.id
+                    elif event.event == "thread.message.completed":
+                        parts = [part.text.value for part in event.data.content if part.type == "text"]
+                    elif event.event == "thread.run.requires_action":
+                        # Функции ассистента бот не выполняет — без отмены run держал бы thread
+                        await cancel_run(thread_id, event.data.id)
+                        raise RuntimeError(f"Run requires action: {event.data.required_action}")
+                    elif event.event in ("thread.run.failed", "thread.run.cancelled",
+                                         "thread.run.expired", "thread.run.incomplete"):
+                        raise RuntimeError(f"Run failed: {event.data.last_error}")
+                    elif event.event == "error":
+                        raise RuntimeError(f"Run stream error: {event.data}")
+
+    except TimeoutError:
         # Таймаут — отменяем run
-        try:
-            await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-        except Exception as e:
-            logging.warning(f"Failed to cancel timed out run: {e}")
+        if run_id:
+            await cancel_run(thread_id, run_id)
         raise TimeoutError(f"OpenAI не ответил за {OPENAI_RUN_TIMEOUT} секунд")
 
-    # === 5. Получаем последний ответ ===
-    messages = await client.beta.threads.messages.list(
-        thread_id=thread_id,
-        limit=1,
-    )
+    return "\n".join(parts)
 
-    last_msg = messages.data[0]
-    parts = [
-        part.text.value for part in last_msg.content if part.type == "text"
-    ]
-    reply = "\n".join(parts) if parts else "Пустой ответ 🤷‍♂️"
 
-    return reply, thread_id
+async def ask_assistant(tg_id, assistant_id, user_message, session):
+    # получаем или создаём thread
+    thread_id = await get_or_create_thread(tg_id, assistant_id, session)
+
+    # === 1. Отменяем зависшие run, если есть ===
+    await cancel_active_runs(thread_id)
 
+    # === 2. Создаём run с сообщением и читаем поток событий ===
+    reply = await stream_run(thread_id, assistant_id, {
+        "role": "user",
+        "content": [{"type": "text", "text": user_message}],
+    })
+
+    return reply or "Пустой ответ 🤷‍♂️", thread_id
 
 
 async def ask_assistant_file(
@@ -125,80 +151,44 @@ async def ask_assistant_file(
     # 2. Определяем MIME тип
     mime, _ = mimetypes.guess_type(filepath)
 
-    # 3. Загружаем файл в OpenAI Files API
-    with open(filepath, "rb") as f:
-        file = await client.files.create(
-            file=f,
-            purpose="assistants"
-        )
+    # 3. Загружаем файл в OpenAI Files API (параллельно с отменой зависших run)
+    async def upload():
+        with open(filepath, "rb") as f:
+            return await client.files.create(
+                file=f,
+                purpose="assistants"
+            )
+
+    file, _ = await asyncio.gather(upload(), cancel_active_runs(thread_id))
 
     is_image = mime and mime.startswith("image/")
 
     # ------- Для изображений -------
     if is_image:
-        content = [
-            {"type": "text", "text": "Проанализируй изображение."},
-            {"type": "image_file", "image_file": {"file_id": file.id}}
-        ]
-
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=content
-        )
+        message = {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "Проанализируй изображение."},
+                {"type": "image_file", "image_file": {"file_id": file.id}}
+            ]
+        }
 
     # ------- Для документов -------
     else:
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=[{
+        message = {
+            "role": "user",
+            "content": [{
                 "type": "text",
                 "text": "Проанализируй прикреплённый файл."
             }],
-            attachments=[{
+            "attachments": [{
                 "file_id": file.id,
                 "tools": [{"type": "code_interpreter"}]
             }]
-        )
-
-    # 4. Запускаем ассистента
-    run = await client.beta.threads.runs.create(
-        thread_id=thread_id,
-        assistant_id=assistant_id
-    )
-
-    # 5. Ждём выполнения с таймаутом
-    for _ in range(OPENAI_RUN_TIMEOUT):
-        run = await client.beta.threads.runs.retrieve(
-            thread_id=thread_id,
-            run_id=run.id
-        )
-        if run.status == "completed":
-            break
-        if run.status in ("failed", "cancelled", "expired"):
-            raise RuntimeError(f"Assistant error: {run.last_error}")
-        await asyncio.sleep(1)
-    else:
-        # Таймаут — отменяем run
-        try:
-            await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
-        except Exception as e:
-            logging.warning(f"Failed to cancel timed out run: {e}")
-        raise TimeoutError(f"OpenAI не ответил за {OPENAI_RUN_TIMEOUT} секунд")
-
-    # 6. Читаем ответ
-    messages = await client.beta.threads.messages.list(
-        thread_id=thread_id,
-        limit=1
-    )
-
-    last_msg = messages.data[0]
+        }
 
-    reply = ""
-    for part in last_msg.content:
-        if part.type == "text":
-            reply += part.text.value
+    # 4. Запускаем ассистента и читаем ответ из потока
+    reply = await stream_run(thread_id, assistant_id, message)
 
     return reply, thread_id
 
@@ -3,15 +3,29 @@ OpenAI клиент на базе Responses API (замена Assistants API)
 Миграция в связи с deprecation Assistants API (август 2026)
 """
 from __future__ import annotations
+import asyncio
 import logging
+import time
+from datetime import datetime, timedelta
 import mimetypes
 import base64
-from openai import AsyncOpenAI
-from sqlalchemy import select
+from openai import AsyncOpenAI, BadRequestError, NotFoundError
+from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from config import OPENAI_API_KEY, OPENAI_RUN_TIMEOUT
-from database import Conversations
+from config import (
+    OPENAI_API_KEY, LOCAL_RETRIEVAL_MODE, COMPACT_INPUT_TOKENS, COMPACT_MODEL, CONTAINER_TTL, TOOL_CLASSIFIER,
+    INPUT_TOKEN_BUDGET, DEGRADED_MAX_OUTPUT_TOKENS
+)
+from database import session_maker, Conversations
+from model_router import router
+from local_retrieval import retrieve, format_context
+from metrics import timed, CONTAINER_LATENCY, FILE_SEARCH_LATENCY, ADMISSION_REQUESTS
+from tracing import span, set_attribute
+from analytics import add_tokens, add_estimate
+from tool_policy import ToolPolicy, DEFAULT_POLICY, needs_code_interpreter, wants_file_search, file_search_tool
+from admission import admission, TIER_NAMES, TIER_NO_TOOLS, TIER_CHEAP_MODEL, TIER_SHORT_OUTPUT
+from token_budget import preload, count_messages, truncate_tokens, truncation_notice, estimate_cost
 
 client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
@@ -364,6 +378,25 @@ ASSISTANT_MODELS = {
     "asst_K0TDVlaEvZHvh5bSxjz1iUCe": "gpt-4.1",      # Куратор WB (RAG)
 }
 
+# При перегрузке (уровень short_output) — вместе с ограничением max_output_tokens
+BRIEF_INSTRUCTION = "Сейчас высокая нагрузка: отвечай кратко, только самое главное."
+
+# Модель ассистента, которого нет в ASSISTANT_MODELS
+DEFAULT_MODEL = "gpt-4.1-mini"
+
+# Бюджет сообщения пользователя в токенах (остальные — INPUT_TOKEN_BUDGET)
+ASSISTANT_INPUT_BUDGETS = {
+    # RAG-ассистенты на gpt-4.1: к вопросу ещё добавляются фрагменты file_search
+    "asst_QfzzLwaL8JHcve4Y80IVKq9E": 2000,  # Ящик Пандоры
+    "asst_K0TDVlaEvZHvh5bSxjz1iUCe": 2000,  # Куратор WB
+}
+
+# Резервные модели (используются при нарушении SLO основной модели)
+ASSISTANT_MODEL_FALLBACKS = {
+    "asst_QfzzLwaL8JHcve4Y80IVKq9E": ["gpt-4.1-mini"],  # Ящик Пандоры (RAG)
+    "asst_K0TDVlaEvZHvh5bSxjz1iUCe": ["gpt-4.1-mini"],  # Куратор WB (RAG)
+}
+
 # Vector Stores для RAG-ассистентов
 ASSISTANT_VECTOR_STORES = {
     "asst_QfzzLwaL8JHcve4Y80IVKq9E": "vs_69401d7692488191a351f7474bb168b5",  # Ящик Пандоры
@@ -377,21 +410,128 @@ ASSISTANT_TOOLS = {
 }
 
 
+# Политики инструментов: когда искать по базе знаний и сколько фрагментов отдавать модели
+ASSISTANT_TOOL_POLICIES = {
+    # Ящик Пандоры: идеи и разборы — хватает нескольких самых релевантных фрагментов
+    "asst_QfzzLwaL8JHcve4Y80IVKq9E": ToolPolicy(max_num_results=6, score_threshold=0.3),
+    # Куратор WB: регламенты и оферта — ответ часто собирается из нескольких пунктов
+    "asst_K0TDVlaEvZHvh5bSxjz1iUCe": ToolPolicy(max_num_results=8, score_threshold=0.25),
+}
 
-async def get_last_response_id(tg_id: int, assistant_id: str, session: AsyncSession) -> str | None:
-    """Получить ID последнего ответа для продолжения диалога"""
+
+def live_container(conv: Conversations | None) -> str | None:
+    """Контейнер code_interpreter диалога, если он ещё не истёк"""
+    if conv is None or not conv.container_id or conv.container_expires_at is None:
+        return None
+    return conv.container_id if conv.container_expires_at > datetime.utcnow() else None
+
+
+def response_container_id(response) -> str | None:
+    """Контейнер, в котором выполнялся code_interpreter в этом ответе"""
+    for output in response.output or []:
+        if getattr(output, "type", None) == "code_interpreter_call" and getattr(output, "container_id", None):
+            return output.container_id
+    return None
+
+
+def build_tools(
+    assistant_id: str,
+    use_file_search: bool = True,
+    use_code_interpreter: bool = True,
+    container_id: str | None = None
+) -> list[dict]:
+    """Tools ассистента (file_search, code_interpreter) для Responses API"""
+    tools = []
+    vector_store_id = ASSISTANT_VECTOR_STORES.get(assistant_id)
+    if vector_store_id and use_file_search:
+        tools.append(file_search_tool(vector_store_id, ASSISTANT_TOOL_POLICIES.get(assistant_id, DEFAULT_POLICY)))
+
+    assistant_tools = ASSISTANT_TOOLS.get(assistant_id, [])
+    if "code_interpreter" in assistant_tools and use_code_interpreter:
+        tools.append({
+            "type": "code_interpreter",
+            # Живой контейнер — без холодного старта и с уже загруженными файлами
+            "container": container_id or {"type": "auto"}
+        })
+
+    return tools
+
+
+async def preload_tokenizers() -> None:
+    """Токенизаторы моделей ассистентов грузятся на старте, а не на первом запросе"""
+    await asyncio.to_thread(preload, [DEFAULT_MODEL, *ASSISTANT_MODELS.values()])
+
+
+def fit_input_budget(assistant_id: str, user_message: str, model: str) -> tuple[str, str | None]:
+    """Обрезать сообщение пользователя до бюджета ассистента. Возвращает (сообщение, уведомление или None)"""
+    budget = ASSISTANT_INPUT_BUDGETS.get(assistant_id, INPUT_TOKEN_BUDGET)
+    if budget <= 0:
+        return user_message, None
+    user_message, dropped = truncate_tokens(user_message, budget, model)
+    if not dropped:
+        return user_message, None
+    logging.info(f"User message to {assistant_id} truncated to {budget} tokens ({dropped} dropped)")
+    return user_message, truncation_notice(dropped)
+
+
+def estimate_input_tokens(input_messages: list[dict], model: str, conv: Conversations | None,
+                          previous_response_id: str | None) -> int:
+    """
+    Оценка input tokens запроса до сетевого вызова: новые сообщения плюс контекст цепочки
+    (размер входа прошлого хода). Фрагменты file_search заранее не известны.
+    """
+    tokens = count_messages(input_messages, model)
+    if previous_response_id and conv is not None and conv.input_tokens:
+        tokens += conv.input_tokens
+    return tokens
+
+
+async def get_conversation(tg_id: int, assistant_id: str, session: AsyncSession) -> Conversations | None:
     result = await session.execute(
         select(Conversations).where(
             Conversations.tg_id == tg_id,
             Conversations.assistant_id == assistant_id
         )
     )
-    conv = result.scalar_one_or_none()
+    return result.scalar_one_or_none()
+
+
+async def get_last_response_id(tg_id: int, assistant_id: str, session: AsyncSession) -> str | None:
+    """Получить ID последнего ответа для продолжения диалога"""
+    conv = await get_conversation(tg_id, assistant_id, session)
     return conv.last_response_id if conv else None
 
 
-async def save_response_id(tg_id: int, assistant_id: str, response_id: str, session: AsyncSession) -> None:
-    """Сохранить ID ответа для продолжения диалога"""
+def chain_start(conv: Conversations | None) -> tuple[str | None, str | None]:
+    """
+    Откуда продолжать диалог: (previous_response_id, резюме).
+    Резюме возвращается только для первого хода после сжатия — дальше оно уже в цепочке.
+    """
+    if conv is None:
+        return None, None
+    if conv.last_response_id:
+        return conv.last_response_id, None
+    return None, conv.summary
+
+
+def summary_message(summary: str) -> dict:
+    return {"role": "system", "content": f"Краткое содержание предыдущего диалога с пользователем:\n{summary}"}
+
+
+def response_input_tokens(response) -> int | None:
+    """Размер контекста запроса — по нему решаем, пора ли сжимать цепочку"""
+    return response.usage.input_tokens if response.usage else None
+
+
+async def save_response_id(
+    tg_id: int,
+    assistant_id: str,
+    response_id: str,
+    session: AsyncSession,
+    input_tokens: int | None = None,
+    container_id: str | None = None
+) -> None:
+    """Сохранить ID ответа (и контейнер code_interpreter, если он был) для продолжения диалога"""
     result = await session.execute(
         select(Conversations).where(
             Conversations.tg_id == tg_id,
@@ -402,60 +542,216 @@ async def save_response_id(tg_id: int, assistant_id: str, response_id: str, sess
 
     if conv:
         conv.last_response_id = response_id
+        conv.input_tokens = input_tokens
     else:
         conv = Conversations(
             tg_id=tg_id,
             assistant_id=assistant_id,
-            last_response_id=response_id
+            last_response_id=response_id,
+            input_tokens=input_tokens
         )
         session.add(conv)
 
+    if container_id:
+        # Контейнер живёт, пока им пользуются: каждое использование продлевает срок
+        conv.container_id = container_id
+        conv.container_expires_at = datetime.utcnow() + timedelta(seconds=CONTAINER_TTL)
+
     await session.commit()
 
+    if COMPACT_INPUT_TOKENS and input_tokens and input_tokens >= COMPACT_INPUT_TOKENS:
+        schedule_compaction(tg_id, assistant_id)
+
+
+async def advance_response_id(
+    tg_id: int,
+    assistant_id: str,
+    previous_response_id: str | None,
+    response_id: str,
+    session: AsyncSession,
+    input_tokens: int | None = None,
+    container_id: str | None = None
+) -> bool:
+    """
+    Продолжить цепочку ответом, запущенным от previous_response_id (background-задачи).
+
+    Условный UPDATE, как при сжатии: если пользователь успел продолжить диалог,
+    пока ответ готовился, цепочка не трогается. False — ответ в цепочку не попал.
+    """
+    conv = await get_conversation(tg_id, assistant_id, session)
+    if conv is None:
+        if previous_response_id is not None:
+            return False
+        await save_response_id(tg_id, assistant_id, response_id, session, input_tokens, container_id)
+        return True
+
+    values = {"last_response_id": response_id, "input_tokens": input_tokens}
+    if container_id:
+        values.update(container_id=container_id,
+                      container_expires_at=datetime.utcnow() + timedelta(seconds=CONTAINER_TTL))
+    same_chain = (
+        Conversations.last_response_id == previous_response_id if previous_response_id
+        else Conversations.last_response_id.is_(None)
+    )
+    result = await session.execute(
+        update(Conversations).where(Conversations.id == conv.id, same_chain).values(**values)
+    )
+    await session.commit()
+
+    if result.rowcount != 1:
+        return False
+    if COMPACT_INPUT_TOKENS and input_tokens and input_tokens >= COMPACT_INPUT_TOKENS:
+        schedule_compaction(tg_id, assistant_id)
+    return True
+
+
+def container_mode(tools: list[dict] | None) -> str:
+    """none — без code_interpreter, new — новый контейнер, reused — живой контейнер диалога"""
+    for tool in tools or []:
+        if tool["type"] == "code_interpreter":
+            return "reused" if isinstance(tool["container"], str) else "new"
+    return "none"
+
+
+def model_chain(assistant_id: str, tier: int) -> list[str]:
+    """Цепочка моделей ассистента; при перегрузке (cheap_model) резервные модели — первыми"""
+    primary = ASSISTANT_MODELS.get(assistant_id, DEFAULT_MODEL)
+    fallbacks = ASSISTANT_MODEL_FALLBACKS.get(assistant_id, [])
+    return fallbacks + [primary] if tier >= TIER_CHEAP_MODEL else [primary] + fallbacks
+
+
+def expected_model(assistant_id: str) -> str:
+    """Модель, которая скорее всего ответит сейчас (первая здоровая в цепочке)"""
+    chain = model_chain(assistant_id, min(admission.tier(), TIER_SHORT_OUTPUT))
+    return next((model for model in chain if router.stats(model).is_healthy()), chain[0])
+
+
+@timed("openai", model=lambda result: result[1])
+async def create_response(assistant_id: str, request_params: dict):
+    """
+    Вызвать Responses API через роутер моделей.
+    Возвращает (response, модель, которая реально ответила)
+    """
+    primary = ASSISTANT_MODELS.get(assistant_id, DEFAULT_MODEL)
+
+    # Перегрузка: сначала резервная модель, короткий ответ (уже принятый запрос не отклоняется)
+    tier = min(admission.tier(), TIER_SHORT_OUTPUT)
+    ADMISSION_REQUESTS.labels(TIER_NAMES[tier]).inc()
+    set_attribute("admission_tier", TIER_NAMES[tier])
+    chain = model_chain(assistant_id, tier)
+    if tier >= TIER_SHORT_OUTPUT:
+        request_params = {**request_params, "max_output_tokens": DEGRADED_MAX_OUTPUT_TOKENS}
+
+    async def request(model: str):
+        try:
+            return await client.responses.create(**{**request_params, "model": model})
+        except (BadRequestError, NotFoundError) as e:
+            # Контейнер истёк раньше, чем мы думали — повторяем с новым
+            if container != "reused" or "container" not in str(e).lower():
+                raise
+            logging.info(f"Container expired for {assistant_id}, retrying with a new one: {e}")
+            tools = [
+                {**tool, "container": {"type": "auto"}} if tool["type"] == "code_interpreter" else tool
+                for tool in request_params["tools"]
+            ]
+            return await client.responses.create(**{**request_params, "tools": tools, "model": model})
+
+    container = container_mode(request_params.get("tools"))
+    set_attribute("container", container)
+    file_search = any(tool["type"] == "file_search" for tool in request_params.get("tools") or [])
+    set_attribute("file_search", file_search)
+    started = time.perf_counter()
+    background = bool(request_params.get("background"))
+    response, model_used = await router.call(chain, request, hedge=not background, record=not background)
+    if not background:
+        elapsed = time.perf_counter() - started
+        CONTAINER_LATENCY.labels(assistant_id, container).observe(elapsed)
+        FILE_SEARCH_LATENCY.labels(assistant_id, "on" if file_search else "off").observe(elapsed)
+    set_attribute("openai_response_id", response.id)
+    set_attribute("model", model_used)
+    add_tokens(response.usage, model_used)
+    if model_used != primary:
+        logging.info(f"Assistant {assistant_id} answered by fallback model {model_used}")
+    return response, model_used
+
 
 async def ask_assistant_v2(
     tg_id: int,
     assistant_id: str,
     user_message: str,
     session: AsyncSession
-) -> tuple[str, str]:
+) -> tuple[str, str, str]:
     """
     Отправить сообщение ассистенту через Responses API.
-    Возвращает (ответ, response_id)
+    Возвращает (ответ, response_id, модель)
     """
-    # Получаем инструкции и модель
+    # Получаем инструкции
     instructions = ASSISTANT_INSTRUCTIONS.get(assistant_id, "Ты — полезный ассистент.")
-    model = ASSISTANT_MODELS.get(assistant_id, "gpt-4.1-mini")
-
-    # Получаем ID предыдущего ответа для продолжения диалога
-    previous_response_id = await get_last_response_id(tg_id, assistant_id, session)
-
-    # Формируем tools (file_search, code_interpreter) если нужно
-    tools = []
-    vector_store_id = ASSISTANT_VECTOR_STORES.get(assistant_id)
-    if vector_store_id:
-        tools.append({
-            "type": "file_search",
-            "vector_store_ids": [vector_store_id]
-        })
-
-    assistant_tools = ASSISTANT_TOOLS.get(assistant_id, [])
-    if "code_interpreter" in assistant_tools:
-        tools.append({
-            "type": "code_interpreter",
-            "container": {"type": "auto"}
-        })
+    model = ASSISTANT_MODELS.get(assistant_id, DEFAULT_MODEL)
+
+    # Огромная вставка не уходит в запрос целиком
+    user_message, notice = fit_input_budget(assistant_id, user_message, model)
+
+    # Продолжение диалога: предыдущий ответ или резюме сжатой цепочки
+    conv = await get_conversation(tg_id, assistant_id, session)
+    previous_response_id, summary = chain_start(conv)
+    container_id = live_container(conv)
+
+    # При перегрузке необязательные инструменты отключаются (admission.py)
+    tier = min(admission.tier(), TIER_SHORT_OUTPUT)
+    if tier >= TIER_SHORT_OUTPUT:
+        instructions = f"{instructions}\n\n{BRIEF_INSTRUCTION}"
+
+    # «Спасибо» и короткие ответы на уточняющий вопрос обходятся без поиска по базе знаний
+    policy = ASSISTANT_TOOL_POLICIES.get(assistant_id, DEFAULT_POLICY)
+    search = wants_file_search(policy, user_message, TOOL_CLASSIFIER or tier >= TIER_NO_TOOLS)
+
+    # Локальный поиск по базе знаний (LOCAL_RETRIEVAL_MODE)
+    knowledge = None
+    if search and LOCAL_RETRIEVAL_MODE != "off" and assistant_id in ASSISTANT_VECTOR_STORES:
+        try:
+            with span("local_retrieval"):
+                found = await retrieve(assistant_id, user_message)
+        except Exception as e:
+            logging.warning(f"Local retrieval failed, falling back to file_search: {e}")
+            found = None
+        if found is not None:
+            # Нерелевантный вопрос — file_search не нужен ни в одном из режимов
+            search = found.relevant and LOCAL_RETRIEVAL_MODE == "prefilter"
+            if found.relevant and LOCAL_RETRIEVAL_MODE == "replace":
+                knowledge = format_context(found.chunks)
+
+    tools = build_tools(
+        assistant_id,
+        search,
+        # Живой контейнер оставляем и при перегрузке: в нём файлы и расчёты пользователя
+        use_code_interpreter=(
+            bool(container_id) if tier >= TIER_NO_TOOLS else needs_code_interpreter(user_message, container_id)
+        ),
+        container_id=container_id
+    )
 
     # Формируем запрос
     input_messages = [
         {"role": "system", "content": instructions},
         {"role": "user", "content": user_message}
     ]
+    if knowledge:
+        input_messages.insert(1, {"role": "system", "content": knowledge})
+    if summary:
+        input_messages.insert(1, summary_message(summary))
+
+    # Оценка входа и стоимости до сетевого вызова; в request_log — рядом с фактическими токенами
+    estimated = estimate_input_tokens(input_messages, model, conv, previous_response_id)
+    cost = estimate_cost(model, estimated)
+    add_estimate(estimated)
+    set_attribute("estimated_input_tokens", estimated)
+    if cost is not None:
+        set_attribute("estimated_input_cost", round(cost, 6))
 
     try:
-        # Вызываем Responses API
+        # Параметры запроса (модель выбирает роутер)
         request_params = {
-            "model": model,
             "input": input_messages,
         }
 
@@ -465,134 +761,158 @@ async def ask_assistant_v2(
         if previous_response_id:
             request_params["previous_response_id"] = previous_response_id
 
-        response = await client.responses.create(**request_params)
+        # Вызываем Responses API
+        response, model_used = await create_response(assistant_id, request_params)
 
         # Извлекаем текст ответа
-        reply = ""
-        for output in response.output:
-            if hasattr(output, 'content'):
-                for content in output.content:
-                    if hasattr(content, 'text'):
-                        reply += content.text
-
-        if not reply:
-            reply = "Пустой ответ 🤷‍♂️"
+        reply = extract_reply_text(response)
+        if notice:
+            reply = f"{notice}\n\n{reply}"
 
         # Сохраняем response_id для продолжения диалога
-        await save_response_id(tg_id, assistant_id, response.id, session)
+        await save_response_id(tg_id, assistant_id, response.id, session,
+                               response_input_tokens(response), response_container_id(response))
 
-        return reply, response.id
+        return reply, response.id, model_used
 
     except Exception as e:
         logging.error(f"Responses API error: {type(e).__name__}: {e}")
         raise
 
 
-async def ask_assistant_file_v2(
+async def build_file_request(
     tg_id: int,
     assistant_id: str,
     filepath: str,
     session: AsyncSession
-) -> tuple[str, str]:
-    """
-    Отправить файл ассистенту через Responses API.
-    Возвращает (ответ, response_id)
-    """
+) -> dict:
+    """Сформировать параметры запроса Responses API для анализа файла"""
     # Определяем MIME тип
     mime, _ = mimetypes.guess_type(filepath)
     is_image = mime and mime.startswith("image/")
 
     instructions = ASSISTANT_INSTRUCTIONS.get(assistant_id, "Ты — полезный ассистент.")
-    model = ASSISTANT_MODELS.get(assistant_id, "gpt-4.1-mini")
 
-    previous_response_id = await get_last_response_id(tg_id, assistant_id, session)
+    conv = await get_conversation(tg_id, assistant_id, session)
+    previous_response_id, summary = chain_start(conv)
+
+    # С файлом code_interpreter нужен всегда; живой контейнер — без холодного старта
+    tools = build_tools(assistant_id, container_id=live_container(conv))
+
+    if is_image:
+        # Для изображений — используем base64
+        with open(filepath, "rb") as f:
+            image_data = base64.b64encode(f.read()).decode("utf-8")
+
+        input_messages = [
+            {"role": "system", "content": instructions},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": "Проанализируй это изображение."},
+                    {
+                        "type": "input_image",
+                        "image_url": f"data:{mime};base64,{image_data}"
+                    }
+                ]
+            }
+        ]
+    else:
+        # Для документов — загружаем файл
+        with open(filepath, "rb") as f:
+            file = await client.files.create(file=f, purpose="assistants")
 
-    # Формируем tools (file_search, code_interpreter) если нужно
-    tools = []
-    vector_store_id = ASSISTANT_VECTOR_STORES.get(assistant_id)
-    if vector_store_id:
-        tools.append({
-            "type": "file_search",
-            "vector_store_ids": [vector_store_id]
-        })
+        input_messages = [
+            {"role": "system", "content": instructions},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "input_text", "text": "Проанализируй прикреплённый файл."},
+                    {"type": "input_file", "file_id": file.id}
+                ]
+            }
+        ]
 
-    assistant_tools = ASSISTANT_TOOLS.get(assistant_id, [])
-    if "code_interpreter" in assistant_tools:
-        tools.append({
-            "type": "code_interpreter",
-            "container": {"type": "auto"}
-        })
+    if summary:
+        input_messages.insert(1, summary_message(summary))
 
-    try:
-        if is_image:
-            # Для изображений — используем base64
-            with open(filepath, "rb") as f:
-                image_data = base64.b64encode(f.read()).decode("utf-8")
-
-            input_messages = [
-                {"role": "system", "content": instructions},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": "Проанализируй это изображение."},
-                        {
-                            "type": "input_image",
-                            "image_url": f"data:{mime};base64,{image_data}"
-                        }
-                    ]
-                }
-            ]
-        else:
-            # Для документов — загружаем файл
-            with open(filepath, "rb") as f:
-                file = await client.files.create(file=f, purpose="assistants")
-
-            input_messages = [
-                {"role": "system", "content": instructions},
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "input_text", "text": "Проанализируй прикреплённый файл."},
-                        {"type": "input_file", "file_id": file.id}
-                    ]
-                }
-            ]
+    # Формируем параметры запроса (модель выбирает роутер)
+    request_params = {
+        "input": input_messages,
+    }
 
-        # Формируем параметры запроса
-        request_params = {
-            "model": model,
-            "input": input_messages,
-        }
+    if tools:
+        request_params["tools"] = tools
 
-        if tools:
-            request_params["tools"] = tools
+    if previous_response_id:
+        request_params["previous_response_id"] = previous_response_id
 
-        if previous_response_id:
-            request_params["previous_response_id"] = previous_response_id
+    return request_params
 
-        # Вызываем Responses API
-        response = await client.responses.create(**request_params)
 
-        # Извлекаем текст ответа
-        reply = ""
-        for output in response.output:
-            if hasattr(output, 'content'):
-                for content in output.content:
-                    if hasattr(content, 'text'):
-                        reply += content.text
+def extract_reply_text(response) -> str:
+    """Извлечь текст ответа из response.output"""
+    reply = ""
+    for output in response.output or []:
+        if hasattr(output, 'content'):
+            for content in output.content:
+                if hasattr(content, 'text'):
+                    reply += content.text
 
-        if not reply:
-            reply = "Пустой ответ 🤷‍♂️"
+    return reply or "Пустой ответ 🤷‍♂️"
 
-        await save_response_id(tg_id, assistant_id, response.id, session)
 
-        return reply, response.id
+async def ask_assistant_file_v2(
+    tg_id: int,
+    assistant_id: str,
+    filepath: str,
+    session: AsyncSession
+) -> tuple[str, str, str]:
+    """
+    Отправить файл ассистенту через Responses API.
+    Возвращает (ответ, response_id, модель)
+    """
+    try:
+        request_params = await build_file_request(tg_id, assistant_id, filepath, session)
+
+        # Вызываем Responses API
+        response, model_used = await create_response(assistant_id, request_params)
+
+        reply = extract_reply_text(response)
+
+        await save_response_id(tg_id, assistant_id, response.id, session,
+                               response_input_tokens(response), response_container_id(response))
+
+        return reply, response.id, model_used
 
     except Exception as e:
         logging.error(f"Responses API file error: {type(e).__name__}: {e}")
         raise
 
 
+async def submit_file_job_v2(
+    tg_id: int,
+    assistant_id: str,
+    filepath: str,
+    session: AsyncSession
+) -> tuple[str, str, str | None]:
+    """
+    Запустить анализ файла в background-режиме Responses API.
+    Возвращает (response_id, модель, previous_response_id). Результат забирает поллер background_jobs.
+    """
+    try:
+        request_params = await build_file_request(tg_id, assistant_id, filepath, session)
+        request_params["background"] = True
+
+        response, model_used = await create_response(assistant_id, request_params)
+
+        return response.id, model_used, request_params.get("previous_response_id")
+
+    except Exception as e:
+        logging.error(f"Responses API background submit error: {type(e).__name__}: {e}")
+        raise
+
+
 async def get_conversation_history_v2(
     tg_id: int,
     assistant_id: str,
@@ -602,9 +922,19 @@ async def get_conversation_history_v2(
     """
     Получить историю диалога через Responses API.
     """
-    last_response_id = await get_last_response_id(tg_id, assistant_id, session)
+    conv = await get_conversation(tg_id, assistant_id, session)
+    return await fetch_history(conv, limit)
+
+
+@timed("openai_history")
+async def fetch_history(conv: Conversations | None, limit: int = 5) -> list[dict]:
+    """История диалога по последнему ответу (сетевой responses.retrieve)"""
+    last_response_id = conv.last_response_id if conv else None
 
     if not last_response_id:
+        # Сразу после сжатия цепочки от диалога осталось только резюме
+        if conv and conv.summary:
+            return [{"role": "assistant", "text": f"Краткое содержание диалога:\n{conv.summary}"}]
         return []
 
     try:
@@ -655,4 +985,82 @@ async def reset_conversation_v2(tg_id: int, assistant_id: str, session: AsyncSes
 
     if conv:
         conv.last_response_id = None
+        conv.input_tokens = None
+        conv.summary = None
+        conv.container_id = None
+        conv.container_expires_at = None
+        await session.commit()
+
+
+# ======================================================
+#                   СЖАТИЕ ДЛИННЫХ ДИАЛОГОВ
+# ======================================================
+COMPACT_PROMPT = (
+    "Сожми весь диалог выше в резюме для продолжения работы: задача пользователя, данные о его "
+    "товаре и аудитории, принятые решения, готовые результаты (промпты, ключевые слова, сценарии — "
+    "дословно, если они понадобятся дальше) и открытые вопросы. Не добавляй ничего от себя. "
+    "Пиши на языке диалога, без вступлений."
+)
+
+_compactions: dict[tuple[int, str], asyncio.Task] = {}
+
+
+def schedule_compaction(tg_id: int, assistant_id: str) -> None:
+    """Сжать диалог в фоне — пользователь получает ответ без задержки"""
+    key = (tg_id, assistant_id)
+    if key in _compactions:
+        return
+    task = asyncio.create_task(compact_conversation(tg_id, assistant_id))
+    _compactions[key] = task
+    task.add_done_callback(lambda _: _compactions.pop(key, None))
+
+
+@timed("compaction")
+async def compact_conversation(tg_id: int, assistant_id: str) -> bool:
+    """
+    Заменить длинную цепочку previous_response_id резюме.
+
+    Следующий ход начинает новую цепочку с резюме вместо всей истории.
+    Conversations обновляется одним условным UPDATE: если пользователь успел
+    продолжить диалог, пока строилось резюме, сжатие отбрасывается
+    (и повторится после следующего хода).
+    """
+    async with session_maker() as session:
+        conv = await get_conversation(tg_id, assistant_id, session)
+    if conv is None or not conv.last_response_id or (conv.input_tokens or 0) < COMPACT_INPUT_TOKENS:
+        return False
+
+    response_id = conv.last_response_id
+    try:
+        response = await client.responses.create(
+            model=COMPACT_MODEL,
+            previous_response_id=response_id,
+            input=[{"role": "user", "content": COMPACT_PROMPT}],
+            store=False
+        )
+    except Exception as e:
+        logging.warning(f"Failed to compact conversation of user {tg_id} with {assistant_id}: {e}")
+        return False
+
+    summary = "".join(
+        content.text
+        for output in response.output or []
+        for content in getattr(output, "content", None) or []
+        if hasattr(content, "text")
+    ).strip()
+    if not summary:
+        return False
+
+    async with session_maker() as session:
+        result = await session.execute(
+            update(Conversations)
+            .where(Conversations.id == conv.id, Conversations.last_response_id == response_id)
+            .values(last_response_id=None, summary=summary, input_tokens=None)
+        )
         await session.commit()
+
+    compacted = result.rowcount == 1
+    if compacted:
+        logging.info(f"Compacted conversation of user {tg_id} with {assistant_id}: "
+                     f"{conv.input_tokens} input tokens -> {len(summary)} chars summary")
+    return compacted
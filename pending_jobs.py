@@ -0,0 +1,124 @@
+"""
+Запросы к ассистентам в работе и их судьба при остановке бота.
+
+Без очереди задач (QUEUE_MODE=false) запрос выполняется прямо в хэндлере,
+и редеплой убивал его уже после списания лимита, оставляя «думает...».
+Теперь on_shutdown (polling к этому моменту остановлен — новых апдейтов нет):
+
+    1. ждёт до SHUTDOWN_DRAIN_TIMEOUT, пока запросы в работе ответят и доставятся;
+    2. оставшиеся отменяет и записывает в pending_jobs.
+
+Следующий процесс на старте забирает pending_jobs: свежие выполняет заново
+без повторного списания, старше PENDING_JOB_MAX_AGE — возвращает в дневной
+лимит и сообщает пользователю (resume_pending_jobs в assistant_service.py).
+
+В QUEUE_MODE задачи и так лежат в task_queue до завершения.
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import json
+import logging
+from dataclasses import dataclass, field
+from datetime import date, datetime
+
+from sqlalchemy import select, delete
+
+from database import session_maker, PendingJobs
+
+
+@dataclass
+class InFlightJob:
+    tg_id: int
+    chat_id: int
+    assistant_id: str
+    kind: str  # text / file
+    payload: dict
+    loading_message_id: int | None
+    charged_on: date | None = None  # день списания (повторно выполняемый запрос уже списан)
+    started_at: datetime = field(default_factory=datetime.utcnow)
+    finished: bool = False
+
+
+class InFlight:
+    """Реестр запросов к ассистентам, выполняющихся в этом процессе"""
+
+    def __init__(self):
+        self._jobs: dict[asyncio.Task, InFlightJob] = {}
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    @contextlib.contextmanager
+    def track(self, job: InFlightJob):
+        """Учитывать запрос, пока выполняется блок (ответ доставлен — блок завершился без исключения)"""
+        task = asyncio.current_task()
+        self._jobs[task] = job
+        try:
+            yield job
+            job.finished = True
+        finally:
+            self._jobs.pop(task, None)
+
+    def mark_charged(self) -> None:
+        """Запрос текущей задачи списан из дневного лимита"""
+        job = self._jobs.get(asyncio.current_task())
+        if job is not None:
+            job.charged_on = date.today()
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Дождаться запросов в работе (не дольше timeout), незавершённые отменить
+        и сохранить в pending_jobs. Возвращает число сохранённых.
+        """
+        if self._jobs:
+            logging.info(f"Draining {len(self._jobs)} in-flight requests (up to {timeout:g}s)")
+            await asyncio.wait(set(self._jobs), timeout=timeout)
+
+        jobs = dict(self._jobs)
+        if not jobs:
+            return 0
+
+        for task in jobs:
+            task.cancel()
+        await asyncio.gather(*jobs, return_exceptions=True)
+
+        # Доставленные в последний момент не сохраняем — иначе пользователь получит ответ дважды
+        unfinished = [job for job in jobs.values() if not job.finished]
+        await save_pending(unfinished)
+        logging.warning(f"Saved {len(unfinished)} unfinished requests to pending_jobs")
+        return len(unfinished)
+
+
+async def save_pending(jobs: list[InFlightJob]) -> None:
+    async with session_maker() as session:
+        session.add_all(
+            PendingJobs(
+                tg_id=job.tg_id,
+                chat_id=job.chat_id,
+                assistant_id=job.assistant_id,
+                kind=job.kind,
+                payload=json.dumps(job.payload, ensure_ascii=False),
+                loading_message_id=job.loading_message_id,
+                charged_on=job.charged_on,
+                started_at=job.started_at
+            )
+            for job in jobs
+        )
+        await session.commit()
+
+
+async def claim_pending() -> list[PendingJobs]:
+    """Забрать прерванные запросы (строка удаляется — при нескольких репликах её получит одна)"""
+    claimed = []
+    async with session_maker() as session:
+        result = await session.execute(select(PendingJobs).order_by(PendingJobs.id))
+        for job in result.scalars().all():
+            deleted = await session.execute(delete(PendingJobs).where(PendingJobs.id == job.id))
+            await session.commit()
+            if deleted.rowcount == 1:
+                claimed.append(job)
+    return claimed
+
+
+in_flight = InFlight()
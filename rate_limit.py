@@ -1,15 +1,26 @@
 from __future__ import annotations
 from datetime import date
-from sqlalchemy import select
+from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from config import DAILY_REQUEST_LIMIT, RATE_LIMIT_WARNING_THRESHOLD
+from config import DAILY_REQUEST_LIMIT, RATE_LIMIT_WARNING_THRESHOLD, QUEUE_MODE
 from database import UsageLog
+from cache import usage_cache, MISSING
+from coordination import user_lock, invalidate, LOCK_USAGE, IS_POSTGRES
+from metrics import timed, RATE_LIMIT_DENIALS
+
+# На SQLite инвалидация только локальная, а в QUEUE_MODE запросы списывают воркеры
+# в других процессах — кэш бота отставал бы от них, и пачка сообщений проходила бы лимит
+USE_USAGE_CACHE = IS_POSTGRES or not QUEUE_MODE
 
 
 async def get_usage_count(tg_id: int, session: AsyncSession) -> int:
     """Получить количество запросов пользователя за сегодня"""
     today = date.today()
+    cached = usage_cache.get(tg_id) if USE_USAGE_CACHE else MISSING
+    if cached is not MISSING and cached[0] == today:
+        return cached[1]
+
     result = await session.execute(
         select(UsageLog).where(
             UsageLog.tg_id == tg_id,
@@ -17,30 +28,53 @@ async def get_usage_count(tg_id: int, session: AsyncSession) -> int:
         )
     )
     usage = result.scalar_one_or_none()
-    return usage.request_count if usage else 0
+    count = usage.request_count if usage else 0
+    usage_cache.set(tg_id, (today, count))
+    return count
 
 
 async def increment_usage(tg_id: int, session: AsyncSession) -> int:
     """Увеличить счётчик запросов и вернуть новое значение"""
     today = date.today()
-    result = await session.execute(
-        select(UsageLog).where(
-            UsageLog.tg_id == tg_id,
-            UsageLog.usage_date == today
+
+    # Блокировка пользователя — чтобы реплики не создали две строки на один день
+    async with user_lock(tg_id, session, namespace=LOCK_USAGE):
+        result = await session.execute(
+            update(UsageLog)
+            .where(UsageLog.tg_id == tg_id, UsageLog.usage_date == today)
+            .values(request_count=UsageLog.request_count + 1)
         )
-    )
-    usage = result.scalar_one_or_none()
+        if result.rowcount == 0:
+            session.add(UsageLog(tg_id=tg_id, usage_date=today, request_count=1))
+            await session.flush()
+
+        count = (await session.execute(
+            select(UsageLog.request_count).where(
+                UsageLog.tg_id == tg_id,
+                UsageLog.usage_date == today
+            )
+        )).scalar_one()
 
-    if usage:
-        usage.request_count += 1
-    else:
-        usage = UsageLog(tg_id=tg_id, usage_date=today, request_count=1)
-        session.add(usage)
+        await invalidate("usage", tg_id, session)
+        await session.commit()
 
+    usage_cache.set(tg_id, (today, count))
+    return count
+
+
+async def refund_usage(tg_id: int, usage_date: date, session: AsyncSession) -> None:
+    """Вернуть списанный запрос (запрос не был выполнен)"""
+    await session.execute(
+        update(UsageLog)
+        .where(UsageLog.tg_id == tg_id, UsageLog.usage_date == usage_date, UsageLog.request_count > 0)
+        .values(request_count=UsageLog.request_count - 1)
+    )
+    await invalidate("usage", tg_id, session)
     await session.commit()
-    return usage.request_count
+    usage_cache.invalidate(tg_id)
 
 
+@timed("db_rate_limit")
 async def check_rate_limit(tg_id: int, session: AsyncSession) -> tuple[bool, int, str | None]:
     """
     Проверить лимит запросов.
@@ -53,6 +87,7 @@ async def check_rate_limit(tg_id: int, session: AsyncSession) -> tuple[bool, int
     current_count = await get_usage_count(tg_id, session)
 
     if current_count >= DAILY_REQUEST_LIMIT:
+        RATE_LIMIT_DENIALS.inc()
         return False, current_count, None
 
     warning_message = None
@@ -0,0 +1,113 @@
+"""
+Воспроизведение записанного трафика (capture.py) против бота с заглушками
+Telegram и OpenAI (fake_servers.py).
+
+Апдейты подаются в dp.feed_update с исходными интервалами между ними,
+делёнными на --speed (0 — без пауз, максимально быстро). Задержки и ошибки
+заглушки OpenAI задаются как в bench_load.py и фиксируются --seed,
+поэтому прогоны до и после изменения сравнимы.
+
+Запуск:
+    python replay.py captured_updates.jsonl --speed 10 --save before
+    python replay.py captured_updates.jsonl --speed 10 --compare before
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+from bench_load import start_stubs, bot_under_test, wait_queue_empty, summarize, print_report, \
+    load_baseline, save_baseline, telegram_calls, openai_calls
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика")
+    parser.add_argument("capture", help="JSONL, записанный CaptureMiddleware")
+    parser.add_argument("--speed", type=float, default=1.0, help="Ускорение (1 — реальное время, 0 — без пауз)")
+    parser.add_argument("--limit", type=int, help="Воспроизвести только первые N апдейтов")
+    parser.add_argument("--latency", type=float, default=0.5, help="Медиана задержки OpenAI, секунды")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--input-tokens", type=int, default=1500)
+    parser.add_argument("--output-tokens", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--container-cold-start", type=float, default=0.0)
+    parser.add_argument("--file-search-latency", type=float, default=0.0)
+    parser.add_argument("--slow-start", type=float, default=0.0)
+    parser.add_argument("--slow-duration", type=float, default=0.0)
+    parser.add_argument("--slow-factor", type=float, default=1.0)
+    parser.add_argument("--admission-p95", type=float)
+    parser.add_argument("--admission-max-in-flight", type=int)
+    parser.add_argument("--admission-window", type=float)
+    parser.add_argument("--admission-cooldown", type=float)
+    parser.add_argument("--queue", action="store_true", help="Режим очереди: воркер в этом же процессе")
+    parser.add_argument("--loading-mode", choices=("message", "edit", "action"), default="edit",
+                        help="Индикатор загрузки (LOADING_MODE)")
+    parser.add_argument("--db-url", help="БД бота (по умолчанию — временная SQLite)")
+    parser.add_argument("--save", metavar="NAME", help="Сохранить результат как baseline")
+    parser.add_argument("--compare", metavar="NAME", help="Сравнить с сохранённым baseline")
+    return parser.parse_args()
+
+
+def load_capture(path: str, limit: int | None) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda r: r["ts"])
+    return records[:limit] if limit else records
+
+
+async def replay(args: argparse.Namespace, records: list[dict]) -> dict:
+    from aiogram.types import Update
+
+    updates = [Update.model_validate(r["update"]) for r in records]
+    offsets = [r["ts"] - records[0]["ts"] for r in records]
+    span = offsets[-1]
+
+    print(f"▶️ Апдейтов: {len(updates)}, длительность записи: {span:.0f}s, ускорение: "
+          f"{'без пауз' if not args.speed else f'{args.speed}x'}")
+
+    async with bot_under_test(args) as (dp, bot, collector):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tasks = []
+
+        for update, offset in zip(updates, offsets):
+            if args.speed:
+                delay = started + offset / args.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # Как при polling: апдейты обрабатываются конкурентно, по мере поступления
+            tasks.append(asyncio.create_task(dp.feed_update(bot, update)))
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        if args.queue:
+            await wait_queue_empty()
+        elapsed = loop.time() - started
+        calls, openai = await telegram_calls(), await openai_calls()
+
+    failed = [r for r in results if isinstance(r, Exception)]
+    if failed:
+        print(f"⚠️ Апдейтов с ошибкой: {len(failed)} (первая: {type(failed[0]).__name__}: {failed[0]})")
+
+    return summarize(args, collector, len(updates), elapsed, calls, openai)
+
+
+def main() -> None:
+    args = parse_args()
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        sys.exit("Запись пуста")
+    baseline = load_baseline(args.compare)
+
+    stubs = start_stubs(args)
+    try:
+        result = asyncio.run(replay(args, records))
+    finally:
+        stubs.terminate()
+
+    print_report(result, baseline)
+    if args.save:
+        save_baseline(args.save, result)
+
+
+if __name__ == "__main__":
+    main()
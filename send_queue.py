@@ -0,0 +1,270 @@
+"""
+Очередь исходящих запросов к Telegram с учётом flood control.
+
+Все методы отправки (sendMessage, editMessageText, deleteMessage, ...) проходят
+через request-middleware сессии бота и попадают в очередь:
+
+    - общий token bucket: SEND_GLOBAL_RATE — лимит бота целиком, он делится поровну
+      между SEND_PROCESSES процессами (бот и воркеры QUEUE_MODE отправляют сами);
+    - token bucket на чат (SEND_CHAT_RATE в секунду, всплеск до SEND_CHAT_BURST);
+    - в один чат одновременно уходит только один запрос — порядок сохраняется;
+    - 429 (retry_after): чат ставится на паузу, запрос повторяется;
+    - несколько ожидающих editMessageText одного сообщения схлопываются в последний;
+    - приоритеты: ответы на callback и ответы ассистента раньше индикаторов загрузки,
+      рассылка (broadcast.py) — после всего остального.
+
+Приоритет задаётся контекстом: with send_priority(PRIORITY_LOADING): await message.answer(...)
+"""
+from __future__ import annotations
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import SEND_GLOBAL_RATE, SEND_PROCESSES, SEND_CHAT_RATE, SEND_CHAT_BURST
+
+PRIORITY_CALLBACK = 0   # answerCallbackQuery — у Telegram таймаут на ответ
+PRIORITY_REPLY = 1      # ответы ассистента и обычные сообщения
+PRIORITY_EDIT = 2       # правки сообщений
+PRIORITY_LOADING = 3    # «думает...», удаление индикаторов, chat action
+PRIORITY_BROADCAST = 4  # рассылка — только остаток лимита после живого трафика
+
+# Методы, которые идут через очередь; остальные (getUpdates, getFile, getChatMember) — напрямую
+QUEUED_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "sendChatAction",
+    "editMessageText", "editMessageReplyMarkup", "deleteMessage", "answerCallbackQuery",
+}
+DEFAULT_PRIORITIES = {
+    "answerCallbackQuery": PRIORITY_CALLBACK,
+    "editMessageText": PRIORITY_EDIT,
+    "editMessageReplyMarkup": PRIORITY_EDIT,
+    "deleteMessage": PRIORITY_LOADING,
+    "sendChatAction": PRIORITY_LOADING,
+}
+# Не сообщения: не расходуют лимиты SEND_GLOBAL_RATE / SEND_CHAT_RATE,
+# но идут через очередь ради порядка в чате и обработки retry_after
+RATE_EXEMPT_METHODS = {"answerCallbackQuery", "deleteMessage", "sendChatAction"}
+# Одновременных HTTP-запросов к Telegram
+MAX_IN_FLIGHT = 16
+MAX_RETRIES = 3
+
+_priority: contextvars.ContextVar[int | None] = contextvars.ContextVar("send_priority", default=None)
+
+
+@contextlib.contextmanager
+def send_priority(priority: int):
+    """Задать приоритет запросов к Telegram внутри блока"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 — уже доступен)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+@dataclass(order=True)
+class _Item:
+    priority: int
+    seq: int
+    make_request: object = field(compare=False)
+    bot: object = field(compare=False)
+    method: object = field(compare=False)
+    chat_id: int | str | None = field(compare=False)
+    edit_key: tuple | None = field(compare=False)
+    futures: list[asyncio.Future] = field(compare=False, default_factory=list)
+    attempts: int = field(compare=False, default=0)
+
+
+class SendQueue:
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chat_buckets: dict = {}
+        self._paused_until: dict = {}        # chat_id (None — все чаты) -> monotonic
+        self._busy_chats: set = set()
+        self._heap: list[_Item] = []
+        self._edits: dict[tuple, _Item] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self._task: asyncio.Task | None = None
+
+    async def submit(self, make_request, bot, method):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+        chat_id = getattr(method, "chat_id", None)
+        edit_key = None
+        if method.__api_method__ == "editMessageText" and getattr(method, "message_id", None):
+            edit_key = (chat_id, method.message_id)
+
+        future = asyncio.get_running_loop().create_future()
+
+        # Более новая правка того же сообщения заменяет ещё не отправленную
+        pending = self._edits.get(edit_key) if edit_key else None
+        if pending is not None:
+            pending.make_request, pending.bot, pending.method = make_request, bot, method
+            pending.futures.append(future)
+            return await future
+
+        priority = _priority.get()
+        if priority is None:
+            priority = DEFAULT_PRIORITIES.get(method.__api_method__, PRIORITY_REPLY)
+
+        item = _Item(priority, next(self._seq), make_request, bot, method, chat_id, edit_key, [future])
+        if edit_key:
+            self._edits[edit_key] = item
+        heapq.heappush(self._heap, item)
+        self._wakeup.set()
+        return await future
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10_000:
+                now = time.monotonic()
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if not b.is_idle(now)}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _ready_delay(self, item: _Item, now: float) -> float | None:
+        """Через сколько секунд можно отправить item (None — чат занят запросом)"""
+        if item.chat_id is not None and item.chat_id in self._busy_chats:
+            return None
+        delay = max(self._paused_until.get(None, 0), self._paused_until.get(item.chat_id, 0)) - now
+        if item.method.__api_method__ not in RATE_EXEMPT_METHODS:
+            delay = max(delay, self.global_bucket.delay(now))
+            if item.chat_id is not None:
+                delay = max(delay, self._chat_bucket(item.chat_id).delay(now))
+        return max(delay, 0.0)
+
+    def _pick(self, now: float) -> tuple[_Item | None, float]:
+        """Первый по приоритету запрос, который можно отправить сейчас, или время ожидания"""
+        best, wait = None, 1.0
+        for item in self._heap:
+            if best is not None and best < item:
+                continue
+            delay = self._ready_delay(item, now)
+            if delay is None:
+                continue
+            if delay == 0:
+                best = item
+            else:
+                wait = min(wait, delay)
+        return best, 0.0 if best else wait
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            item, wait = self._pick(time.monotonic())
+            if item is None:
+                self._wakeup.clear()
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                continue
+
+            self._heap.remove(item)
+            heapq.heapify(self._heap)
+            if item.edit_key:
+                self._edits.pop(item.edit_key, None)
+
+            if item.method.__api_method__ not in RATE_EXEMPT_METHODS:
+                self.global_bucket.take()
+                if item.chat_id is not None:
+                    self._chat_bucket(item.chat_id).take()
+            if item.chat_id is not None:
+                self._busy_chats.add(item.chat_id)
+
+            await self._in_flight.acquire()
+            asyncio.create_task(self._send(item))
+
+    async def _send(self, item: _Item) -> None:
+        try:
+            result = await item.make_request(item.bot, item.method)
+        except TelegramRetryAfter as e:
+            item.attempts += 1
+            key = item.chat_id  # без chat_id — пауза для всех
+            self._paused_until[key] = time.monotonic() + e.retry_after
+            logging.warning(f"Telegram flood control: {item.method.__api_method__} to {key}, "
+                            f"retry after {e.retry_after}s (attempt {item.attempts})")
+            if item.attempts <= MAX_RETRIES:
+                self._requeue(item)
+                return
+            self._resolve(item, error=e)
+        except Exception as e:
+            self._resolve(item, error=e)
+        else:
+            self._resolve(item, result=result)
+        finally:
+            self._busy_chats.discard(item.chat_id)
+            self._in_flight.release()
+            self._wakeup.set()
+
+    def _requeue(self, item: _Item) -> None:
+        # Пока запрос ждал, могла прийти более новая правка того же сообщения
+        if item.edit_key and item.edit_key in self._edits:
+            self._edits[item.edit_key].futures.extend(item.futures)
+            return
+        if item.edit_key:
+            self._edits[item.edit_key] = item
+        heapq.heappush(self._heap, item)
+
+    @staticmethod
+    def _resolve(item: _Item, result=None, error: Exception | None = None) -> None:
+        for future in item.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+send_queue = SendQueue(SEND_GLOBAL_RATE / SEND_PROCESSES, SEND_CHAT_RATE, SEND_CHAT_BURST)
+
+
+class SendQueueMiddleware(BaseRequestMiddleware):
+    """Request-middleware сессии бота: методы отправки идут через send_queue"""
+
+    def __init__(self, queue: SendQueue = send_queue):
+        self.queue = queue
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__ not in QUEUED_METHODS:
+            return await make_request(bot, method)
+        return await self.queue.submit(make_request, bot, method)
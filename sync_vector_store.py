@@ -0,0 +1,291 @@
+"""
+Инкрементальная синхронизация локальной базы знаний с Vector Store.
+
+Сравнивает файлы локальной папки с файлами Vector Store по SHA-256:
+    - новые и изменённые файлы загружаются параллельно и добавляются одним file batch;
+    - устаревшие (удалённые локально или заменённые) — удаляются из store и из Files.
+
+Старая версия файла удаляется только после того, как новая проиндексирована.
+Метки (attributes) получают только проиндексированные файлы; загрузки с ошибкой
+убираются из store и из Files и будут загружены заново следующим запуском.
+Если batch не завершился, ничего не удаляется и скрипт выходит с кодом 1.
+
+Путь и хэш файла хранятся в attributes файла Vector Store, поэтому состояние
+синхронизации берётся из самого store, без локального манифеста.
+Файлы без этих attributes (загруженные вручную) не трогаются без --prune-unmanaged.
+
+Использование:
+    python sync_vector_store.py --assistant asst_QfzzLwaL8JHcve4Y80IVKq9E --dir knowledge/pandora --dry-run
+    python sync_vector_store.py --vector-store vs_... --dir knowledge/curator
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+from dataclasses import dataclass
+from openai import AsyncOpenAI
+from config import OPENAI_API_KEY
+from export_common import Progress, gather_bounded, collect_pages
+from openai_client_v2 import ASSISTANT_VECTOR_STORES
+
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# Ожидание обработки batch: интервал растёт от 1с до 10с
+BATCH_POLL_MIN = 1.0
+BATCH_POLL_MAX = 10.0
+BATCH_TIMEOUT = 1800
+
+
+@dataclass
+class LocalFile:
+    path: str       # относительный путь (ключ синхронизации)
+    abs_path: str
+    sha256: str
+    size: int
+
+
+@dataclass
+class RemoteFile:
+    file_id: str
+    path: str | None
+    sha256: str | None
+
+
+@dataclass
+class SyncPlan:
+    upload: list[LocalFile]
+    delete: list[RemoteFile]
+    unchanged: list[LocalFile]
+    unmanaged: list[RemoteFile]
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_local(directory: str) -> dict[str, LocalFile]:
+    """Все файлы папки (кроме скрытых), ключ — относительный путь"""
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in names:
+            if name.startswith("."):
+                continue
+            abs_path = os.path.join(root, name)
+            rel = os.path.relpath(abs_path, directory).replace(os.sep, "/")
+            files[rel] = LocalFile(rel, abs_path, file_sha256(abs_path), os.path.getsize(abs_path))
+    return files
+
+
+async def scan_remote(vector_store_id: str) -> list[RemoteFile]:
+    """Все файлы Vector Store (все страницы) с путём и хэшем из attributes"""
+    vs_files = await collect_pages(client.vector_stores.files.list(vector_store_id, limit=100))
+    remote = []
+    for f in vs_files:
+        attrs = f.attributes or {}
+        remote.append(RemoteFile(f.id, attrs.get("path"), attrs.get("sha256")))
+    return remote
+
+
+def build_plan(local: dict[str, LocalFile], remote: list[RemoteFile], prune_unmanaged: bool) -> SyncPlan:
+    # Под одним путём может лежать несколько версий — после прерванной синхронизации
+    managed: dict[str, list[RemoteFile]] = {}
+    for r in remote:
+        if r.path:
+            managed.setdefault(r.path, []).append(r)
+    unmanaged = [r for r in remote if not r.path]
+
+    upload, unchanged, delete = [], [], []
+    for path, lf in sorted(local.items()):
+        versions = managed.get(path, [])
+        current = next((rf for rf in versions if rf.sha256 == lf.sha256), None)
+        if current:
+            unchanged.append(lf)
+        else:
+            upload.append(lf)
+        delete.extend(rf for rf in versions if rf is not current)  # старые версии файла
+
+    delete.extend(rf for path, versions in managed.items() if path not in local for rf in versions)
+    if prune_unmanaged:
+        delete.extend(unmanaged)
+
+    return SyncPlan(upload=upload, delete=delete, unchanged=unchanged, unmanaged=unmanaged)
+
+
+def print_plan(plan: SyncPlan) -> None:
+    print(f"\n➕ Загрузить: {len(plan.upload)}")
+    for lf in plan.upload:
+        print(f"   + {lf.path} ({lf.size} bytes)")
+    print(f"\n➖ Удалить: {len(plan.delete)}")
+    for rf in plan.delete:
+        print(f"   - {rf.path or '(без пути)'} [{rf.file_id}]")
+    print(f"\n⏭️ Без изменений: {len(plan.unchanged)}")
+    if plan.unmanaged:
+        print(f"\n⚠️ Файлов без attributes (загружены вручную): {len(plan.unmanaged)}")
+
+
+async def wait_for_batch(vector_store_id: str, batch_id: str):
+    """Ждать завершения file batch с растущим интервалом опроса"""
+    interval = BATCH_POLL_MIN
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BATCH_TIMEOUT
+
+    while True:
+        batch = await client.vector_stores.file_batches.retrieve(batch_id, vector_store_id=vector_store_id)
+        counts = batch.file_counts
+        print(f"   ⏳ Batch {batch.status}: {counts.completed}/{counts.total} готово, {counts.failed} ошибок")
+        if batch.status != "in_progress" or loop.time() >= deadline:
+            return batch
+        await asyncio.sleep(interval)
+        interval = min(interval * 1.5, BATCH_POLL_MAX)
+
+
+async def discard_file(vector_store_id: str, file_id: str, attached: bool = True) -> None:
+    """Убрать файл из store (если он туда добавлен) и удалить из Files"""
+    if attached:
+        await client.vector_stores.files.delete(file_id, vector_store_id=vector_store_id)
+    try:
+        await client.files.delete(file_id)
+    except Exception as e:
+        print(f"   ⚠️ Файл {file_id} убран из store, но не удалён из Files: {e}")
+
+
+async def upload_files(vector_store_id: str, files: list[LocalFile]) -> set[str] | None:
+    """
+    Загрузить файлы одним batch. Возвращает пути проиндексированных файлов;
+    None — загрузка или batch не завершились (удалять старые версии нельзя).
+    """
+    if not files:
+        return set()
+
+    async def upload(lf: LocalFile) -> str | None:
+        try:
+            with open(lf.abs_path, "rb") as f:
+                uploaded = await client.files.create(file=(os.path.basename(lf.path), f), purpose="assistants")
+        except Exception as e:
+            print(f"   ❌ {lf.path}: {e}")
+            return None
+        return uploaded.id
+
+    print("\n📤 Загрузка файлов...")
+    file_ids = await gather_bounded(files, upload, progress=Progress("загружен", len(files)),
+                                    label=lambda lf, _: lf.path)
+    uploaded = {file_id: lf for lf, file_id in zip(files, file_ids) if file_id}
+
+    if len(uploaded) < len(files):
+        # Неполный набор в store не добавляем — иначе часть старых версий останется без замены
+        print(f"   ❌ Не загружено файлов: {len(files) - len(uploaded)}, загруженные удаляются")
+        await gather_bounded(list(uploaded), lambda file_id: discard_file(vector_store_id, file_id, attached=False))
+        return None
+
+    batch = await client.vector_stores.file_batches.create(vector_store_id, file_ids=list(uploaded))
+    batch = await wait_for_batch(vector_store_id, batch.id)
+    if batch.status == "in_progress":
+        # Таймаут: недоиндексированные файлы без меток потом не отличить от загруженных вручную
+        batch = await client.vector_stores.file_batches.cancel(batch.id, vector_store_id=vector_store_id)
+    if batch.status != "completed":
+        print(f"   ❌ Batch завершился со статусом {batch.status}")
+
+    batch_files = await collect_pages(
+        client.vector_stores.file_batches.list_files(batch.id, vector_store_id=vector_store_id, limit=100)
+    )
+    statuses = {f.id: f.status for f in batch_files}
+    indexed = [(lf, file_id) for file_id, lf in uploaded.items() if statuses.get(file_id) == "completed"]
+    broken = [file_id for file_id in uploaded if statuses.get(file_id) != "completed"]
+
+    # Путь и хэш — в attributes, по ним следующая синхронизация найдёт изменения
+    async def tag(item: tuple[LocalFile, str]) -> None:
+        lf, file_id = item
+        await client.vector_stores.files.update(
+            file_id,
+            vector_store_id=vector_store_id,
+            attributes={"path": lf.path, "sha256": lf.sha256}
+        )
+
+    await gather_bounded(indexed, tag)
+
+    # Без меток файл выглядел бы загруженным вручную — убираем, следующий запуск загрузит заново
+    if broken:
+        print(f"   ❌ Не проиндексировано: {', '.join(uploaded[file_id].path for file_id in broken)}")
+        await gather_bounded(broken, lambda file_id: discard_file(vector_store_id, file_id))
+
+    if batch.status != "completed":
+        return None
+    return {lf.path for lf, _ in indexed}
+
+
+async def delete_files(vector_store_id: str, files: list[RemoteFile]) -> None:
+    if not files:
+        return
+
+    async def delete(rf: RemoteFile) -> None:
+        await discard_file(vector_store_id, rf.file_id)
+
+    print("\n🗑️ Удаление устаревших файлов...")
+    await gather_bounded(files, delete, progress=Progress("удалён", len(files)),
+                         label=lambda rf, _: rf.path or rf.file_id)
+
+
+async def sync(vector_store_id: str, directory: str, dry_run: bool, prune_unmanaged: bool) -> bool:
+    """Синхронизировать папку со store; False — не всё загружено (старые версии оставлены)"""
+    print("=" * 60)
+    print(f"СИНХРОНИЗАЦИЯ {directory} → {vector_store_id}")
+    print("=" * 60)
+
+    local = scan_local(directory)
+    remote = await scan_remote(vector_store_id)
+    print(f"📂 Локально: {len(local)} файлов, в Vector Store: {len(remote)}")
+
+    plan = build_plan(local, remote, prune_unmanaged)
+    print_plan(plan)
+
+    if dry_run:
+        print("\n🔍 Dry run — изменения не применялись")
+        return True
+
+    # Сначала загружаем новые версии, потом удаляем старые — store не остаётся пустым
+    indexed = await upload_files(vector_store_id, plan.upload)
+    if indexed is None:
+        print("\n❌ Загрузка не завершилась — старые версии не удалялись, повторите синхронизацию")
+        return False
+
+    # Старую версию удаляем, только если новая проиндексирована (или новую не загружали)
+    replaced = {lf.path for lf in plan.upload}
+    delete = [rf for rf in plan.delete if rf.path not in replaced or rf.path in indexed]
+    await delete_files(vector_store_id, delete)
+
+    ok = len(indexed) == len(plan.upload)
+    print("\n" + "=" * 60)
+    print("✅ СИНХРОНИЗАЦИЯ ЗАВЕРШЕНА" if ok else "⚠️ СИНХРОНИЗАЦИЯ ЗАВЕРШЕНА С ОШИБКАМИ")
+    print("=" * 60)
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Синхронизация базы знаний с Vector Store")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--assistant", help="ID ассистента из ASSISTANT_VECTOR_STORES")
+    target.add_argument("--vector-store", help="ID Vector Store")
+    parser.add_argument("--dir", required=True, help="Локальная папка с базой знаний")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, что изменится")
+    parser.add_argument("--prune-unmanaged", action="store_true",
+                        help="Удалить файлы store, загруженные не этим скриптом")
+    args = parser.parse_args()
+
+    vector_store_id = args.vector_store or ASSISTANT_VECTOR_STORES.get(args.assistant)
+    if not vector_store_id:
+        sys.exit(f"У ассистента {args.assistant} нет Vector Store")
+    if not os.path.isdir(args.dir):
+        sys.exit(f"Папка {args.dir} не найдена")
+
+    if not asyncio.run(sync(vector_store_id, args.dir, args.dry_run, args.prune_unmanaged)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Очередь задач ассистентов в БД (QUEUE_MODE).
+
+Dispatcher (main.py) кладёт задачи, воркеры (worker.py) забирают их.
+Порядок сообщений одного пользователя сохраняется: пока у пользователя есть
+задача в статусе running, его следующие задачи не выдаются.
+"""
+from __future__ import annotations
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import QUEUE_VISIBILITY_TIMEOUT, QUEUE_MAX_ATTEMPTS
+from database import session_maker, TaskQueue
+from metrics import QUEUE_DEPTH
+from admission import admission
+
+# Сколько кандидатов рассматривать за одну попытку захвата
+CLAIM_BATCH = 20
+
+
+async def enqueue_task(
+    session: AsyncSession,
+    tg_id: int,
+    chat_id: int,
+    assistant_id: str,
+    kind: str,
+    payload: dict,
+    loading_message_id: int | None = None
+) -> int:
+    """Положить задачу в очередь и вернуть её id"""
+    task = TaskQueue(
+        tg_id=tg_id,
+        chat_id=chat_id,
+        assistant_id=assistant_id,
+        kind=kind,
+        payload=json.dumps(payload, ensure_ascii=False),
+        loading_message_id=loading_message_id,
+        status="pending",
+        attempts=0,
+        enqueued_at=datetime.utcnow()
+    )
+    session.add(task)
+    await session.commit()
+    return task.id
+
+
+async def claim_task(worker_id: str) -> TaskQueue | None:
+    """
+    Захватить самую старую задачу пользователя, у которого нет задач в работе.
+    Захват — условный UPDATE по статусу, поэтому работает и на SQLite, и на PostgreSQL.
+    """
+    async with session_maker() as session:
+        busy_users = select(TaskQueue.tg_id).where(TaskQueue.status == "running")
+        result = await session.execute(
+            select(TaskQueue.id, TaskQueue.tg_id)
+            .where(TaskQueue.status == "pending", TaskQueue.tg_id.not_in(busy_users))
+            .order_by(TaskQueue.id)
+            .limit(CLAIM_BATCH)
+        )
+
+        seen_users = set()
+        for task_id, tg_id in result.all():
+            # Только первая задача пользователя — иначе можно обогнать его же сообщение
+            if tg_id in seen_users:
+                continue
+            seen_users.add(tg_id)
+
+            claimed = await session.execute(
+                update(TaskQueue)
+                .where(TaskQueue.id == task_id, TaskQueue.status == "pending")
+                .values(
+                    status="running",
+                    worker=worker_id,
+                    locked_at=datetime.utcnow(),
+                    attempts=TaskQueue.attempts + 1
+                )
+            )
+            await session.commit()
+
+            if claimed.rowcount == 1:
+                return await session.get(TaskQueue, task_id)
+
+    return None
+
+
+async def complete_task(task_id: int) -> None:
+    """Удалить выполненную задачу из очереди"""
+    async with session_maker() as session:
+        await session.execute(delete(TaskQueue).where(TaskQueue.id == task_id))
+        await session.commit()
+
+
+async def requeue_stale_tasks() -> int:
+    """Вернуть в очередь задачи упавших воркеров (или пометить failed после QUEUE_MAX_ATTEMPTS)"""
+    border = datetime.utcnow() - timedelta(seconds=QUEUE_VISIBILITY_TIMEOUT)
+
+    async with session_maker() as session:
+        failed = await session.execute(
+            update(TaskQueue)
+            .where(
+                TaskQueue.status == "running",
+                TaskQueue.locked_at < border,
+                TaskQueue.attempts >= QUEUE_MAX_ATTEMPTS
+            )
+            .values(status="failed")
+        )
+        requeued = await session.execute(
+            update(TaskQueue)
+            .where(TaskQueue.status == "running", TaskQueue.locked_at < border)
+            .values(status="pending", worker=None, locked_at=None)
+        )
+        await session.commit()
+
+    if failed.rowcount:
+        logging.error(f"Marked {failed.rowcount} queue tasks as failed after {QUEUE_MAX_ATTEMPTS} attempts")
+    if requeued.rowcount:
+        logging.warning(f"Requeued {requeued.rowcount} stale queue tasks")
+    return requeued.rowcount
+
+
+async def get_queue_depth(session: AsyncSession) -> int:
+    """Количество задач, ожидающих воркера"""
+    result = await session.execute(
+        select(func.count()).select_from(TaskQueue).where(TaskQueue.status == "pending")
+    )
+    return result.scalar_one()
+
+
+async def get_oldest_wait(session: AsyncSession) -> float:
+    """Сколько секунд ждёт воркера самая старая задача"""
+    result = await session.execute(
+        select(func.min(TaskQueue.enqueued_at)).where(TaskQueue.status == "pending")
+    )
+    oldest = result.scalar_one()
+    return (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+
+
+async def track_queue_depth(interval: float = 15) -> None:
+    """Периодически обновлять gauge глубины очереди и сигнал queue_wait для контроля допуска"""
+    while True:
+        try:
+            async with session_maker() as session:
+                QUEUE_DEPTH.set(await get_queue_depth(session))
+                admission.observe_queue_wait(await get_oldest_wait(session))
+        except Exception as e:
+            logging.warning(f"Failed to read queue depth: {e}")
+        await asyncio.sleep(interval)
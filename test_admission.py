@@ -0,0 +1,88 @@
+"""
+Локальный тест контроля допуска (admission.py).
+
+Сигналы подаются напрямую: задержки OpenAI — в model_router, запросы
+в работе — через in_flight, ожидание в очереди — observe_queue_wait.
+Проверяет, что уровень растёт сразу, снижается по одному шагу после
+cooldown, а отказ сообщает ETA.
+
+Запуск: python test_admission.py
+"""
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ["DB_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'admission_test.db')}"
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+import admission as admission_module  # noqa: E402
+from admission import (  # noqa: E402
+    AdmissionController, TIER_NORMAL, TIER_NO_TOOLS, TIER_CHEAP_MODEL, TIER_SHORT_OUTPUT, TIER_REJECT
+)
+from model_router import router  # noqa: E402
+from pending_jobs import in_flight, InFlightJob  # noqa: E402
+
+admission_module.CHECK_INTERVAL = 0
+
+
+def record_latencies(latency: float, count: int = 20) -> None:
+    for _ in range(count):
+        router.stats("gpt-test").record(latency, True)
+
+
+async def run_admission():
+    print("=" * 60)
+    print("Контроль допуска")
+    print("=" * 60)
+
+    controller = AdmissionController(enabled=True, max_in_flight=2, queue_wait_target=60, p95_target=10,
+                                     window=60, cooldown=0.2)
+    assert controller.tier() == TIER_NORMAL
+
+    record_latencies(9)   # давление 0.9
+    assert controller.tier() == TIER_CHEAP_MODEL
+    record_latencies(14)  # p95 14 / 10 = 1.4
+    assert controller.tier() == TIER_REJECT
+    print("✅ Рост p95 OpenAI сразу поднимает уровень вплоть до reject")
+
+    router._stats.clear()
+    assert controller.tier() == TIER_REJECT  # cooldown ещё не прошёл
+    tiers = []
+    while controller.tier() != TIER_NORMAL:
+        time.sleep(0.21)
+        tiers.append(controller.tier())
+    assert tiers == [TIER_SHORT_OUTPUT, TIER_CHEAP_MODEL, TIER_NO_TOOLS, TIER_NORMAL], tiers
+    print("✅ После нормализации уровень снижается по одному шагу раз в cooldown")
+
+    # Запросы в работе: 3 при пороге 2 — давление 1.5
+    jobs = [InFlightJob(i, i, "asst_test", "text", {"text": "?"}, None) for i in range(3)]
+    release = asyncio.Event()
+
+    async def hold(job):
+        with in_flight.track(job):
+            await release.wait()
+
+    tasks = [asyncio.create_task(hold(job)) for job in jobs]
+    await asyncio.sleep(0)
+    assert controller.tier() == TIER_REJECT
+    release.set()
+    await asyncio.gather(*tasks)
+
+    controller.observe_queue_wait(90)
+    text = controller.reject_text()
+    assert "через 2 мин." in text and "не учтён в лимите" in text, text  # 90 с очереди + cooldown
+    print(f"✅ Перегрузка по запросам в работе — отказ с ETA: {text.splitlines()[-1]}")
+
+
+async def main():
+    await run_admission()
+
+    print("\n" + "=" * 60)
+    print("ТЕСТИРОВАНИЕ ЗАВЕРШЕНО")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
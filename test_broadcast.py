@@ -0,0 +1,131 @@
+"""
+Локальный end-to-end тест рассылки (/broadcast).
+
+Поднимает временную SQLite с пользователями, подменяет Telegram заглушкой
+(часть пользователей «заблокировала бота»), прерывает рассылку посередине
+и проверяет, что после рестарта она продолжается с сохранённого курсора,
+а заблокировавшие бота исключаются из следующей рассылки.
+
+Запуск: python test_broadcast.py
+"""
+import asyncio
+import os
+import tempfile
+from collections import Counter
+
+_db_path = os.path.join(tempfile.mkdtemp(), "broadcast_test.db")
+os.environ["DB_URL"] = f"sqlite+aiosqlite:///{_db_path}"
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["BROADCAST_RATE"] = "2000"
+os.environ["BROADCAST_BATCH"] = "50"
+
+from aiogram.exceptions import TelegramForbiddenError  # noqa: E402
+from aiogram.methods import SendMessage  # noqa: E402
+
+from broadcast import broadcaster, create_broadcast  # noqa: E402
+from database import create_db, session_maker, UserState, Broadcasts  # noqa: E402
+
+USERS = 500
+ADMIN_ID = 1
+BLOCKED_EVERY = 10  # каждый десятый пользователь заблокировал бота
+
+
+class FakeBot:
+    """Заглушка Bot: считает доставленные сообщения"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.delivered: Counter = Counter()
+        self.reports = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        await asyncio.sleep(self.delay)
+        if chat_id == ADMIN_ID:
+            self.reports += 1
+            return
+        if chat_id % BLOCKED_EVERY == 0:
+            raise TelegramForbiddenError(SendMessage(chat_id=chat_id, text=text), "bot was blocked by the user")
+        self.delivered[(chat_id, text)] += 1
+
+    async def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+        pass
+
+
+async def wait_status(broadcast_id: int, statuses: tuple, timeout: float = 30) -> Broadcasts:
+    for _ in range(int(timeout * 10)):
+        async with session_maker() as session:
+            broadcast = await session.get(Broadcasts, broadcast_id)
+        if broadcast.status in statuses:
+            return broadcast
+        await asyncio.sleep(0.1)
+    raise AssertionError(f"рассылка #{broadcast_id} не перешла в {statuses}")
+
+
+async def run_broadcast_e2e():
+    print("=" * 60)
+    print("E2E: рассылка с перезапуском")
+    print("=" * 60)
+
+    await create_db()
+    async with session_maker() as session:
+        session.add_all(UserState(tg_id=tg_id, assistant_id=None) for tg_id in range(2, USERS + 2))
+        await session.commit()
+        broadcast = await create_broadcast(ADMIN_ID, "Новый ассистент!", session)
+    assert broadcast.total == USERS
+
+    # Первый запуск прерываем посередине — как при редеплое
+    bot = FakeBot(delay=0.005)
+    await broadcaster.start(bot)
+    assert await broadcaster.launch(bot, broadcast.id, ADMIN_ID, 100)
+    while sum(bot.delivered.values()) < USERS // 3:
+        await asyncio.sleep(0.01)
+    await broadcaster.stop()
+
+    async with session_maker() as session:
+        interrupted = await session.get(Broadcasts, broadcast.id)
+    assert interrupted.status == "running" and interrupted.owner is None
+    assert 0 < interrupted.last_tg_id < USERS
+    print(f"✅ Прервана на курсоре {interrupted.last_tg_id}, прогресс сохранён")
+
+    # Рестарт: брошенная рассылка подхватывается и доходит до конца
+    await broadcaster.start(bot)
+    done = await wait_status(broadcast.id, ("done",))
+    await broadcaster.stop()
+
+    expected = {tg_id for tg_id in range(2, USERS + 2) if tg_id % BLOCKED_EVERY}
+    received = {chat_id for chat_id, _ in bot.delivered}
+    assert received == expected, f"не получили: {len(expected - received)}"
+    duplicates = sum(count - 1 for count in bot.delivered.values())
+    assert duplicates <= int(os.environ["BROADCAST_BATCH"])
+    print(f"✅ Доставлено {len(received)} пользователям после рестарта (повторов: {duplicates})")
+
+    assert done.sent + done.blocked + done.failed >= USERS
+    assert done.blocked == USERS // BLOCKED_EVERY and done.failed == 0
+    assert bot.reports == 1
+    print(f"✅ Статистика: доставлено {done.sent}, заблокировали {done.blocked}, ошибок {done.failed}")
+
+    # Следующая рассылка не идёт тем, кто заблокировал бота
+    async with session_maker() as session:
+        second = await create_broadcast(ADMIN_ID, "Ещё одна новость", session)
+    assert second.total == USERS - USERS // BLOCKED_EVERY
+
+    bot = FakeBot()
+    await broadcaster.start(bot)
+    assert await broadcaster.launch(bot, second.id, ADMIN_ID, 101)
+    second = await wait_status(second.id, ("done",))
+    await broadcaster.stop()
+    assert second.blocked == 0 and second.sent == len(expected)
+    print(f"✅ Заблокировавшие бота исключены из следующей рассылки: {second.sent} получателей")
+
+
+async def main():
+    await run_broadcast_e2e()
+
+    print("\n" + "=" * 60)
+    print("ТЕСТИРОВАНИЕ ЗАВЕРШЕНО")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
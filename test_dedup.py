@@ -0,0 +1,90 @@
+"""
+Локальный тест дедупликации апдейтов (dedup.py).
+
+Временная SQLite, хэндлер — счётчик вызовов. Проверяет, что повторный
+update_id и то же сообщение под другим update_id отбрасываются, правка
+сообщения проходит, после «рестарта» повтор отбрасывается по кольцу из БД,
+а кольцо не растёт больше окна.
+
+Запуск: python test_dedup.py
+"""
+import asyncio
+import os
+import tempfile
+from datetime import datetime
+
+_db_path = os.path.join(tempfile.mkdtemp(), "dedup_test.db")
+os.environ["DB_URL"] = f"sqlite+aiosqlite:///{_db_path}"
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["DEDUP_WINDOW"] = "100"
+
+from aiogram.types import Chat, Message, Update, User  # noqa: E402
+from sqlalchemy import func, select  # noqa: E402
+
+import dedup  # noqa: E402
+from dedup import DedupMiddleware, UpdateDeduplicator  # noqa: E402
+from database import create_db, session_maker, ProcessedUpdates  # noqa: E402
+
+CHAT = Chat(id=42, type="private")
+USER = User(id=42, is_bot=False, first_name="Test")
+
+
+def make_update(update_id: int, message_id: int, edit_date: int | None = None) -> Update:
+    message = Message(message_id=message_id, date=datetime.now(), chat=CHAT, from_user=USER,
+                      text="Как снизить логистику?", edit_date=edit_date)
+    if edit_date:
+        return Update(update_id=update_id, edited_message=message)
+    return Update(update_id=update_id, message=message)
+
+
+async def run_dedup_e2e():
+    print("=" * 60)
+    print("Дедупликация апдейтов")
+    print("=" * 60)
+
+    await create_db()
+    middleware = DedupMiddleware()
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.update_id)
+
+    await middleware(handler, make_update(1, 10), {})
+    await middleware(handler, make_update(1, 10), {})
+    await middleware(handler, make_update(2, 10), {})
+    assert handled == [1], handled
+    print("✅ Повторный update_id и то же сообщение под новым update_id отброшены")
+
+    await middleware(handler, make_update(3, 10, edit_date=1000), {})
+    await middleware(handler, make_update(4, 10, edit_date=1000), {})
+    await middleware(handler, make_update(5, 11), {})
+    assert handled == [1, 3, 5], handled
+    print("✅ Правка сообщения обработана один раз, новое сообщение — обработано")
+
+    # Рестарт: окно в памяти пустое, повтор отбрасывается по кольцу из БД
+    dedup.deduplicator = UpdateDeduplicator()
+    await dedup.deduplicator.load()
+    await middleware(handler, make_update(5, 11), {})
+    await middleware(handler, make_update(6, 12), {})
+    assert handled == [1, 3, 5, 6], handled
+    print("✅ После рестарта повтор отброшен, не дойдя до хэндлера")
+
+    for update_id in range(7, 300):
+        await middleware(handler, make_update(update_id, update_id + 10), {})
+    async with session_maker() as session:
+        rows = (await session.execute(select(func.count()).select_from(ProcessedUpdates))).scalar_one()
+    assert rows == 100, rows
+    print(f"✅ Кольцо в БД ограничено окном: {rows} строк после {handled[-1]} апдейтов")
+
+
+async def main():
+    await run_dedup_e2e()
+
+    print("\n" + "=" * 60)
+    print("ТЕСТИРОВАНИЕ ЗАВЕРШЕНО")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
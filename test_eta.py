@@ -0,0 +1,77 @@
+"""
+Локальный тест оценки времени ответа (eta.py).
+
+Временная SQLite: запросы пишутся в request_log как в track_request,
+оценщик догоняет журнал. Проверяет диапазон p50-p90 по (ассистент, модель,
+тип входа), запасной вариант по всем моделям ассистента, прежние «5-30 секунд»
+без данных и фиксированный размер гистограмм при любом числе запросов.
+
+Запуск: python test_eta.py
+"""
+import asyncio
+import os
+import random
+import tempfile
+
+os.environ["DB_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'eta_test.db')}"
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+from analytics import record_request  # noqa: E402
+from database import create_db  # noqa: E402
+from eta import LatencyEstimator, BUCKETS, TEXT, PHOTO, DOCUMENT, format_eta  # noqa: E402
+
+rng = random.Random(0)
+
+
+async def log_requests(assistant_id: str, model: str, input_type: str, median: float, count: int) -> None:
+    for _ in range(count):
+        latency = rng.lognormvariate(0, 0.3) * median
+        await record_request(1, assistant_id, "text" if input_type == TEXT else "file", "ok",
+                             latency_ms=int(latency * 1000), model=model, input_type=input_type)
+
+
+async def run_eta():
+    print("=" * 60)
+    print("Оценка времени ответа")
+    print("=" * 60)
+
+    await create_db()
+    await log_requests("asst_a", "gpt-4.1", TEXT, 12, 200)
+    await log_requests("asst_a", "gpt-4.1", PHOTO, 40, 50)
+    # Строка без типа входа (неудачная отправка background-задачи) в оценку не попадает
+    await record_request(1, "asst_a", "file", "ok", latency_ms=50, model="gpt-4.1")
+
+    estimator = LatencyEstimator(min_samples=5)
+    assert await estimator.refresh() == 250
+    low, high = estimator.estimate("asst_a", "gpt-4.1", TEXT)
+    assert 10 < low < 14 and 14 < high < 22, (low, high)
+    assert estimator.estimate("asst_a", "gpt-4.1", PHOTO)[0] > 30
+    print(f"✅ Текст: {format_eta(low, high)}, фото: {format_eta(*estimator.estimate('asst_a', 'gpt-4.1', PHOTO))}")
+
+    # Модель без статистики — по всем моделям ассистента; ассистент без статистики — None
+    assert estimator.estimate("asst_a", "gpt-4o-mini", TEXT) == (low, high)
+    assert estimator.estimate("asst_a", "gpt-4.1", DOCUMENT) is None
+    assert estimator.estimate("asst_b", "gpt-4.1", TEXT) is None
+    assert format_eta(5, 30) == "5-30 секунд" and format_eta(100, 200) == "2-4 минуты"
+    print("✅ Мало данных — оценка по другим моделям ассистента или прежние «5-30 секунд»")
+
+    # Догоняет только новые строки; размер гистограмм не зависит от числа запросов
+    await log_requests("asst_a", "gpt-4.1", TEXT, 12, 300)
+    assert await estimator.refresh() == 300
+    assert await estimator.refresh() == 0
+    sketches = estimator._sketches
+    assert len(sketches) == 2 and all(len(sketch.counts) == BUCKETS for sketch in sketches.values())
+    print(f"✅ Новые строки учтены один раз, память постоянна: {len(sketches)} гистограммы по {BUCKETS} бакетов")
+
+
+async def main():
+    await run_eta()
+
+    print("\n" + "=" * 60)
+    print("ТЕСТИРОВАНИЕ ЗАВЕРШЕНО")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+"""
+Локальный тест маршрутизации моделей (model_router.py).
+
+Запрос — заглушка: по имени модели решает, упасть сразу, ответить
+с задержкой или ответить быстро. Проверяет fallback по цепочке и hedging,
+в том числе когда основная модель падает раньше hedge_delay, и что
+проигравший hedge-запрос не попадает в статистику как быстрый успех.
+
+Запуск: python test_model_router.py
+"""
+import asyncio
+import os
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+import httpx  # noqa: E402
+from openai import APIConnectionError  # noqa: E402
+
+from model_router import ModelRouter  # noqa: E402
+
+# модель -> (задержка, упасть ли)
+BEHAVIOUR = {"fast-fail": (0.0, True), "slow": (0.5, False), "fast": (0.01, False)}
+
+
+def make_request(calls: list[str]):
+    async def request(model: str) -> str:
+        calls.append(model)
+        delay, fail = BEHAVIOUR[model]
+        await asyncio.sleep(delay)
+        if fail:
+            raise APIConnectionError(request=httpx.Request("POST", "http://test"))
+        return f"answer from {model}"
+    return request
+
+
+async def run_router():
+    print("=" * 60)
+    print("Маршрутизация моделей")
+    print("=" * 60)
+
+    calls = []
+    result, model = await ModelRouter(hedge_delay=0, timeout=5).call(["fast-fail", "fast"], make_request(calls))
+    assert model == "fast" and calls == ["fast-fail", "fast"], calls
+    print("✅ Без hedging: ошибка основной модели — ответ резервной")
+
+    # Основная падает раньше hedge_delay — резервная всё равно опрашивается
+    calls = []
+    result, model = await ModelRouter(hedge_delay=0.2, timeout=5).call(["fast-fail", "fast"], make_request(calls))
+    assert model == "fast" and calls == ["fast-fail", "fast"], calls
+    print("✅ Hedging: основная упала до hedge_delay — сразу запрос к резервной")
+
+    calls = []
+    router = ModelRouter(hedge_delay=0.05, timeout=5)
+    result, model = await router.call(["slow", "fast"], make_request(calls))
+    assert model == "fast" and calls == ["slow", "fast"], calls
+    # Проигравшая основная — промах SLO, а не успех с обрезанной латентностью
+    assert [ok for _, _, ok in router.stats("slow").samples] == [False]
+    assert [ok for _, _, ok in router.stats("fast").samples] == [True]
+    print("✅ Hedging: медленная основная — отвечает резервная, основная учтена как промах")
+
+    calls = []
+    router = ModelRouter(hedge_delay=0.05, timeout=5)
+    result, model = await router.call(["slow", "fast"], make_request(calls), hedge=False, record=False)
+    assert model == "slow" and calls == ["slow"], calls
+    assert not any(stats.samples for stats in router._stats.values())
+    print("✅ Без hedging и статистики (отправка background-задач) — один запрос")
+
+    # Вызывающий отменён во время ожидания hedge_delay — основной запрос тоже отменяется
+    started = asyncio.Event()
+    finished = []
+
+    async def hanging(model: str) -> str:
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        finally:
+            finished.append(model)
+        return model
+
+    call = asyncio.create_task(ModelRouter(hedge_delay=5, timeout=30).call(["slow", "fast"], hanging))
+    await started.wait()
+    call.cancel()
+    await asyncio.gather(call, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert finished == ["slow"], finished
+    print("✅ Отмена вызывающего отменяет и запрос к основной модели")
+
+
+async def main():
+    await run_router()
+
+    print("\n" + "=" * 60)
+    print("ТЕСТИРОВАНИЕ ЗАВЕРШЕНО")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+"""
+Локальный тест остановки бота с запросами в работе (pending_jobs.py).
+
+Временная SQLite, заглушки OpenAI и Telegram. Быстрые запросы успевают
+ответить за время drain, медленный сохраняется в pending_jobs; следующий
+«процесс» выполняет его без повторного списания, а слишком старый —
+возвращает в лимит.
+
+Запуск: python test_pending_jobs.py
+"""
+import asyncio
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+
+_db_path = os.path.join(tempfile.mkdtemp(), "pending_test.db")
+os.environ["DB_URL"] = f"sqlite+aiosqlite:///{_db_path}"
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["LOADING_MODE"] = "edit"
+
+from sqlalchemy import select, func  # noqa: E402
+
+import assistant_service  # noqa: E402
+from assistant_service import run_text_request, resume_pending_jobs  # noqa: E402
+from database import create_db, session_maker, PendingJobs  # noqa: E402
+from pending_jobs import in_flight, InFlightJob  # noqa: E402
+from rate_limit import get_usage_count  # noqa: E402
+from test_task_queue import FakeBot, ASSISTANT_ID  # noqa: E402
+
+SLOW_USER = 3
+slow_users = {SLOW_USER}
+
+
+async def fake_ask_assistant_v2(tg_id, assistant_id, user_message, session):
+    """Заглушка OpenAI: запросы slow_users не успевают до остановки"""
+    await asyncio.sleep(30 if tg_id in slow_users else 0.1)
+    return f"echo:{user_message}", "resp_test", "gpt-test"
+
+
+async def handle(bot: FakeBot, tg_id: int, text: str) -> None:
+    """Как handle_message в main.py без QUEUE_MODE"""
+    payload = {"text": text}
+    with in_flight.track(InFlightJob(tg_id, tg_id, ASSISTANT_ID, "text", payload, 1000 + tg_id)):
+        await run_text_request(bot, tg_id, tg_id, ASSISTANT_ID, text, 1000 + tg_id)
+
+
+async def usage(tg_id: int) -> int:
+    async with session_maker() as session:
+        return await get_usage_count(tg_id, session)
+
+
+async def run_pending_e2e():
+    print("=" * 60)
+    print("Остановка с запросами в работе")
+    print("=" * 60)
+
+    assistant_service.ask_assistant_v2 = fake_ask_assistant_v2
+    await create_db()
+
+    bot = FakeBot()
+    handlers = [asyncio.create_task(handle(bot, tg_id, f"вопрос {tg_id}")) for tg_id in (1, 2, SLOW_USER)]
+    await asyncio.sleep(0.05)
+
+    saved = await in_flight.drain(timeout=1)
+    assert saved == 1 and all(task.done() for task in handlers)
+    assert set(bot.sent) == {1, 2}
+    assert await usage(SLOW_USER) == 1
+    print("✅ Быстрые запросы доставлены за время drain, медленный сохранён в pending_jobs")
+
+    # Следующий процесс: запрос выполняется заново, лимит не списывается второй раз
+    slow_users.clear()
+    await asyncio.gather(*await resume_pending_jobs(bot))
+    assert bot.sent[SLOW_USER] and "echo:вопрос 3" in bot.sent[SLOW_USER][0]
+    assert await usage(SLOW_USER) == 1
+    async with session_maker() as session:
+        assert (await session.execute(select(func.count()).select_from(PendingJobs))).scalar_one() == 0
+    print("✅ Прерванный запрос выполнен после рестарта без повторного списания")
+
+    # Слишком старый прерванный запрос — возврат в лимит и сообщение пользователю
+    async with session_maker() as session:
+        session.add(PendingJobs(tg_id=SLOW_USER, chat_id=SLOW_USER, assistant_id=ASSISTANT_ID, kind="text",
+                                payload='{"text": "старый вопрос"}', loading_message_id=2000,
+                                charged_on=date.today(), started_at=datetime.utcnow() - timedelta(hours=2)))
+        await session.commit()
+    assert await resume_pending_jobs(bot) == []
+    assert await usage(SLOW_USER) == 0
+    assert "не учтён в лимите" in bot.sent[SLOW_USER][-1]
+    print("✅ Старый прерванный запрос возвращён в лимит, пользователь предупреждён")
+
+
+async def main():
+    await run_pending_e2e()
+
+    print("\n" + "=" * 60)
+    print("ТЕСТИРОВАНИЕ ЗАВЕРШЕНО")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
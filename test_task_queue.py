@@ -0,0 +1,127 @@
+"""
+Локальный end-to-end тест очереди задач (QUEUE_MODE).
+
+Поднимает временную SQLite, подменяет OpenAI и Telegram заглушками,
+запускает воркеры и проверяет, что все ответы доставлены,
+а порядок сообщений каждого пользователя сохранён.
+
+Запуск: python test_task_queue.py
+"""
+import asyncio
+import os
+import random
+import tempfile
+
+_db_path = os.path.join(tempfile.mkdtemp(), "queue_test.db")
+os.environ["DB_URL"] = f"sqlite+aiosqlite:///{_db_path}"
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+import assistant_service  # noqa: E402
+from database import create_db, session_maker  # noqa: E402
+from task_queue import enqueue_task, get_queue_depth  # noqa: E402
+from worker import run_worker  # noqa: E402
+
+USERS = 20
+MESSAGES_PER_USER = 5
+ASSISTANT_ID = "asst_ZMDIYhez0iMJ3ZhMScCwREil"
+
+
+class FakeSession:
+    async def close(self):
+        pass
+
+
+class FakeBot:
+    """Заглушка Bot: запоминает отправленные сообщения"""
+
+    id = 123456
+
+    def __init__(self):
+        self.session = FakeSession()
+        self.sent: dict[int, list[str]] = {}
+        self.replaced = 0  # сообщения о загрузке: удалены или превращены в ответ
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.sent.setdefault(chat_id, []).append(text)
+
+    async def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+        self.sent.setdefault(chat_id, []).append(text)
+        self.replaced += 1
+
+    async def delete_message(self, chat_id, message_id):
+        self.replaced += 1
+
+    async def send_chat_action(self, chat_id, action, message_thread_id=None):
+        pass
+
+
+async def fake_ask_assistant_v2(tg_id, assistant_id, user_message, session):
+    """Заглушка OpenAI: случайная задержка, эхо-ответ"""
+    await asyncio.sleep(random.uniform(0, 0.03))
+    return f"echo:{user_message}", "resp_test", "gpt-test"
+
+
+async def run_queue_e2e():
+    print("=" * 60)
+    print("E2E: очередь задач + воркеры")
+    print("=" * 60)
+
+    assistant_service.ask_assistant_v2 = fake_ask_assistant_v2
+    await create_db()
+
+    # Сообщения разных пользователей перемешаны, как в реальном потоке апдейтов
+    async with session_maker() as session:
+        for i in range(MESSAGES_PER_USER):
+            for user in range(1, USERS + 1):
+                await enqueue_task(
+                    session,
+                    tg_id=user,
+                    chat_id=user,
+                    assistant_id=ASSISTANT_ID,
+                    kind="text",
+                    payload={"text": f"msg-{i}"},
+                    loading_message_id=1000 + i
+                )
+
+    bot = FakeBot()
+    stop = asyncio.Event()
+    worker = asyncio.create_task(run_worker(concurrency=8, bot=bot, stop=stop))
+
+    total = USERS * MESSAGES_PER_USER
+    for _ in range(300):
+        if sum(len(v) for v in bot.sent.values()) >= total:
+            break
+        await asyncio.sleep(0.1)
+
+    stop.set()
+    await worker
+
+    delivered = sum(len(v) for v in bot.sent.values())
+    assert delivered == total, f"доставлено {delivered} из {total}"
+    print(f"✅ Доставлено ответов: {delivered}")
+
+    for chat_id, texts in bot.sent.items():
+        order = [int(t.split("echo:msg-")[1].split("\n")[0]) for t in texts]
+        assert order == sorted(order), f"порядок нарушен для {chat_id}: {order}"
+    print(f"✅ Порядок сообщений сохранён для {len(bot.sent)} пользователей")
+
+    assert bot.replaced == total
+    print(f"✅ Заменено сообщений о загрузке: {bot.replaced}")
+
+    async with session_maker() as session:
+        depth = await get_queue_depth(session)
+    assert depth == 0
+    print("✅ Очередь пуста")
+
+
+async def main():
+    await run_queue_e2e()
+
+    print("\n" + "=" * 60)
+    print("ТЕСТИРОВАНИЕ ЗАВЕРШЕНО")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
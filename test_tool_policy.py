@@ -0,0 +1,53 @@
+"""
+Локальный тест классификатора хода (tool_policy.py).
+
+Короткие вопросы без «?» должны идти с поиском по базе знаний,
+без поиска — только вежливость и подтверждения.
+
+Запуск: python test_tool_policy.py
+"""
+from tool_policy import ToolPolicy, DEFAULT_POLICY, needs_retrieval, needs_code_interpreter, wants_file_search
+
+KNOWLEDGE_TURNS = (
+    "какие документы нужны",
+    "нужен ли штрихкод",
+    "сколько стоит доставка",
+    "как упаковать товар",
+    "можно ли продавать б/у",
+    "женская одежда",
+    "подробнее",
+    "комиссия",
+)
+SMALL_TALK_TURNS = ("спасибо!", "ок", "понятно, спасибо большое", "добрый день", "👍", "")
+
+
+def run_retrieval():
+    print("=" * 60)
+    print("Классификатор file_search")
+    print("=" * 60)
+
+    missed = [text for text in KNOWLEDGE_TURNS if not needs_retrieval(text)]
+    assert not missed, missed
+    print(f"✅ Короткие вопросы без «?» ищутся по базе знаний ({len(KNOWLEDGE_TURNS)} фраз)")
+
+    searched = [text for text in SMALL_TALK_TURNS if needs_retrieval(text)]
+    assert not searched, searched
+    print(f"✅ Вежливость и подтверждения обходятся без поиска ({len(SMALL_TALK_TURNS)} фраз)")
+
+    assert wants_file_search(ToolPolicy(retrieval="always"), "спасибо")
+    assert not wants_file_search(ToolPolicy(retrieval="never"), "какие документы нужны")
+    assert wants_file_search(DEFAULT_POLICY, "спасибо", classifier=False)
+    assert needs_code_interpreter("посчитай маржу") and needs_code_interpreter("спасибо", "cntr_1")
+    print("✅ Политики always/never и выключенный классификатор соблюдаются")
+
+
+def main():
+    run_retrieval()
+
+    print("\n" + "=" * 60)
+    print("ТЕСТИРОВАНИЕ ЗАВЕРШЕНО")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
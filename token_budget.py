@@ -0,0 +1,112 @@
+"""
+Локальный подсчёт токенов до запроса к OpenAI.
+
+Сообщение пользователя считается токенизатором модели ассистента (tiktoken)
+и обрезается до бюджета ассистента — огромная вставка не уходит в запрос
+целиком. По оценке входа считается стоимость запроса ещё до сетевого вызова;
+оценка пишется в request_log рядом с фактическими токенами из usage.
+
+tiktoken необязателен: без него (или если словарь не скачался) токены
+оцениваются по длине текста с запасом.
+"""
+from __future__ import annotations
+import functools
+import logging
+import math
+
+# Оценка без tiktoken: кириллица — около 3 символов на токен, латиница — около 4; берём с запасом
+CHARS_PER_TOKEN = 3
+# Служебные токены на каждое сообщение (роль, разметка)
+MESSAGE_OVERHEAD = 4
+# Словарь для моделей, которых tiktoken ещё не знает
+FALLBACK_ENCODING = "o200k_base"
+
+# Цены моделей, USD за 1M токенов: (вход, выход)
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _tiktoken():
+    try:
+        import tiktoken
+    except ImportError:
+        logging.info("tiktoken is not installed, token counts are estimated by text length")
+        return None
+    return tiktoken
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Токенизатор модели (один на процесс) или None — тогда считаем по длине текста"""
+    tiktoken = _tiktoken()
+    if tiktoken is None:
+        return None
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as e:
+        # Словарь скачивается при первом обращении — без сети его нет
+        logging.warning(f"Failed to load tokenizer for {model}, token counts are estimated: {e}")
+        return None
+
+
+def preload(models) -> None:
+    """Загрузить токенизаторы заранее (первая загрузка блокирующая — вызывать через to_thread)"""
+    for model in set(models):
+        get_encoding(model)
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_messages(messages: list[dict], model: str) -> int:
+    """Токены input Responses API (сообщения с текстовым content)"""
+    return sum(count_tokens(m["content"], model) + MESSAGE_OVERHEAD for m in messages)
+
+
+def truncate_tokens(text: str, max_tokens: int, model: str) -> tuple[str, int]:
+    """Обрезать текст до max_tokens. Возвращает (текст, сколько токенов отброшено)"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        total = math.ceil(len(text) / CHARS_PER_TOKEN)
+        if total <= max_tokens:
+            return text, 0
+        kept = text[:max_tokens * CHARS_PER_TOKEN]
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        total = len(tokens)
+        if total <= max_tokens:
+            return text, 0
+        kept = encoding.decode(tokens[:max_tokens])
+
+    # Не рвём слово посередине
+    cut = kept.rfind(" ", len(kept) * 9 // 10)
+    if cut > 0:
+        kept = kept[:cut]
+    return kept.rstrip(), total - max_tokens
+
+
+def truncation_notice(dropped_tokens: int) -> str:
+    return (
+        f"✂️ Сообщение слишком длинное: последние ~{dropped_tokens} токенов не отправлены ассистенту. "
+        f"Отправьте оставшуюся часть отдельным сообщением."
+    )
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int = 0) -> float | None:
+    """Стоимость запроса в USD (None — цена модели неизвестна)"""
+    price = MODEL_PRICES.get(model)
+    if price is None:
+        return None
+    return (input_tokens * price[0] + output_tokens * price[1]) / 1_000_000
@@ -0,0 +1,92 @@
+"""
+Политики инструментов ассистентов и дешёвый локальный классификатор хода.
+
+file_search не подключается только к ходам, которые целиком состоят из
+вежливости и подтверждений («спасибо», «ок», «понятно»), — это и быстрее, и дешевле.
+Всё остальное ищется: короткое «какие документы нужны» без «?» — тоже вопрос
+к базе знаний, и промах здесь дороже лишнего поиска. code_interpreter — только
+для расчётов/анализа данных или когда у диалога есть живой контейнер.
+
+Классификатор — регулярные выражения, без модели и без сети.
+"""
+from __future__ import annotations
+import re
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class ToolPolicy:
+    retrieval: str = "auto"         # auto — решает классификатор; always / never
+    max_num_results: int = 10       # сколько фрагментов file_search отдаёт модели
+    score_threshold: float = 0.0    # фрагменты с меньшей релевантностью отбрасываются
+    ranker: str = "auto"
+
+
+DEFAULT_POLICY = ToolPolicy()
+
+# Вежливость, подтверждения, приветствия — поиск по базе знаний не нужен
+SMALL_TALK = re.compile(
+    r"^(спасибо|спс|благодарю|ок|окей|ok|хорошо|понял|поняла|понятно|ясно|супер|отлично|класс|"
+    r"круто|нет|ага|угу|привет|здравствуйте|добрый|день|вечер|доброе|утро|пока|до|свидания|"
+    r"не|надо|всё|все|готово|большое|огромное|очень|и|тебе|вам)$"
+)
+# «Да», «давай», «подробнее» — обычно согласие на предложение ассистента что-то найти
+CONTINUE_WORDS = {"да", "давай", "продолжай", "дальше", "подробнее", "ещё", "еще"}
+# Темы базы знаний: упоминание — всегда повод искать
+KNOWLEDGE_HINTS = re.compile(
+    r"комисси|логистик|fbo|fbs|dbs|оферт|штраф|выкуп|хранени|реклам|карточк|seo|остатк|поставк|"
+    r"маркировк|сертифик|декларац|тариф|склад|возврат|продвижени|рейтинг|отзыв|акци|wildberries|\bwb\b|вб",
+    re.IGNORECASE
+)
+# Признаки того, что ходу нужен code_interpreter (расчёты, таблицы, графики)
+CODE_INTERPRETER_HINTS = re.compile(
+    r"посчита|рассчита|расч[её]т|вычисл|формул|процент|сумм|средн|медиан|динамик|прогноз|"
+    r"график|диаграм|визуализ|таблиц|excel|xlsx|csv|выгрузк|файл|отч[её]т|статистик|проанализируй|анализ данных",
+    re.IGNORECASE
+)
+_WORD_RE = re.compile(r"[\w-]+")
+
+
+def needs_retrieval(text: str | None) -> bool:
+    """Нужен ли ходу поиск по базе знаний"""
+    if not text:
+        return False
+    if KNOWLEDGE_HINTS.search(text):
+        return True
+
+    words = _WORD_RE.findall(text.lower())
+    if not words:
+        return False  # эмодзи, стикеры-текстом, пунктуация
+    if CONTINUE_WORDS & set(words):
+        return True
+    # Пропускаем поиск только при явной вежливости/подтверждении, иначе — ищем
+    return not all(SMALL_TALK.match(word) for word in words)
+
+
+def needs_code_interpreter(text: str | None, container_id: str | None = None) -> bool:
+    """
+    Подключать ли code_interpreter к текстовому ходу: есть живой контейнер
+    (в нём файлы и результаты прошлых ходов) или вопрос похож на расчёт/анализ данных.
+    """
+    return bool(container_id) or bool(text and CODE_INTERPRETER_HINTS.search(text))
+
+
+def wants_file_search(policy: ToolPolicy, text: str | None, classifier: bool = True) -> bool:
+    """Решение по file_search для хода с учётом политики ассистента"""
+    if policy.retrieval == "never":
+        return False
+    if policy.retrieval == "always" or not classifier:
+        return True
+    return needs_retrieval(text)
+
+
+def file_search_tool(vector_store_id: str, policy: ToolPolicy) -> dict:
+    return {
+        "type": "file_search",
+        "vector_store_ids": [vector_store_id],
+        "max_num_results": policy.max_num_results,
+        "ranking_options": {
+            "ranker": policy.ranker,
+            "score_threshold": policy.score_threshold,
+        },
+    }
@@ -0,0 +1,248 @@
+"""
+Трассировка апдейтов и лог медленных запросов.
+
+Каждый апдейт (и каждая задача воркера) — трасса со стеком спанов,
+текущая трасса и спан передаются через contextvars, поэтому видны
+во всех вложенных вызовах и в задачах, созданных через asyncio.create_task.
+
+Если обработка заняла дольше SLOW_UPDATE_THRESHOLD, трасса пишется в
+SLOW_LOG_PATH (JSON Lines): дерево спанов, количество и время SQL-запросов,
+response_id OpenAI. Запись — буферизованная фоновая (как у capture.py),
+без синхронного open/write в event loop, который в этот момент и так перегружен.
+
+Если задан OTEL_TRACE_FILE и установлен opentelemetry-sdk, все трассы
+дополнительно выгружаются в этот файл в формате OpenTelemetry.
+"""
+from __future__ import annotations
+import contextlib
+import contextvars
+import functools
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from sqlalchemy import event
+
+from capture import JsonlWriter
+from config import SLOW_UPDATE_THRESHOLD, SLOW_LOG_PATH, OTEL_TRACE_FILE
+
+
+@dataclass
+class Span:
+    name: str
+    started: float
+    attrs: dict[str, Any] = field(default_factory=dict)
+    children: list[Span] = field(default_factory=list)
+    ended: float | None = None
+    error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return (self.ended or time.perf_counter()) - self.started
+
+    def to_dict(self, origin: float) -> dict:
+        data = {
+            "name": self.name,
+            "start_ms": round((self.started - origin) * 1000, 1),
+            "duration_ms": round(self.duration * 1000, 1),
+        }
+        if self.attrs:
+            data["attrs"] = self.attrs
+        if self.error:
+            data["error"] = self.error
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in self.children]
+        return data
+
+
+@dataclass
+class Trace:
+    root: Span
+    wall_started: datetime
+    attrs: dict[str, Any] = field(default_factory=dict)
+    db_statements: int = 0
+    db_time: float = 0.0
+
+
+# Подписчики на завершённые трассы (например, нагрузочный бенчмарк)
+TRACE_LISTENERS: list[Callable[[Trace], None]] = []
+
+slow_log = JsonlWriter(SLOW_LOG_PATH)
+
+_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("trace", default=None)
+_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("span", default=None)
+
+
+def set_attribute(key: str, value: Any) -> None:
+    """Атрибут всей трассы (например, openai_response_id)"""
+    current = _trace.get()
+    if current is not None:
+        current.attrs[key] = value
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    """Вложенный спан текущей трассы (без трассы — ничего не делает)"""
+    parent = _span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, time.perf_counter(), {k: v for k, v in attrs.items() if v is not None})
+    parent.children.append(child)
+    token = _span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = type(e).__name__
+        raise
+    finally:
+        child.ended = time.perf_counter()
+        _span.reset(token)
+
+
+def traced(name: str):
+    """Декоратор async-функции: вызов — отдельный спан"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.asynccontextmanager
+async def trace(name: str, **attrs):
+    """Корневой спан: апдейт Telegram или задача воркера"""
+    root = Span(name, time.perf_counter(), attrs)
+    current = Trace(root, datetime.now())
+    trace_token = _trace.set(current)
+    span_token = _span.set(root)
+    try:
+        yield current
+    except BaseException as e:
+        root.error = type(e).__name__
+        raise
+    finally:
+        root.ended = time.perf_counter()
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+        _finish(current)
+
+
+def _finish(current: Trace) -> None:
+    for listener in TRACE_LISTENERS:
+        listener(current)
+    if current.root.duration >= SLOW_UPDATE_THRESHOLD:
+        _write_slow_log(current)
+    if _otel_tracer is not None:
+        _export_otel(current)
+
+
+def _write_slow_log(current: Trace) -> None:
+    record = {
+        "time": current.wall_started.isoformat(timespec="milliseconds"),
+        "duration_ms": round(current.root.duration * 1000, 1),
+        "db_statements": current.db_statements,
+        "db_time_ms": round(current.db_time * 1000, 1),
+        **current.attrs,
+        "spans": current.root.to_dict(current.root.started),
+    }
+    logging.warning(f"Slow {current.root.name}: {record['duration_ms']}ms "
+                    f"({current.db_statements} SQL, {current.attrs})")
+    slow_log.put(record)
+
+
+# ======================================================
+#                      SQLALCHEMY
+# ======================================================
+def instrument_engine(engine) -> None:
+    """Считать SQL-запросы и их время в текущей трассе"""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("trace_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["trace_started"].pop()
+        current = _trace.get()
+        if current is not None:
+            current.db_statements += 1
+            current.db_time += time.perf_counter() - started
+
+
+# ======================================================
+#                      AIOGRAM
+# ======================================================
+class TracingMiddleware(BaseMiddleware):
+    """Outer-middleware на update: трасса на каждый апдейт"""
+
+    async def __call__(self, handler, event: Update, data):
+        user = data.get("event_from_user")
+        async with trace(event.event_type) as current:
+            current.attrs["update_id"] = event.update_id
+            if user:
+                current.attrs["tg_id"] = user.id
+            return await handler(event, data)
+
+
+# ======================================================
+#                   OPENTELEMETRY
+# ======================================================
+def _setup_otel():
+    if not OTEL_TRACE_FILE:
+        return None
+    try:
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor, ConsoleSpanExporter
+    except ImportError:
+        logging.warning("OTEL_TRACE_FILE is set, but opentelemetry-sdk is not installed")
+        return None
+
+    out = open(OTEL_TRACE_FILE, "a", encoding="utf-8")
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(
+        ConsoleSpanExporter(out=out, formatter=lambda s: s.to_json(indent=None) + "\n")
+    ))
+    return provider.get_tracer("titan")
+
+
+_otel_tracer = _setup_otel()
+
+
+def _export_otel(current: Trace) -> None:
+    from opentelemetry import trace as otel_trace
+
+    # perf_counter -> наносекунды unix-времени
+    offset = current.wall_started.timestamp() - current.root.started
+
+    def to_ns(moment: float) -> int:
+        return int((moment + offset) * 1e9)
+
+    def emit(item: Span, context=None) -> None:
+        otel_span = _otel_tracer.start_span(item.name, context=context, start_time=to_ns(item.started))
+        for key, value in item.attrs.items():
+            if value is not None:
+                otel_span.set_attribute(key, value if isinstance(value, (str, int, float, bool)) else str(value))
+        if item.error:
+            otel_span.set_attribute("error", item.error)
+        child_context = otel_trace.set_span_in_context(otel_span)
+        for child in item.children:
+            emit(child, child_context)
+        otel_span.end(end_time=to_ns(item.ended or item.started))
+
+    try:
+        current.root.attrs.update(
+            {f"trace.{k}": v for k, v in current.attrs.items()},
+            db_statements=current.db_statements
+        )
+        emit(current.root)
+    except Exception as e:
+        logging.warning(f"Failed to export trace: {e}")
@@ -0,0 +1,166 @@
+"""
+Воркер очереди задач ассистентов (QUEUE_MODE=true).
+
+main.py принимает апдейты и кладёт задачи в таблицу task_queue,
+воркеры забирают их, ходят в OpenAI и сами отправляют ответы в Telegram.
+
+Запуск:
+    python worker.py
+
+Масштабирование: WORKER_PROCESSES процессов на контейнер (по ядрам),
+WORKER_CONCURRENCY задач на процесс, плюс реплики Railway.
+Лимит отправки SEND_GLOBAL_RATE делится между ботом и воркерами (SEND_PROCESSES).
+"""
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+from datetime import datetime
+from functools import partial
+
+from aiogram import Bot
+
+from config import WORKER_PROCESSES, WORKER_CONCURRENCY, METRICS_PORT
+from database import create_db, TaskQueue
+from assistant_service import create_bot, run_task, deliver_background_reply
+from background_jobs import job_poller
+from openai_client_v2 import preload_tokenizers
+from task_queue import claim_task, complete_task, requeue_stale_tasks
+from coordination import start_coordination, stop_coordination
+from metrics import start_metrics_server
+from tracing import trace, slow_log
+from admission import admission
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Интервалы опроса очереди при простое (секунды)
+IDLE_POLL_MIN = 0.1
+IDLE_POLL_MAX = 1.0
+# Как часто возвращать в очередь задачи упавших воркеров (секунды)
+JANITOR_INTERVAL = 60
+
+
+async def handle_task(bot: Bot, task: TaskQueue) -> None:
+    """Выполнить одну задачу из очереди"""
+    payload = json.loads(task.payload)
+    # При повторном выполнении (воркер упал) не списываем запрос второй раз
+    charge = task.attempts <= 1
+
+    # Воркер и так держит только эту задачу, background-режим для файлов не нужен
+    await run_task(
+        bot, task.kind, task.tg_id, task.chat_id, task.assistant_id, payload,
+        task.loading_message_id, charge=charge, allow_background=False
+    )
+
+
+async def worker_loop(bot: Bot, worker_id: str, stop: asyncio.Event) -> None:
+    idle = IDLE_POLL_MIN
+
+    while not stop.is_set():
+        task = await claim_task(worker_id)
+        if task is None:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=idle)
+            except TimeoutError:
+                pass
+            idle = min(idle * 2, IDLE_POLL_MAX)
+            continue
+
+        idle = IDLE_POLL_MIN
+        if task.enqueued_at:
+            admission.observe_queue_wait((datetime.utcnow() - task.enqueued_at).total_seconds())
+        try:
+            async with trace(f"task_{task.kind}") as current:
+                current.attrs.update(task_id=task.id, tg_id=task.tg_id, attempt=task.attempts)
+                await handle_task(bot, task)
+        except Exception as e:
+            logging.error(f"Task {task.id} crashed: {type(e).__name__}: {e}")
+        finally:
+            await complete_task(task.id)
+
+
+async def janitor_loop(stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            await requeue_stale_tasks()
+        except Exception as e:
+            logging.warning(f"Failed to requeue stale tasks: {e}")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=JANITOR_INTERVAL)
+        except TimeoutError:
+            pass
+
+
+async def run_worker(concurrency: int = WORKER_CONCURRENCY, bot: Bot | None = None,
+                     stop: asyncio.Event | None = None) -> None:
+    """Запустить concurrency циклов обработки в текущем процессе"""
+    bot = bot or create_bot()
+    stop = stop or asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await create_db()
+    await start_coordination()
+    await preload_tokenizers()
+
+    # Background-задачи бота: если его процесс перезапускается, их доопрашивает любой живой процесс
+    await job_poller.start(partial(deliver_background_reply, bot))
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    logging.info(f"Worker {worker_id} started with concurrency {concurrency}")
+
+    try:
+        await asyncio.gather(
+            janitor_loop(stop),
+            *(worker_loop(bot, f"{worker_id}:{i}", stop) for i in range(concurrency))
+        )
+    finally:
+        await job_poller.stop()
+        await slow_log.stop()
+        await stop_coordination()
+        await bot.session.close()
+        logging.info(f"Worker {worker_id} stopped")
+
+
+def _process_entry(index: int = 0) -> None:
+    # Порт метрик: следующий за портом бота, у каждого процесса свой
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + 1 + index)
+    asyncio.run(run_worker())
+
+
+def main() -> None:
+    if WORKER_PROCESSES <= 1:
+        _process_entry()
+        return
+
+    processes = [
+        multiprocessing.Process(target=_process_entry, args=(i,), name=f"assistant-worker-{i}")
+        for i in range(WORKER_PROCESSES)
+    ]
+    for p in processes:
+        p.start()
+
+    # SIGTERM от Railway приходит только родителю — пересылаем детям
+    def forward_signal(signum, frame):
+        for p in processes:
+            p.terminate()
+
+    signal.signal(signal.SIGTERM, forward_signal)
+
+    for p in processes:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()